@@ -9,5 +9,5 @@ setup(name='sepiida-agent',
       url='http://sepiida.linuxavdelingen.no',
       packages=['sepiida.agent'],
       package_dir={'sepiida': 'src/sepiida'},
-      scripts=['scripts/sepiida-agent', 'scripts/sepiida-agent-connect', 'scripts/sepiida-vnc-proxy-ssh']
+      scripts=['scripts/sepiida-agent', 'scripts/sepiida-agent-connect', 'scripts/sepiida-vnc-proxy-ssh', 'scripts/sepiida-thumbnailer']
      )  
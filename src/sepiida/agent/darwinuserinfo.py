@@ -19,7 +19,7 @@ from twisted.internet import \
     reactor, protocol, defer, utils, threads
 from twisted.python import log
 
-from misc import getpw, getpwuid, getgroups
+from misc import getpw, getpwuid, getgroups, group_index
 import sys
 import time
 import os
@@ -88,6 +88,9 @@ class UserInfo(object):
         self._resolveCache = {}
         self._HWAddr = None
     
+    def watchProcesses(self, cbLoginEvent):
+        raise NotImplementedError
+    
     @defer.deferredGenerator
     def updateUsersProcesses(self, cbChanged):
         """
@@ -145,6 +148,10 @@ class UserInfo(object):
             yield wait
             self._HWAddr = wait.getResult()
         
+        wait = defer.waitForDeferred(group_index.ready())
+        yield wait
+        wait.getResult()
+        
         log.debug('login processes: %s' % loginProcesses)
         users = {}
         for lstart, user, pid, commandline in loginProcesses:
@@ -16,10 +16,13 @@
 # along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
 
 from twisted.internet import \
-    reactor, protocol, defer, utils, threads
+    reactor, protocol, defer, utils, threads, error
 from twisted.python import log
 
-from misc import getpw, getpwuid, getgroups
+from misc import getpw, getpwuid, getgroups, group_index, prefetch
+import procfs
+import procevents
+import thumbnails
 import sys
 import time
 import socket
@@ -31,6 +34,18 @@ import shlex
 from string import Template
 import config
 
+def killProcess(processProtocol):
+    """
+    Return a canceller for a deferred called back by processProtocol,
+    which kills its process.
+    """
+    def cancel(deferred):
+        try:
+            processProtocol.transport.signalProcess('KILL')
+        except (error.ProcessExitedAlready, AttributeError):
+            pass
+    return cancel
+
 class SlurpProtocol(protocol.ProcessProtocol):
     def __init__(self, deferred):
         self.buffer = cStringIO.StringIO()
@@ -43,7 +58,8 @@ class SlurpProtocol(protocol.ProcessProtocol):
         self.buffer.write(data)
     
     def processEnded(self, status):
-        self.deferred.callback(self.buffer.getvalue())
+        if not self.deferred.called: # not cancelled
+            self.deferred.callback(self.buffer.getvalue())
         self.buffer.close()
         
 class NullProtocol(protocol.ProcessProtocol):
@@ -107,7 +123,117 @@ class UserInfo(object):
         self._prevPIDList = []
         self._loginPIDs = []
         self._resolveCache = {}
+        # Used when watching process events, see watchProcesses
+        self._eventReader = None
+        self._cbLoginEvent = None
+        self._table = None # {pid: (uid, starttime, commandline)}
+        self._tableChanged = False
+        self._eventPIDs = {} # {pid: event} received while scanning
+        self._eventsLost = 0 # times events have been lost, see _scanProcesses
+        self._loginEventCall = None
+        self._scanDeferred = None
+        self._scanWaiting = [] # deferreds waiting for _scanDeferred
+        self._bootTime = 0
+        self._thumbnailWorkers = {} # {(display, uid): ThumbnailWorker}
+        self._thumbnailCache = None
+        
+    def watchProcesses(self, cbLoginEvent):
+        """
+        Keep the process table updated from kernel process events instead of
+        rescanning /proc. cbLoginEvent is called (without arguments) shortly
+        after a login process has started or exited, and should call
+        updateUsersProcesses.
+        Raises socket.error if process events aren't available, in which
+        case polling continues as before.
+        """
+        reader = procevents.ProcessEventReader(self._processEvent,
+                                               self._processEventsLost)
+        reader.start()
+        self._eventReader = reader
+        self._cbLoginEvent = cbLoginEvent
+        self._table = None # force a full scan
+    
+    def _processEvent(self, what, pid):
+        if self._table is None: # full scan in progress
+            self._eventPIDs[pid] = what
+            return
+        self._applyEvent(what, pid)
+    
+    def _applyEvent(self, what, pid):
+        loginEvent = False
+        if what == procevents.PROC_EVENT_EXIT:
+            # the process is a zombie at this point, so don't reread it
+            if self._table.pop(pid, None) is not None:
+                loginEvent = pid in self._loginPIDs
+        else:
+            try:
+                entry = self._table[pid] = procfs.readProcess(pid, self._bootTime)
+                loginEvent = entry[2].startswith(config.get().get('Agent', 'login cmd'))
+            except (IOError, OSError, ValueError, IndexError):
+                self._table.pop(pid, None)
+        self._tableChanged = True
+        
+        if loginEvent and not self._loginEventCall:
+            # coalesce e.g. a login process forking and then exec'ing
+            def call():
+                self._loginEventCall = None
+                self._cbLoginEvent()
+            self._loginEventCall = reactor.callLater(0.1, call)
+    
+    def _processEventsLost(self):
+        self._table = None
+        self._eventPIDs = {}
+        self._eventsLost += 1
+        if self._eventReader.socket is None: # reader stopped
+            self._eventReader = None
+        if not self._loginEventCall:
+            self._cbLoginEvent()
+    
+    def _scanProcesses(self):
+        """
+        Return a deferred which is called back with the process table.
+        """
+        if self._eventReader is None:
+            return threads.deferToThread(procfs.scanProcesses)
+        elif self._table is not None:
+            self._tableChanged = False
+            return defer.succeed(self._table)
+        
+        def cbScanned(table, eventsLost):
+            self._scanDeferred = None
+            if eventsLost != self._eventsLost:
+                # events were lost while scanning, so the table may already
+                # be out of date and the events received since are gone,
+                # scan again next time
+                return table
+            self._table = table
+            events, self._eventPIDs = self._eventPIDs, {}
+            for pid, what in events.iteritems():
+                self._applyEvent(what, pid)
+            self._tableChanged = False
+            return table
+        
+        def ebScanned(failure):
+            # scan again next time
+            self._scanDeferred = None
+            return failure
         
+        def done(result, waiting):
+            # the table, or the failure
+            for d in waiting:
+                d.callback(result)
+        
+        d = defer.Deferred()
+        if self._scanDeferred is None:
+            self._bootTime = procfs.getBootTime()
+            self._scanDeferred = threads.deferToThread(procfs.scanProcesses)
+            self._scanDeferred.addCallbacks(cbScanned, ebScanned,
+                                            callbackArgs=(self._eventsLost,))
+            self._scanWaiting = []
+            self._scanDeferred.addBoth(done, self._scanWaiting)
+        self._scanWaiting.append(d)
+        return d
+    
     def updateUsersProcesses(self, cbChanged):
         """
         Update list of users and processes.
@@ -119,48 +245,29 @@ class UserInfo(object):
         cbChanged is called with the value True if the list of users has
         changed, otherwise False.
         """
-        # actually a list of files in /proc, but the PIDs should be the only things changing
-        pids = os.listdir('/proc')
-        if pids == self._prevPIDList:
-            cbChanged(False)
-            return
-        self._prevPIDList = pids
-        
-        cfg = config.get()
-        
-        import re
-        # What we're matching:
-        # Mon May 25 19:59:23 2009 1000      23043 /bin/bash
-        re_ps = re.compile(r'^(\S+\s*\S+\s*\S+\s*\S+\s*\S+)\s*(\S+)\s*(\S+)\s*(.+)$')
-        re_number = re.compile(r'^\d+$')
-        cmd_login = cfg.get('Agent', 'login cmd')
+        if self._eventReader is not None:
+            if self._table is not None and not self._tableChanged:
+                cbChanged(False)
+                return
+        else:
+            # actually a list of files in /proc, but the PIDs should be the only things changing
+            pids = os.listdir('/proc')
+            if pids == self._prevPIDList:
+                cbChanged(False)
+                return
+            self._prevPIDList = pids
         
-        args = ['ww', '-e', '-o', 'lstart,uid,pid,args']
-        env = {'LC_ALL': 'C'}
-        d = utils.getProcessOutput('/bin/ps', args, env)
+        d = self._scanProcesses()
         wait = defer.waitForDeferred(d)
         yield wait
-        output = wait.getResult()
-        
-        processes = {} # {user: [ (pid, commandline)] }
-        loginProcesses = [] # [ (logintime, user, pid, commandline) ]
-        for line in output.splitlines()[1:]: # skip header
-            m = re_ps.match(line)
-            if not m:
-                log.err('ps regex didn\'t match %s' % line)
-                continue
-            lstart, uid, pid, commandline = m.groups()
-            commandline = commandline.decode('utf-8', 'replace')
-
-            try:
-                user = getpwuid(int(uid)).pw_name.decode('utf-8')
-            except KeyError:
-                continue
-                
-            processes.setdefault(user, []).append((int(pid), commandline))
-
-            if commandline.startswith(cmd_login):
-                loginProcesses.append((lstart, user, int(pid), commandline))
+        table = wait.getResult()
+        # resolve UIDs not in the cache in threads, so that a slow NSS
+        # backend doesn't block the reactor
+        wait = defer.waitForDeferred(
+            prefetch(getpwuid, set(entry[0] for entry in table.itervalues())))
+        yield wait
+        wait.getResult()
+        processes, loginProcesses = self._processesFromTable(table)
         
         self.processes = processes
         
@@ -171,13 +278,13 @@ class UserInfo(object):
         self._loginPIDs = loginPIDs
         
         log.debug('login processes: %s' % loginProcesses)
+        wait = defer.waitForDeferred(defer.DeferredList([
+            prefetch(getpw, set(l[1] for l in loginProcesses)),
+            group_index.ready()]))
+        yield wait
+        wait.getResult()
         users = {}
-        for lstart, user, pid, commandline in loginProcesses:
-            try:
-                logintime = time.mktime(time.strptime(lstart))
-            except ValueError:
-                log.err('failed to parse lstart \'%s\'' % lstart)
-                continue
+        for logintime, user, pid, commandline in loginProcesses:
             try:
                 env = dict(
                               ( var.split('=', 1) for var in
@@ -236,6 +343,35 @@ class UserInfo(object):
     
     updateUsersProcesses = defer.deferredGenerator(updateUsersProcesses)
     
+    def _processesFromTable(self, table):
+        """
+        Turn a process table as returned by procfs.scanProcesses into
+        {user: [ (pid, commandline)] } and a list of login processes,
+        [ (logintime, user, pid, commandline) ] sorted by PID.
+        """
+        cmd_login = config.get().get('Agent', 'login cmd')
+        usernames = {} # {uid: username}
+        processes = {} # {user: [ (pid, commandline)] }
+        loginProcesses = [] # [ (logintime, user, pid, commandline) ]
+        for pid in sorted(table):
+            uid, starttime, commandline = table[pid]
+            try:
+                user = usernames[uid]
+            except KeyError:
+                try:
+                    user = usernames[uid] = getpwuid(uid).pw_name.decode('utf-8')
+                except KeyError:
+                    user = usernames[uid] = None
+            if user is None:
+                continue
+            commandline = commandline.decode('utf-8', 'replace')
+            
+            processes.setdefault(user, []).append((pid, commandline))
+            
+            if commandline.startswith(cmd_login):
+                loginProcesses.append((float(starttime), user, pid, commandline))
+        return processes, loginProcesses
+    
     def _maybeResolve(self, ipaddr):
         cfg = config.get()
         if not cfg.getboolean('Agent', 'resolve ips'):
@@ -317,8 +453,53 @@ class UserInfo(object):
         return self._runCmdAsUser(user, 'open url', {'url': url.encode('utf-8', 'replace')})
     
     def getThumbnail(self, user):
-        d = defer.Deferred()
-        sc = SlurpProtocol(d)
+        """
+        Return a deferred which is called back with a JPEG thumbnail of the
+        user's display. Thumbnails are captured by a sepiida-thumbnailer
+        process per display, which is kept running until it has been idle
+        for 'thumbnail idle timeout' seconds. Thumbnails captured less than
+        'thumbnail max age' seconds ago are reused.
+        """
+        cfg = config.get()
+        def getfloat(option, default):
+            if cfg.has_option('Agent', option):
+                return cfg.getfloat('Agent', option)
+            return default
+        maxAge = getfloat('thumbnail max age', 2.0)
+        idleTimeout = getfloat('thumbnail idle timeout', 60.0)
+        
+        if self._thumbnailCache is None:
+            self._thumbnailCache = thumbnails.FrameCache(maxAge)
+        self._thumbnailCache.maxAge = maxAge
+        
+        key = (user.display, user.uid)
+        def capture():
+            try:
+                worker = self._thumbnailWorkers[key]
+            except KeyError:
+                def onExit(worker):
+                    if self._thumbnailWorkers.get(key) is worker:
+                        del self._thumbnailWorkers[key]
+                worker = thumbnails.ThumbnailWorker(onExit, idleTimeout)
+                reactor.spawnProcess(worker, '/usr/bin/sepiida-thumbnailer',
+                                     args=['sepiida-thumbnailer'],
+                                     env=user.env,
+                                     uid=user.uid, gid=user.gid)
+                self._thumbnailWorkers[key] = worker
+            d = worker.capture(320, 240, 50)
+            d.addErrback(ebCapture)
+            return d
+        
+        def ebCapture(failure):
+            failure.trap(thumbnails.CaptureError)
+            log.msg('%s, falling back to screenshoter' % failure.getErrorMessage())
+            return self._runScreenshoter(user)
+        
+        return self._thumbnailCache.get(key, capture)
+    
+    def _runScreenshoter(self, user):
+        sc = SlurpProtocol(None)
+        d = sc.deferred = defer.Deferred(killProcess(sc))
         
         reactor.spawnProcess(sc, '/usr/bin/screenshoter',
                              args=['screenshoter', '-t', '10',
@@ -397,9 +578,9 @@ class UserInfo(object):
             os.chown(pwtmpf.name, user.uid, user.gid)
             reactor.callLater(10, pwtmpf.close)
             
-            deferred_vnc = defer.Deferred()
+            slurp = SlurpProtocol(None)
+            deferred_vnc = slurp.deferred = defer.Deferred(killProcess(slurp))
             deferred_vnc.addCallback(cbVNC, vncpw)
-            slurp = SlurpProtocol(deferred_vnc)
             
             probe_port = random.randint(2000, 30000) # which port x11vnc should start probing at
             reactor.spawnProcess(slurp, '/usr/bin/x11vnc',
@@ -1,34 +1,181 @@
 import pwd
 import grp
+import time
+from collections import OrderedDict
+from twisted.internet import defer, threads
+from twisted.python import log
 
-# from http://wiki.python.org/moin/PythonDecoratorLibrary#Memoize
-class memoized(object):
+class cached(object):
     """Decorator that caches a function's return value each time it is called.
-    If called later with the same arguments, the cached value is returned, and
-    not re-evaluated.
+    If called later with the same arguments within ttl seconds, the cached
+    value is returned, and not re-evaluated. A KeyError raised by the
+    function (e.g. user not found) is cached for negativeTTL seconds.
+    At most maxsize values are kept, the least recently used are evicted
+    first.
     """
-    def __init__(self, func):
+    def __init__(self, func, maxsize=4096, ttl=600, negativeTTL=60):
         self.func = func
-        self.cache = {}
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negativeTTL = negativeTTL
+        self.cache = OrderedDict() # {args: (expires, value, KeyError or None)}
+
+    def _get(self, args):
+        """
+        Return cache entry for args if it hasn't expired, otherwise None.
+        """
+        entry = self.cache.pop(args, None)
+        if entry is None or entry[0] < time.time():
+            return None
+        self.cache[args] = entry # most recently used
+        return entry
+
+    def _store(self, args, value, error=None):
+        if error is None:
+            expires = time.time() + self.ttl
+        else:
+            expires = time.time() + self.negativeTTL
+        self.cache.pop(args, None)
+        self.cache[args] = (expires, value, error)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
     def __call__(self, *args):
         try:
-            return self.cache[args]
-        except KeyError:
-            self.cache[args] = value = self.func(*args)
-            return value
+            entry = self._get(args)
         except TypeError:
             # uncachable -- for instance, passing a list as an argument.
             # Better to not cache than to blow up entirely.
             return self.func(*args)
+        if entry is None:
+            try:
+                value = self.func(*args)
+            except KeyError, e:
+                self._store(args, None, e)
+                raise
+            self._store(args, value)
+            return value
+        expires, value, error = entry
+        if error is not None:
+            raise error
+        return value
+
+    def deferred(self, *args):
+        """
+        Return a deferred which is called back with the value, or errbacked
+        with KeyError. If the value isn't cached, the function is called in
+        a thread so that slow lookups (e.g. LDAP) don't block the reactor.
+        """
+        entry = self._get(args)
+        if entry is not None:
+            expires, value, error = entry
+            if error is not None:
+                return defer.fail(error)
+            return defer.succeed(value)
+
+        def ebKeyError(failure):
+            failure.trap(KeyError)
+            self._store(args, None, failure.value)
+            return failure
+
+        def cbStore(value):
+            self._store(args, value)
+            return value
+
+        d = threads.deferToThread(self.func, *args)
+        d.addCallbacks(cbStore, ebKeyError)
+        return d
+
+    def clear(self):
+        self.cache.clear()
+
     def __repr__(self):
         """Return the function's docstring."""
         return self.func.__doc__
 
-getpw = memoized(pwd.getpwnam)
-getpwuid = memoized(pwd.getpwuid)
+def prefetch(func, keys):
+    """
+    Look up the keys which aren't already cached in func (a cached instance)
+    in threads. Returns a deferred which is called back when done,
+    lookup errors are ignored.
+    """
+    deferreds = []
+    for key in keys:
+        d = func.deferred(key)
+        d.addErrback(lambda failure: None)
+        deferreds.append(d)
+    return defer.DeferredList(deferreds)
+
+getpw = cached(pwd.getpwnam)
+getpwuid = cached(pwd.getpwuid)
+
+class GroupIndex(object):
+    """
+    Index of supplementary group memberships, {username: [group names]},
+    built from grp.getgrall() in a thread, so that a slow NSS backend
+    doesn't block the reactor. Wait for ready() before the first lookup.
+    The index is rebuilt when it's more than ttl seconds old, and the old
+    index is used until the new one is ready.
+    """
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self._index = None
+        self._builtAt = 0
+        self._waiting = None # deferreds waiting for the build, or None
+
+    def _build(self):
+        index = {}
+        for g in grp.getgrall():
+            for member in g.gr_mem:
+                index.setdefault(member, []).append(g.gr_name)
+        return index
+
+    def _update(self, index):
+        self._index = index
+        self._builtAt = time.time()
+
+    def rebuild(self):
+        """
+        Rebuild the index in a thread. Returns a deferred which is called
+        back when done, build errors are logged.
+        """
+        d = defer.Deferred()
+        if self._waiting is not None:
+            self._waiting.append(d)
+            return d
+        self._waiting = [d]
+
+        def done(result):
+            waiting, self._waiting = self._waiting, None
+            for w in waiting:
+                w.callback(None)
+
+        build = threads.deferToThread(self._build)
+        build.addCallbacks(self._update, log.err)
+        build.addBoth(done)
+        return d
+
+    def ready(self):
+        """
+        Return a deferred which is called back when the index has been
+        built (or the first build failed).
+        """
+        if self._index is None:
+            return self.rebuild()
+        return defer.succeed(None)
+
+    def get(self, user):
+        """
+        Return the user's groups. Before the first build has finished
+        this is empty.
+        """
+        if self._index is None or time.time() - self._builtAt > self.ttl:
+            self.rebuild()
+        if self._index is None:
+            return []
+        return list(self._index.get(user, ()))
 
-all_groups = grp.getgrall()
+group_index = GroupIndex()
 
 def getgroups(user):
-    global all_groups
-    return [g.gr_name for g in all_groups if user in g.gr_mem]
+    return group_index.get(user)
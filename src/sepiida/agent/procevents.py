@@ -0,0 +1,145 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Receive fork/exec/exit events from the kernel's process events connector
+(cn_proc) over netlink. Requires root (CAP_NET_ADMIN).
+"""
+
+from twisted.internet import reactor
+from twisted.python import log
+import socket
+import struct
+import errno
+import os
+
+NETLINK_CONNECTOR = 11
+CN_IDX_PROC = 1
+CN_VAL_PROC = 1
+NLMSG_DONE = 3
+PROC_CN_MCAST_LISTEN = 1
+PROC_CN_MCAST_IGNORE = 2
+
+PROC_EVENT_FORK = 0x00000001
+PROC_EVENT_EXEC = 0x00000002
+PROC_EVENT_UID = 0x00000004
+PROC_EVENT_EXIT = 0x80000000
+
+# struct nlmsghdr: len, type, flags, seq, pid
+NLMSGHDR = struct.Struct('=IHHII')
+# struct cb_id + rest of struct cn_msg: idx, val, seq, ack, len, flags
+CNMSG = struct.Struct('=IIIIHH')
+# struct proc_event header: what, cpu, timestamp_ns
+PROC_EVENT = struct.Struct('=IIQ')
+# event data, the first two fields are always (pid, tgid) of the process
+PID_TGID = struct.Struct('=II')
+
+class ProcessEventReader(object):
+    """
+    Reads process events and calls eventReceived(what, pid) for each
+    event concerning a process (not a thread).
+    For PROC_EVENT_FORK, pid is the new child process.
+    If events have been lost because the socket buffer overflowed,
+    eventsLost() is called, and the caller should rescan all processes.
+    """
+
+    def __init__(self, eventReceived, eventsLost):
+        self.eventReceived = eventReceived
+        self.eventsLost = eventsLost
+        self.socket = None
+
+    def start(self):
+        """
+        Subscribe to process events. Raises socket.error on failure, e.g.
+        if not running as root or cn_proc is not supported by the kernel.
+        """
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_CONNECTOR)
+        try:
+            s.bind((os.getpid(), CN_IDX_PROC))
+            s.send(self._control(PROC_CN_MCAST_LISTEN))
+        except socket.error:
+            s.close()
+            raise
+        s.setblocking(False)
+        self.socket = s
+        reactor.addReader(self)
+
+    def stop(self):
+        if self.socket is None:
+            return
+        reactor.removeReader(self)
+        try:
+            self.socket.send(self._control(PROC_CN_MCAST_IGNORE))
+        except socket.error:
+            pass
+        self.socket.close()
+        self.socket = None
+
+    def _control(self, op):
+        payload = struct.pack('=I', op)
+        cnmsg = CNMSG.pack(CN_IDX_PROC, CN_VAL_PROC, 0, 0, len(payload), 0)
+        length = NLMSGHDR.size + len(cnmsg) + len(payload)
+        return NLMSGHDR.pack(length, NLMSG_DONE, 0, 0, os.getpid()) + cnmsg + payload
+
+    # IReadDescriptor
+
+    def fileno(self):
+        if self.socket is None:
+            return -1
+        return self.socket.fileno()
+
+    def logPrefix(self):
+        return 'ProcessEventReader'
+
+    def connectionLost(self, reason):
+        log.msg('process event socket closed: %s' % reason)
+        self.socket = None
+        # delayed, so that it's not called when the reactor is stopping
+        reactor.callLater(0, self.eventsLost)
+
+    def doRead(self):
+        while self.socket is not None:
+            try:
+                data = self.socket.recv(4096)
+            except socket.error, e:
+                if e.args[0] == errno.EAGAIN:
+                    return
+                if e.args[0] == errno.ENOBUFS:
+                    log.msg('process events lost, socket buffer overflowed')
+                    self.eventsLost()
+                    continue
+                raise
+            self._parse(data)
+
+    def _parse(self, data):
+        offset = 0
+        header = NLMSGHDR.size + CNMSG.size
+        while offset + header + PROC_EVENT.size + PID_TGID.size <= len(data):
+            length = NLMSGHDR.unpack_from(data, offset)[0]
+            if length < header:
+                return
+            what = PROC_EVENT.unpack_from(data, offset + header)[0]
+            evoffset = offset + header + PROC_EVENT.size
+            if what == PROC_EVENT_FORK:
+                # parent pid, parent tgid, child pid, child tgid
+                pid, tgid = PID_TGID.unpack_from(data, evoffset + PID_TGID.size)
+            else:
+                pid, tgid = PID_TGID.unpack_from(data, evoffset)
+            if what in (PROC_EVENT_FORK, PROC_EVENT_EXEC, PROC_EVENT_UID,
+                        PROC_EVENT_EXIT) and pid == tgid:
+                self.eventReceived(what, pid)
+            offset += (length + 3) & ~3 # NLMSG_ALIGN
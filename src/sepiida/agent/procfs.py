@@ -0,0 +1,92 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Read process information directly from /proc, without running ps.
+"""
+
+import os
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+def getBootTime():
+    """
+    Return the boot time in unix time, from the btime line in /proc/stat.
+    """
+    f = open('/proc/stat', 'r')
+    try:
+        for line in f:
+            if line.startswith('btime'):
+                return int(line.split()[1])
+    finally:
+        f.close()
+    raise ValueError('btime not found in /proc/stat')
+
+def _read(path):
+    f = open(path, 'r')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def readProcess(pid, bootTime):
+    """
+    Return (uid, starttime, commandline) for pid, where starttime is in
+    unix time and commandline is formatted like ps ww -o args.
+    Raises IOError or OSError if the process has exited.
+    """
+    stat = _read('/proc/%d/stat' % pid)
+    # the command name may contain spaces and parentheses, so split on the
+    # last ")". Field 22 (starttime) is the 20th field after it.
+    lparen = stat.index('(')
+    rparen = stat.rindex(')')
+    comm = stat[lparen+1:rparen]
+    starttime = int(stat[rparen+2:].split(' ', 20)[19])
+
+    uid = None
+    for line in _read('/proc/%d/status' % pid).splitlines():
+        if line.startswith('Uid:'):
+            # real, effective, saved, filesystem: ps uid is the effective UID
+            uid = int(line.split()[2])
+            break
+    if uid is None:
+        raise IOError('no Uid line in /proc/%d/status' % pid)
+
+    cmdline = _read('/proc/%d/cmdline' % pid)
+    if cmdline:
+        commandline = cmdline.rstrip('\x00').replace('\x00', ' ')
+    else: # kernel thread or zombie
+        commandline = '[%s]' % comm
+
+    return uid, bootTime + starttime // CLOCK_TICKS, commandline
+
+def scanProcesses():
+    """
+    Return a dict of {pid: (uid, starttime, commandline)} for all processes.
+    Processes which exit while scanning are skipped.
+    """
+    bootTime = getBootTime()
+    processes = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        pid = int(name)
+        try:
+            processes[pid] = readProcess(pid, bootTime)
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+    return processes
@@ -0,0 +1,136 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+import random
+
+class ProcessTable(object):
+    """
+    Versioned per-user process table, used to answer processes requests
+    with only the processes added and removed since a given version.
+    Versions are strings of the form "generation:N", where generation
+    changes each time the agent is started, so that versions from a
+    previous agent are never mistaken for current ones.
+    """
+    MAX_REMOVED = 1000 # number of removed PIDs to remember per user
+    MAX_GONE = 100 # number of logged out users to remember
+
+    def __init__(self):
+        self.generation = '%08x' % random.getrandbits(32)
+        self.version = 0
+        self._users = {} # {username: {pid: (version, commandline)}}
+        self._removed = {} # {username: deque([ (version, pid) ])}
+        self._horizon = {} # {username: oldest version deltas can be made from}
+        self._loggedOut = {} # {username: version}
+        self._gone = deque() # [ (version, username) ] logged out
+        self._goneHorizon = 0 # horizon of users not remembered
+        self._source = None
+
+    def update(self, processes):
+        """
+        Update table from UserInfo.processes, {username: [ (pid, commandline)] }.
+        UserInfo replaces the dict when processes change, so the same dict
+        as last time means nothing has changed.
+        """
+        if processes is self._source:
+            return
+        self._source = processes
+        self.version += 1
+        version = self.version
+        changed = False
+
+        for username in set(self._users) - set(processes):
+            self._remove(username, self._users.pop(username).keys(), version)
+            self._loggedOut[username] = version
+            self._gone.append((version, username))
+            changed = True
+
+        for username, plist in processes.iteritems():
+            try:
+                table = self._users[username]
+            except KeyError:
+                table = self._users[username] = {}
+                self._horizon.setdefault(username, version - 1)
+                self._loggedOut.pop(username, None)
+            current = dict(plist)
+            removed = [pid for pid in table if pid not in current]
+            if removed:
+                self._remove(username, removed, version)
+                for pid in removed:
+                    del table[pid]
+                changed = True
+            for pid, commandline in current.iteritems():
+                entry = table.get(pid)
+                if entry is None or entry[1] != commandline:
+                    table[pid] = (version, commandline)
+                    changed = True
+
+        self._forgetGone()
+        if not changed:
+            self.version -= 1
+
+    def _remove(self, username, pids, version):
+        removed = self._removed.setdefault(username, deque())
+        for pid in pids:
+            removed.append((version, pid))
+        while len(removed) > self.MAX_REMOVED:
+            self._horizon[username] = removed.popleft()[0]
+
+    def _forgetGone(self):
+        """
+        Forget the removed PIDs of the users who logged out longest ago,
+        beyond MAX_GONE. Deltas for users not remembered can only be made
+        from versions after they were forgotten.
+        """
+        while len(self._gone) > self.MAX_GONE:
+            version, username = self._gone.popleft()
+            if self._loggedOut.get(username) != version:
+                continue # logged in again, or out again later
+            del self._loggedOut[username]
+            self._removed.pop(username, None)
+            self._horizon.pop(username, None)
+            self._goneHorizon = max(self._goneHorizon, version)
+
+    def _parseVersion(self, token):
+        try:
+            generation, version = token.split(':')
+            version = int(version)
+        except (AttributeError, ValueError):
+            return None
+        if generation != self.generation or version > self.version:
+            return None
+        return version
+
+    def get(self, username, since=None):
+        """
+        Return a dict with the current version and either the full list of
+        processes for username ('processes') or, if possible, the processes
+        added or changed ('added') and the PIDs removed ('removed') since
+        the version since.
+        """
+        table = self._users.get(username, {})
+        token = '%s:%d' % (self.generation, self.version)
+        version = self._parseVersion(since)
+        if version is None or \
+           version < self._horizon.get(username, self._goneHorizon):
+            return {'version': token,
+                    'processes': [(pid, table[pid][1]) for pid in sorted(table)]}
+
+        added = [(pid, table[pid][1]) for pid in sorted(table)
+                 if table[pid][0] > version]
+        removed = [pid for v, pid in self._removed.get(username, ()) if v > version]
+        return {'version': token, 'added': added, 'removed': removed}
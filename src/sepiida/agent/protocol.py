@@ -18,24 +18,38 @@
 from twisted.internet import reactor, defer, task
 from twisted.protocols import basic
 from twisted.python import log
-try:
-    import json
-except ImportError:
-    import simplejson as json
+
+import socket
+import hashlib
 
 import config
 from userinfo import UserInfo
+from proctable import ProcessTable
+from sepiida import wire
 
 class AgentProtocol(basic.Int32StringReceiver):
     MAX_LENGTH = 10000000
     def __init__(self):
         self.userInfo = UserInfo()
+        self.processTable = ProcessTable()
+        self.codec = wire.Codec()
+        self._inflight = {} # {requestID: deferred}, see _handleCancel
     
     def connectionMade(self):
         config.reload()
         # Send hello (info) message
         self._sendInfo(hello=True)
         
+        cfg = config.get()
+        if cfg.has_option('Agent', 'process events') and \
+           cfg.getboolean('Agent', 'process events'):
+            try:
+                self.userInfo.watchProcesses(self._sendUpdatedUserInfo)
+            except NotImplementedError:
+                log.msg('process events are not supported on this platform')
+            except socket.error, e:
+                log.msg('failed to watch process events, polling: %s' % e)
+        
         self.update_loop = task.LoopingCall(self._sendUpdatedUserInfo)
         self.update_info_loop = task.LoopingCall(self._sendInfo)        
         def startLooping():
@@ -53,27 +67,50 @@ class AgentProtocol(basic.Int32StringReceiver):
         req = 'error'
         reqid = 0
         try:
-            request = json.loads(data)
+            request = self.codec.decode(data)
             req = request['request']
             args = request['args']
             reqid = request['requestID']
             
+            def done(result):
+                self._inflight.pop(reqid, None)
+                return result
+            
             def sendResponse(data):
                 self.sendResponse(req, reqid, data)
             
+            def ebFailed(failure):
+                if failure.check(defer.CancelledError):
+                    return # the server has given up on it
+                log.err(failure)
+                self.sendResponse(req, reqid, '', 'failed')
+            
             handler = getattr(self, '_handle' + req.capitalize())
             deferred = defer.Deferred()
+            deferred.addBoth(done)
             deferred.addCallback(sendResponse)
+            deferred.addErrback(ebFailed)
+        except wire.StreamError, e:
+            log.msg('closing connection: %s' % e)
+            self.transport.loseConnection()
+            return
         except (KeyError, ValueError, AttributeError):
             log.err()
             self.sendResponse(req, reqid, '', 'invalid request')
             return
-        handler(deferred, args)
+        self._inflight[reqid] = deferred
+        try:
+            handler(deferred, args)
+        except Exception:
+            if deferred.called:
+                log.err()
+            else:
+                deferred.errback()
     
     stringReceived = requestReceived
     
     def sendResponse(self, request, requestID, data, error=''):
-        response = json.dumps(
+        response = self.codec.encode(
                               {'requestID': requestID,
                                'response': request,
                                'data': data,
@@ -109,6 +146,10 @@ class AgentProtocol(basic.Int32StringReceiver):
         else:
             reqid = -2
         def cbInfo(data):
+            if hello:
+                # features this agent can decode, see _handleFeatures,
+                # and the requests the server may check for
+                data['features'] = list(wire.FEATURES) + ['cancel']
             self.sendResponse('info', reqid, data)
         
         d = defer.Deferred()
@@ -140,6 +181,9 @@ class AgentProtocol(basic.Int32StringReceiver):
         for each user, and should return user data or a deferred. 
         """
         def ebFailed(failure, udict):
+            if failure.check(defer.CancelledError):
+                udict['error'] = 'cancelled'
+                return udict
             log.msg('unhandled failure: %s' % failure)
             udict['error'] = 'failed'
             return udict
@@ -150,6 +194,8 @@ class AgentProtocol(basic.Int32StringReceiver):
             d = defer.maybeDeferred(cbUser, user, udict)
             d.addErrback(ebFailed, udict)
             deferreds.append(d)
+        # cancelled by _handleCancel
+        deferred.helpers = deferreds
         
         def cbSuccess(result):
             deferred.callback([t[1] for t in result])
@@ -183,15 +229,33 @@ class AgentProtocol(basic.Int32StringReceiver):
         db = defer.maybeDeferred(self.userInfo.getBootTime)
         db.addCallback(reply)
         
+    def _handleFeatures(self, deferred, args):
+        """
+        Handle features request. args is the list of features (see
+        sepiida.wire) the server can decode, which may then be used in
+        responses. Returns the features this agent can decode.
+        """
+        self.codec.setPeerFeatures(args)
+        deferred.callback(list(wire.FEATURES))
+    
     def _handleProcesses(self, deferred, args):
+        """
+        Handle processes request.
+        If a user dict contains 'since', a version returned by an earlier
+        request, only the processes added ('added') and the PIDs removed
+        ('removed') since then are returned if possible. Otherwise the
+        full list is returned in 'processes'.
+        """
         def get(user, udata):
+            since = udata.pop('since', None)
             if user:
-                udata['processes'] = self.userInfo.processes[user.username]
+                udata.update(self.processTable.get(user.username, since))
             else:
                 udata['processes'] = []
             return udata
         
         def cbChanged(changed):
+            self.processTable.update(self.userInfo.processes)
             self._genericUserRequestHandler(deferred, args, get)
         
         self.userInfo.updateUsersProcesses(cbChanged)
@@ -216,14 +280,39 @@ class AgentProtocol(basic.Int32StringReceiver):
             self._genericUserRequestHandler(deferred, args, get)
         self.userInfo.updateUsersProcesses(cbChanged)
     
+    def _handleCancel(self, deferred, args):
+        """
+        Handle cancel request. args is a list of requestIDs the server has
+        given up on (e.g. timed out), whose helper processes (thumbnailers,
+        x11vnc etc.) are stopped. Their responses are sent with 'error' set
+        to 'cancelled' for the users not done yet.
+        Returned data is the list of requestIDs still in progress.
+        """
+        cancelled = []
+        for reqid in args:
+            d = self._inflight.get(reqid)
+            if d is None:
+                continue
+            cancelled.append(reqid)
+            for helper in getattr(d, 'helpers', ()):
+                helper.cancel()
+        deferred.callback(cancelled)
+    
     def _handleThumbnails(self, deferred, args):
         """
         Handle thumbnails request.
+        Each thumbnail is returned with a 'token' identifying its contents.
+        If a user dict contains 'token' and the thumbnail hasn't changed,
+        'notmodified' is set instead of returning the thumbnail again.
         """
         def get(user, udata):
+            token = udata.pop('token', None)
             def cbSuccess(thumbnail):
-                from base64 import b64encode
-                udata['thumbnail'] = b64encode(thumbnail)
+                udata['token'] = hashlib.md5(thumbnail).hexdigest()
+                if udata['token'] == token:
+                    udata['notmodified'] = True
+                else:
+                    udata['thumbnail'] = wire.Binary(thumbnail)
                 return udata
             
             if user:
@@ -242,6 +331,8 @@ class AgentProtocol(basic.Int32StringReceiver):
         
         def get(user, udata):
             def errorHandler(failure):
+                if failure.check(defer.CancelledError):
+                    return failure # see _genericUserRequestHandler
                 log.msg('getVNC failed: %s' % failure)
                 udata['error'] = 'failed'
                 return udata
@@ -0,0 +1,90 @@
+from twisted.trial import unittest
+from sepiida.agent import misc
+import minimock
+
+class TestCached(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        def lookup(key):
+            self.calls.append(key)
+            if key < 0:
+                raise KeyError(key)
+            return key * 2
+        self.lookup = misc.cached(lookup, maxsize=2, ttl=600, negativeTTL=600)
+    
+    def test_cached(self):
+        self.assertEqual(self.lookup(1), 2)
+        self.assertEqual(self.lookup(1), 2)
+        self.assertEqual(self.calls, [1])
+    
+    def test_negative(self):
+        self.assertRaises(KeyError, self.lookup, -1)
+        self.assertRaises(KeyError, self.lookup, -1)
+        self.assertEqual(self.calls, [-1])
+    
+    def test_ttl(self):
+        self.lookup.ttl = -1
+        self.lookup(1)
+        self.lookup(1)
+        self.assertEqual(self.calls, [1, 1])
+    
+    def test_maxsize(self):
+        self.lookup(1)
+        self.lookup(2)
+        self.lookup(1) # 2 is now the least recently used
+        self.lookup(3)
+        self.assertEqual(self.lookup.cache.keys(), [(1,), (3,)])
+    
+    def test_deferred(self):
+        self.lookup(1)
+        d = self.lookup.deferred(1)
+        d.addCallback(self.assertEqual, 2)
+        def cbPrefetched(result):
+            self.assertEqual(self.lookup(5), 10)
+            self.assertEqual(sorted(self.calls), [-1, 1, 5])
+            self.assertRaises(KeyError, self.lookup, -1)
+            self.assertEqual(len(self.calls), 3)
+        d2 = misc.prefetch(self.lookup, [1, 5, -1])
+        d2.addCallback(cbPrefetched)
+        return d2
+
+class TestGroupIndex(unittest.TestCase):
+    def setUp(self):
+        import grp
+        # restored in tearDown
+        minimock.mock('grp.getgrall', tracker=None, returns=[
+            grp.struct_group(('group1', 'x', 1, ['user1', 'user2'])),
+            grp.struct_group(('group2', 'x', 2, ['user1']))])
+        self.index = misc.GroupIndex()
+    
+    def tearDown(self):
+        import minimock
+        minimock.restore()
+    
+    def test_get(self):
+        d = self.index.ready()
+        # built in a thread, nothing is known until it's done
+        self.assertEqual(self.index.get('user1'), [])
+        def cbReady(result):
+            self.assertEqual(self.index.get('user1'), ['group1', 'group2'])
+            self.assertEqual(self.index.get('user2'), ['group1'])
+            self.assertEqual(self.index.get('user3'), [])
+            return self.index.ready()
+        d.addCallback(cbReady)
+        return d
+    
+    def test_buildFailed(self):
+        import grp
+        import minimock
+        minimock.mock('grp.getgrall', tracker=None, raises=KeyError('nss'))
+        def cbReady(result):
+            self.assertEqual(len(self.flushLoggedErrors(KeyError)), 1)
+            # the build is retried
+            self.assertEqual(self.index.get('user1'), [])
+            return self.index.ready()
+        def cbRetried(result):
+            self.assertEqual(len(self.flushLoggedErrors(KeyError)), 1)
+        d = self.index.ready()
+        d.addCallback(cbReady)
+        d.addCallback(cbRetried)
+        return d
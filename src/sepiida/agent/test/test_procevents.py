@@ -0,0 +1,167 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from sepiida.agent import procevents, linuxuserinfo, config
+from sepiida.agent.procevents import NLMSGHDR, CNMSG, PROC_EVENT, PID_TGID
+import minimock
+
+config.reload()
+
+def event(what, pid, tgid=None, parent=1):
+    """
+    Return a netlink message containing a process event.
+    """
+    if tgid is None:
+        tgid = pid
+    if what == procevents.PROC_EVENT_FORK:
+        data = PID_TGID.pack(parent, parent) + PID_TGID.pack(pid, tgid)
+    else:
+        data = PID_TGID.pack(pid, tgid) + '\0' * 8 # e.g. the exit code
+    data = PROC_EVENT.pack(what, 0, 0) + data
+    cnmsg = CNMSG.pack(procevents.CN_IDX_PROC, procevents.CN_VAL_PROC, 0, 0, len(data), 0)
+    length = NLMSGHDR.size + len(cnmsg) + len(data)
+    msg = NLMSGHDR.pack(length, procevents.NLMSG_DONE, 0, 0, 0) + cnmsg + data
+    return msg + '\0' * (-len(msg) % 4)
+
+class TestProcessEventReader(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.reader = procevents.ProcessEventReader(
+            lambda what, pid: self.events.append((what, pid)), None)
+    
+    def test_parse(self):
+        self.reader._parse(event(procevents.PROC_EVENT_FORK, 100) +
+                           event(procevents.PROC_EVENT_EXEC, 100) +
+                           event(procevents.PROC_EVENT_UID, 100) +
+                           event(procevents.PROC_EVENT_EXIT, 100))
+        self.assertEqual(self.events, [(procevents.PROC_EVENT_FORK, 100),
+                                       (procevents.PROC_EVENT_EXEC, 100),
+                                       (procevents.PROC_EVENT_UID, 100),
+                                       (procevents.PROC_EVENT_EXIT, 100)])
+    
+    def test_threads(self):
+        # threads have a tgid different from their pid
+        self.reader._parse(event(procevents.PROC_EVENT_FORK, 101, 100) +
+                           event(procevents.PROC_EVENT_EXIT, 101, 100))
+        self.assertEqual(self.events, [])
+    
+    def test_unknown(self):
+        self.reader._parse(event(0x00000040, 100)) # PROC_EVENT_COMM
+        self.assertEqual(self.events, [])
+    
+    def test_truncated(self):
+        data = event(procevents.PROC_EVENT_EXEC, 100) + \
+               event(procevents.PROC_EVENT_EXEC, 200)
+        self.reader._parse(data[:len(data) - 20])
+        self.assertEqual(self.events, [(procevents.PROC_EVENT_EXEC, 100)])
+        # an invalid length
+        self.reader._parse(NLMSGHDR.pack(4, 0, 0, 0, 0) + data[NLMSGHDR.size:])
+        self.assertEqual(len(self.events), 1)
+
+class EventReader(object):
+    socket = True
+
+class TestProcessEvents(unittest.TestCase):
+    """
+    Test how UserInfo keeps its process table updated from process events.
+    """
+    def setUp(self):
+        self.clock = task.Clock()
+        minimock.mock('reactor', nsdicts=(linuxuserinfo.__dict__,), mock_obj=self.clock)
+        self.processes = {100: (1000, 0, '/bin/bash'),
+                          200: (1000, 0, '/usr/bin/ssh-agent -- x-session-manager')}
+        def readProcess(pid, bootTime):
+            try:
+                return self.processes[pid]
+            except KeyError:
+                raise IOError(2, 'No such file or directory')
+        minimock.mock('procfs.readProcess', nsdicts=(linuxuserinfo.__dict__,),
+                      mock_obj=readProcess)
+        minimock.mock('procfs.getBootTime', nsdicts=(linuxuserinfo.__dict__,),
+                      tracker=None, returns=0)
+        self.scans = []
+        def deferToThread(f):
+            d = defer.Deferred()
+            self.scans.append(d)
+            return d
+        minimock.mock('threads.deferToThread', nsdicts=(linuxuserinfo.__dict__,),
+                      mock_obj=deferToThread)
+        
+        self.loginEvents = []
+        ui = self.userInfo = linuxuserinfo.UserInfo()
+        ui._eventReader = EventReader()
+        ui._cbLoginEvent = lambda: self.loginEvents.append(True)
+    
+    def tearDown(self):
+        minimock.restore()
+    
+    def test_events(self):
+        ui = self.userInfo
+        ui._table = {}
+        ui._processEvent(procevents.PROC_EVENT_FORK, 100)
+        self.assertEqual(ui._table, {100: (1000, 0, '/bin/bash')})
+        self.assertTrue(ui._tableChanged)
+        ui._processEvent(procevents.PROC_EVENT_EXIT, 100)
+        self.assertEqual(ui._table, {})
+        # gone before it could be read
+        ui._processEvent(procevents.PROC_EVENT_EXEC, 300)
+        self.assertEqual(ui._table, {})
+        self.assertEqual(self.loginEvents, [])
+    
+    def test_loginEvents(self):
+        ui = self.userInfo
+        ui._table = {}
+        ui._loginPIDs = [200]
+        # forking and exec'ing, then exiting, is one login event
+        ui._processEvent(procevents.PROC_EVENT_FORK, 200)
+        ui._processEvent(procevents.PROC_EVENT_EXEC, 200)
+        ui._processEvent(procevents.PROC_EVENT_EXIT, 200)
+        self.assertEqual(self.loginEvents, [])
+        self.clock.advance(0.1)
+        self.assertEqual(self.loginEvents, [True])
+        ui._processEvent(procevents.PROC_EVENT_EXEC, 200)
+        self.clock.advance(0.1)
+        self.assertEqual(self.loginEvents, [True, True])
+    
+    def test_eventsDuringScan(self):
+        ui = self.userInfo
+        tables = []
+        ui._scanProcesses().addCallback(tables.append)
+        ui._processEvent(procevents.PROC_EVENT_EXEC, 100)
+        ui._processEvent(procevents.PROC_EVENT_EXIT, 300)
+        # joins the scan in progress
+        ui._scanProcesses().addCallback(tables.append)
+        self.assertEqual(len(self.scans), 1)
+        self.scans[0].callback({300: (1000, 0, 'exited')})
+        self.assertEqual(tables, [{100: (1000, 0, '/bin/bash')}] * 2)
+        self.assertEqual(ui._table, {100: (1000, 0, '/bin/bash')})
+        self.assertEqual(ui._eventPIDs, {})
+    
+    def test_eventsLostDuringScan(self):
+        ui = self.userInfo
+        ui._scanProcesses()
+        ui._processEvent(procevents.PROC_EVENT_EXEC, 100)
+        ui._processEventsLost()
+        self.assertEqual(self.loginEvents, [True])
+        # the scan started before the events were lost can't be used
+        self.scans[0].callback({})
+        self.assertEqual(ui._table, None)
+        ui._processEvent(procevents.PROC_EVENT_EXEC, 200)
+        ui._scanProcesses()
+        self.assertEqual(len(self.scans), 2)
+        self.scans[1].callback({100: (1000, 0, '/bin/bash')})
+        self.assertEqual(sorted(ui._table), [100, 200])
+    
+    def test_scanFailed(self):
+        ui = self.userInfo
+        d1 = ui._scanProcesses()
+        d2 = ui._scanProcesses()
+        self.scans[0].errback(OSError(24, 'Too many open files'))
+        self.assertEqual(ui._scanDeferred, None)
+        self.assertFailure(d1, OSError)
+        self.assertFailure(d2, OSError)
+        # tried again
+        tables = []
+        ui._scanProcesses().addCallback(tables.append)
+        self.scans[1].callback({})
+        self.assertEqual(tables, [{}])
+        return defer.gatherResults([d1, d2])
@@ -0,0 +1,27 @@
+from twisted.trial import unittest
+from sepiida.agent import procfs
+import os
+import sys
+import time
+
+class TestProcfs(unittest.TestCase):
+    def test_getBootTime(self):
+        bootTime = procfs.getBootTime()
+        self.assertIsInstance(bootTime, int)
+        self.assert_(0 < bootTime <= time.time())
+
+    def test_readProcess(self):
+        uid, starttime, commandline = procfs.readProcess(os.getpid(), procfs.getBootTime())
+        self.assertEqual(uid, os.geteuid())
+        self.assert_(starttime <= time.time() + 1)
+        self.assertIn(os.path.basename(sys.executable), commandline)
+        self.assertNotIn('\x00', commandline)
+
+    def test_readProcess_exited(self):
+        self.assertRaises(IOError, procfs.readProcess, -123, 0)
+
+    def test_scanProcesses(self):
+        processes = procfs.scanProcesses()
+        self.assertIn(os.getpid(), processes)
+        self.assertIn(1, processes)
+        self.assertEqual(processes[os.getpid()][0], os.geteuid())
@@ -1,5 +1,6 @@
 from twisted.trial import unittest
 from sepiida.agent import protocol
+from sepiida import wire
 from twisted.internet import reactor, defer
 from twisted.python import log
 
@@ -111,7 +112,8 @@ class TestAgentProtocol(unittest.TestCase):
     
     _testRequests = [('processes', 'processes', [(0, 'testprocess')], None),
                      ('killProcesses', None, None, [{'username': 'testuser', 'client': '', 'display': ':10', 'pid': 0}]),
-                     ('thumbnails', 'thumbnail', '', None),
+                     ('thumbnails', 'thumbnail', wire.Binary(''), None),
+                     ('thumbnails', 'notmodified', True, [{'username': 'testuser', 'client': '', 'display': ':10', 'token': 'd41d8cd98f00b204e9800998ecf8427e'}]),
                      ('vnc', 'port', 0, None),
                      ('login', 'port', 0, []),
                      ('message', None, None, [{'username': 'testuser', 'client': '', 'display': ':10', 'message': 'test'}]),
@@ -186,3 +188,117 @@ class TestAgentProtocol(unittest.TestCase):
             reactor.callLater(0.1, check)
         reactor.callWhenRunning(test)
         return d
+    
+    def test_cancel(self):
+        getVNC = defer.Deferred()
+        self.ap.userInfo.getVNC = lambda user: getVNC
+        req = {'request': 'vnc',
+               'args': [{'username': 'testuser', 'client': '', 'display': ':10'}],
+               'requestID': 1}
+        d = defer.Deferred()
+        def test():
+            self.ap.requestReceived(json.dumps(req))
+            self.assertIn(1, self.ap._inflight)
+            self.ap.transport.written = ''
+            self.ap.requestReceived(json.dumps(
+                {'request': 'cancel', 'args': [1, 2], 'requestID': 3}))
+            self.assertTrue(getVNC.called)
+            self.assertEqual(self.ap._inflight, {})
+            self.assertIn('"error": "cancelled"', self.ap.transport.written)
+            self.assertIn('"data": [1]', self.ap.transport.written)
+        reactor.callWhenRunning(lambda: d.callback(None))
+        d.addCallback(lambda ignore: test())
+        return d
+
+    def test_requestFailed(self):
+        def failing(deferred, args):
+            raise RuntimeError('handler failed')
+        self.ap._handleLogout = failing
+        self.ap._handleLock = lambda deferred, args: None
+        d = defer.Deferred()
+        def test():
+            self.ap.transport.written = ''
+            self.ap.requestReceived(json.dumps(
+                {'request': 'logout', 'args': [], 'requestID': 1}))
+            self.assertEqual(self.ap._inflight, {})
+            self.assertIn('"error": "failed"', self.ap.transport.written)
+            self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+            
+            # errbacks from the handler
+            self.ap.transport.written = ''
+            self.ap.requestReceived(json.dumps(
+                {'request': 'lock', 'args': [], 'requestID': 2}))
+            self.ap._inflight[2].errback(RuntimeError('lock failed'))
+            self.assertEqual(self.ap._inflight, {})
+            self.assertIn('"error": "failed"', self.ap.transport.written)
+            self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+            
+            # cancelled requests are only forgotten
+            self.ap.transport.written = ''
+            self.ap.requestReceived(json.dumps(
+                {'request': 'lock', 'args': [], 'requestID': 3}))
+            self.ap._inflight[3].errback(defer.CancelledError())
+            self.assertEqual(self.ap._inflight, {})
+            self.assertEqual(self.ap.transport.written, '')
+        reactor.callWhenRunning(lambda: d.callback(None))
+        d.addCallback(lambda ignore: test())
+        return d
+
+class TestProcessTable(unittest.TestCase):
+    def setUp(self):
+        from sepiida.agent.proctable import ProcessTable
+        self.table = ProcessTable()
+        self.table.update({'user1': [(1, 'a'), (2, 'b')]})
+    
+    def test_full(self):
+        result = self.table.get('user1')
+        self.assertEqual(result['processes'], [(1, 'a'), (2, 'b')])
+        self.assertEqual(self.table.get('user1', 'invalid').keys().count('processes'), 1)
+        self.assertEqual(self.table.get('nonexisting')['processes'], [])
+    
+    def test_delta(self):
+        version = self.table.get('user1')['version']
+        self.table.update({'user1': [(2, 'c'), (3, 'd')]})
+        result = self.table.get('user1', version)
+        self.assertEqual(result['added'], [(2, 'c'), (3, 'd')])
+        self.assertEqual(result['removed'], [1])
+        self.assertNotIn('processes', result)
+        
+        # nothing changed since the last version
+        result = self.table.get('user1', result['version'])
+        self.assertEqual((result['added'], result['removed']), ([], []))
+        
+        # user logged out
+        self.table.update({})
+        result2 = self.table.get('user1', result['version'])
+        self.assertEqual(sorted(result2['removed']), [2, 3])
+    
+    def test_delta_expired(self):
+        version = self.table.get('user1')['version']
+        self.table.MAX_REMOVED = 1
+        self.table.update({'user1': []})
+        self.assertIn('processes', self.table.get('user1', version))
+        
+        # version from a previous agent
+        other = self.table.__class__()
+        other.update({'user1': [(1, 'a')]})
+        self.assertIn('processes', other.get('user1', version))
+    
+    def test_gone(self):
+        self.table.MAX_GONE = 1
+        version = self.table.get('user1')['version']
+        self.table.update({'user2': [(3, 'c')]}) # user1 logs out
+        self.assertEqual(self.table.get('user1', version)['removed'], [1, 2])
+        
+        # user1 logs in again, so isn't forgotten when user2 logs out
+        self.table.update({'user1': [(4, 'd')]})
+        self.table.update({'user1': [(4, 'd')], 'user3': [(5, 'e')]})
+        self.assertEqual(sorted(self.table._removed), ['user1', 'user2'])
+        self.table.update({'user1': [(4, 'd')]})
+        self.assertEqual(sorted(self.table._removed), ['user1', 'user3'])
+        self.assertEqual(sorted(self.table._horizon), ['user1', 'user3'])
+        
+        # deltas for forgotten users can't be made from before then
+        self.assertIn('processes', self.table.get('user2', version))
+        current = self.table.get('user2')['version']
+        self.assertEqual(self.table.get('user2', current)['removed'], [])
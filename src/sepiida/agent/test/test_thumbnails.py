@@ -0,0 +1,91 @@
+from twisted.trial import unittest
+from twisted.internet import defer
+from sepiida.agent import thumbnails
+import struct
+
+class TestFrameCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = thumbnails.FrameCache(60)
+        self.captures = []
+    
+    def capture(self):
+        d = defer.Deferred()
+        self.captures.append(d)
+        return d
+    
+    def test_shared(self):
+        """
+        Concurrent requests for the same key should share one capture,
+        and later requests should be served from the cache.
+        """
+        results = []
+        self.cache.get(':0', self.capture).addCallback(results.append)
+        self.cache.get(':0', self.capture).addCallback(results.append)
+        self.cache.get(':1', self.capture)
+        self.assertEqual(len(self.captures), 2)
+        self.captures[0].callback('frame')
+        self.assertEqual(results, ['frame', 'frame'])
+        self.cache.get(':0', self.capture).addCallback(results.append)
+        self.assertEqual(len(self.captures), 2)
+        self.assertEqual(results, ['frame'] * 3)
+    
+    def test_maxAge(self):
+        self.cache.maxAge = -1
+        self.cache.get(':0', self.capture)
+        self.captures[0].callback('frame')
+        self.cache.get(':0', self.capture)
+        self.assertEqual(len(self.captures), 2)
+    
+    def test_failure(self):
+        d = self.cache.get(':0', self.capture)
+        self.captures[0].errback(thumbnails.CaptureError())
+        self.assertFailure(d, thumbnails.CaptureError)
+        self.cache.get(':0', self.capture)
+        self.assertEqual(len(self.captures), 2)
+        return d
+    
+    def test_cancel(self):
+        """
+        The capture should only be cancelled when nobody waits for it.
+        """
+        d1 = self.cache.get(':0', self.capture)
+        d2 = self.cache.get(':0', self.capture)
+        d1.cancel()
+        self.assertFalse(self.captures[0].called)
+        d2.cancel()
+        self.assertTrue(self.captures[0].called)
+        self.assertFailure(d1, defer.CancelledError)
+        return self.assertFailure(d2, defer.CancelledError)
+
+class Transport(object):
+    def __init__(self):
+        self.written = ''
+        self.signals = []
+    def write(self, s):
+        self.written += s
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+    def closeStdin(self):
+        pass
+
+class TestThumbnailWorker(unittest.TestCase):
+    def setUp(self):
+        self.exited = []
+        self.worker = thumbnails.ThumbnailWorker(self.exited.append)
+        self.worker.transport = Transport()
+        self.worker.connectionMade()
+    
+    def tearDown(self):
+        self.worker.processEnded(None)
+    
+    def test_capture(self):
+        results = []
+        self.worker.capture(320, 240, 50).addCallback(results.append)
+        d = self.worker.capture(320, 240, 50)
+        self.assertEqual(self.worker.transport.written, '320 240 50\n' * 2)
+        frame = struct.pack('!I', 4) + 'JFIF'
+        self.worker.outReceived(frame + frame[:3])
+        self.assertEqual(results, ['JFIF'])
+        self.worker.outReceived(struct.pack('!I', 0)[3:] + struct.pack('!I', 0))
+        self.assertEqual(len(self.worker.pending), 0)
+        return self.assertFailure(d, thumbnails.CaptureError)
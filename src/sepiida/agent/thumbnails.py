@@ -0,0 +1,180 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import reactor, protocol, defer
+from twisted.python import log
+import struct
+import time
+
+class CaptureError(Exception):
+    pass
+
+class FrameCache(object):
+    """
+    Cache of captured frames, e.g. thumbnails keyed by display.
+    Frames younger than maxAge seconds are returned from the cache, and
+    concurrent requests for the same key share one capture.
+    """
+    def __init__(self, maxAge):
+        self.maxAge = maxAge
+        self._frames = {} # {key: (time captured, frame)}
+        self._waiting = {} # {key: [deferred]}
+        self._captures = {} # {key: deferred of capture in progress}
+
+    def get(self, key, capture):
+        """
+        Return a deferred which is called back with the frame for key.
+        capture is called without arguments if a new frame is needed, and
+        should return a frame or a deferred.
+        """
+        entry = self._frames.get(key)
+        if entry and time.time() - entry[0] <= self.maxAge:
+            return defer.succeed(entry[1])
+
+        def cancel(d):
+            # stop the capture if nobody else is waiting for it
+            waiting = self._waiting.get(key, [])
+            if d in waiting:
+                waiting.remove(d)
+                if not waiting:
+                    self._captures[key].cancel()
+
+        d = defer.Deferred(cancel)
+        if key in self._waiting:
+            self._waiting[key].append(d)
+            return d
+        self._waiting[key] = [d]
+
+        started = time.time()
+        dc = self._captures[key] = defer.maybeDeferred(capture)
+        dc.addCallback(self._store, key, started)
+        dc.addBoth(self._done, key)
+        return d
+
+    def _store(self, frame, key, started):
+        self.expire()
+        self._frames[key] = (started, frame)
+        return frame
+
+    def _done(self, result, key):
+        del self._captures[key]
+        for d in self._waiting.pop(key):
+            d.callback(result)
+
+    def expire(self):
+        """
+        Forget frames older than maxAge.
+        """
+        now = time.time()
+        for key, (captured, frame) in self._frames.items():
+            if now - captured > self.maxAge:
+                del self._frames[key]
+
+    def forget(self, key):
+        self._frames.pop(key, None)
+
+class ThumbnailWorker(protocol.ProcessProtocol):
+    """
+    Protocol for a long-lived sepiida-thumbnailer process capturing
+    thumbnails of one display.
+    Requests are written as "width height quality" lines, and each thumbnail
+    is read back as a JPEG prefixed by its length (32-bit, big-endian).
+    The process is stopped when it's been idle for idleTimeout seconds,
+    or if a capture takes more than captureTimeout seconds.
+    onExit is called with the worker when the process has ended.
+    """
+    prefix = struct.Struct('!I')
+
+    def __init__(self, onExit, idleTimeout=60.0, captureTimeout=10.0):
+        self.onExit = onExit
+        self.idleTimeout = idleTimeout
+        self.captureTimeout = captureTimeout
+        self.buffer = ''
+        self.pending = [] # deferreds waiting for a thumbnail, in order
+        self.ended = False
+        self._timeoutCall = None
+
+    def connectionMade(self):
+        self._resetTimeout()
+
+    def capture(self, width, height, quality):
+        """
+        Return a deferred which is called back with a JPEG thumbnail.
+        """
+        if self.ended:
+            return defer.fail(CaptureError('thumbnailer has exited'))
+        def cancel(d):
+            # the thumbnails are read in order, so stop the process
+            self.pending.remove(d)
+            self.stop()
+        d = defer.Deferred(cancel)
+        self.pending.append(d)
+        self.transport.write('%d %d %d\n' % (width, height, quality))
+        self._resetTimeout()
+        return d
+
+    def stop(self):
+        if not self.ended:
+            self.transport.signalProcess('KILL')
+
+    def _resetTimeout(self):
+        if self._timeoutCall and self._timeoutCall.active():
+            self._timeoutCall.cancel()
+        if self.pending:
+            timeout = self.captureTimeout
+        else:
+            timeout = self.idleTimeout
+        self._timeoutCall = reactor.callLater(timeout, self._timedOut)
+
+    def _timedOut(self):
+        self._timeoutCall = None
+        if self.pending:
+            log.msg('thumbnailer timed out, stopping it')
+            self.stop()
+        else: # idle
+            self.transport.closeStdin()
+
+    def outReceived(self, data):
+        self.buffer += data
+        size = self.prefix.size
+        while len(self.buffer) >= size:
+            length = self.prefix.unpack(self.buffer[:size])[0]
+            if len(self.buffer) < size + length:
+                break
+            frame = self.buffer[size:size+length]
+            self.buffer = self.buffer[size+length:]
+            if not self.pending:
+                log.msg('thumbnailer sent unexpected data')
+                continue
+            d = self.pending.pop(0)
+            if frame:
+                d.callback(frame)
+            else:
+                d.errback(CaptureError('thumbnailer failed to capture'))
+        self._resetTimeout()
+
+    def errReceived(self, data):
+        log.msg('thumbnailer: %s' % data.rstrip())
+
+    def processEnded(self, status):
+        self.ended = True
+        if self._timeoutCall and self._timeoutCall.active():
+            self._timeoutCall.cancel()
+        pending, self.pending = self.pending, []
+        for d in pending:
+            d.errback(CaptureError('thumbnailer exited: %s' % status.value))
+        self.onExit(self)
@@ -61,6 +61,9 @@ class UserInfo(object):
         import sys
         return sys.platform
     
+    def watchProcesses(self, cbLoginEvent):
+        raise NotImplementedError
+    
     @defer.deferredGenerator
     def updateUsersProcesses(self, cbChanged):
         """
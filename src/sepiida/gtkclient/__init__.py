@@ -18,7 +18,6 @@
 
 import gtk
 import gobject
-import base64
 import re
 import cStringIO
 import locale
@@ -29,10 +28,7 @@ import subprocess
 import os
 import sys
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
+from sepiida import wire
 
 t = gettext.translation('sepiida-gtk', '/usr/share/locale', fallback=True)
 t.install()
@@ -47,6 +43,12 @@ class Server:
         self._requests = {}
         self._reqID = 0
         self.connected = False
+        self.codec = wire.Codec()
+        self.features = ()
+        # versions of the last listUsers/listServers responses, see refresh
+        self.usersVersion = self.serversVersion = None
+        self.uptimes = {} # {server/workstation: uptime from listServers}
+        self.subscribed = False # changes are pushed, see refresh
     
     def _readResponse(self, source, condition):
         prefix = self._process.stdout.read(4) # int32 prefix
@@ -67,12 +69,15 @@ class Server:
             print 'read: %d' % len(msg)
             print >>sys.stderr, 'got data: %s' % msg
         try:
-            data = json.loads(msg)
+            data = self.codec.decode(msg)
             rid = data['requestID']
             err = data.get('error', '')
             gobject.idle_add(self._requests[rid], self, data['data'], err,
                              priority=gobject.PRIORITY_HIGH)
-            del self._requests[rid]
+            # negative requestIDs are pushed changes, partial responses
+            # are followed by more, see sendRequest
+            if rid >= 0 and not data.get('partial', False):
+                del self._requests[rid]
         except (ValueError, KeyError):
             print >>sys.stderr, 'got invalid data: %s' % msg
         return True
@@ -90,6 +95,12 @@ class Server:
     def connect(self, callback, errback):
         self._reqID = 0
         self.connected = False
+        self.codec = wire.Codec()
+        self.features = ()
+        self.usersVersion = self.serversVersion = None
+        self.uptimes = {}
+        self.subscribed = False
+        self._requests = {}
         self.errback = errback
         
         cmd = ['ssh', '-o', 'ConnectTimeout=6', self.hostname, 'sepiida-connect']
@@ -111,24 +122,31 @@ class Server:
                     gobject.source_remove(sid)
             else:
                 self.connected = True
+                if isinstance(data, dict) and 'features' in data:
+                    self.features = data['features']
+                    self.codec.setPeerFeatures(data['features'])
+                    self.sendRequest('features', list(wire.FEATURES),
+                                     lambda server, data, error='': None)
                 gobject.idle_add(callback, self)
         
         self._requests[self._reqID] = cbHello
     
-    def sendRequest(self, request, args, callback):
+    def sendRequest(self, request, args, callback, since=None, stream=False):
         """
         Send request to server.
         Args:
          * request - the request to send to the server
          * args - the arguments, usually a list of ukey dicts
          * callback - a function to call when a response is received
+         * since - version of a previous listUsers/listServers response,
+           to get only the changes since then
+         * stream - if the server supports it, callback is called with the
+           results from each server/workstation as they arrive, and then
+           with the rest of the results
         """
         self._reqID += 1
-        req = json.dumps(
-                     {'request': request,
-                      'args': args
-                      }
-                     )
+        req = self.codec.encode(self._request(request, args, since,
+                                              stream and 'stream' in self.features))
         prefix = struct.pack('!I', len(req))
         if debug:
             print >>sys.stderr, 'sendRequest: sending %s' % req
@@ -137,6 +155,45 @@ class Server:
         
         self._requests[self._reqID] = callback
     
+    def _request(self, request, args, since, stream=False):
+        req = {'request': request, 'args': args}
+        if since is not None:
+            req['since'] = since
+        if stream:
+            req['stream'] = True
+        return req
+    
+    def setPushCallback(self, requestID, callback):
+        """
+        Call callback, as for sendRequest, for each response the server
+        pushes with requestID (negative), e.g. after a subscribe request.
+        """
+        self._requests[requestID] = callback
+    
+    def sendBatch(self, requests):
+        """
+        Send several requests to server in one batch request, if supported.
+        Args:
+         * requests - a list of (request, args, callback, since) as for
+           sendRequest
+        """
+        if 'batch' not in self.features:
+            for request, args, callback, since in requests:
+                self.sendRequest(request, args, callback, since)
+            return
+        
+        def cbBatch(server, data, error=''):
+            if error: # the server doesn't know batch, shouldn't happen
+                for request, args, callback, since in requests:
+                    callback(server, [], error)
+                return
+            for (request, args, callback, since), result in zip(requests, data):
+                callback(server, result['data'], result['error'])
+        
+        self.sendRequest('batch', [self._request(request, args, since)
+                                   for request, args, callback, since in requests],
+                         cbBatch)
+    
     def openLocalForward(self, localPort, remotePort):
         """
         Open local forwarding. ssh -L is not used because it requires opening
@@ -470,78 +527,111 @@ class GtkClient:
             self.real_liststore.set(user.iter, 8, bgcolor)        
         
     def refresh(self, server):
-        total_users = 0
-        total_filtered = 0
-            
+        """
+        Update the users and machines of server. If the server supports it,
+        only the changes since the previous refresh are fetched, and after
+        the first refresh changes are pushed by the server instead.
+        """
+        def updateUser(server, udict, localtime):
+            username = udict['username']
+            userver = udict['server']
+            client = udict['client']
+            display = udict['display']
+            name = udict['name']
+            groups = udict['groups']
+            ltime = udict['time']
+            location = udict.get('location', '')
+
+            ukey_t = (server, username, userver, client, display)
+            try:
+                user = self.users[ukey_t]
+            except KeyError:
+                user = User(server, username, userver, client, display)
+                t = time.localtime(ltime)
+                if localtime[:3] != t[:3]:
+                    user.ltime = time.strftime('%b %d %H:%M', t)
+                else:
+                    user.ltime = time.strftime('%H:%M', t)
+                user.iter = self.real_liststore.append((username, client, '', name, userver, user.ltime, display, server.name, None, user))
+                self.users[ukey_t] = user
+                self.highlight_duplicate(user.username)
+            user.lastupdate = int(time.time())
+            user.name = name
+            user.groups = groups
+            user.location = location
+            for val, col in ((user.name, 3), (user.location, 2)):
+                if val != self.real_liststore.get(user.iter, col):
+                    self.real_liststore.set(user.iter, col, val)
+        
+        def removeUser(ukey_t):
+            user = self.users.pop(ukey_t, None)
+            if user is not None:
+                self.real_liststore.remove(user.iter)
+                self.highlight_duplicate(user.username)
+        
         def cbUsers(server, data, error=''):
             # NOTE: server.name != userver
             # server is the Sepiida server, userver is the server/workstation the user is working on
-            server.lastupdate = int(time.time())
             localtime = time.localtime()
+            if isinstance(data, dict): # response to since
+                server.usersVersion = data['version']
+                if 'users' not in data: # only the changes
+                    for udict in data['added']:
+                        updateUser(server, udict, localtime)
+                    for d in data['removed']:
+                        removeUser((server, d['username'], d['server'],
+                                    d['client'], d['display']))
+                    gobject.idle_add(self.update_statusbar)
+                    return
+                data = data['users']
+            
+            server.lastupdate = int(time.time())
             for udict in data:
-                username = udict['username']
-                userver = udict['server']
-                client = udict['client']
-                display = udict['display']
-                name = udict['name']
-                groups = udict['groups']
-                ltime = udict['time']
-                location = udict.get('location', '')
-
-                ukey_t = (server, username, userver, client, display)
-                try:
-                    user = self.users[ukey_t]
-                except KeyError:
-                    user = User(server, username, userver, client, display)
-                    t = time.localtime(ltime)
-                    if localtime[:3] != t[:3]:
-                        user.ltime = time.strftime('%b %d %H:%M', t)
-                    else:
-                        user.ltime = time.strftime('%H:%M', t)
-                    user.iter = self.real_liststore.append((username, client, '', name, userver, user.ltime, display, server.name, None, user))
-                    self.users[ukey_t] = user
-                    self.highlight_duplicate(user.username)
-                user.lastupdate = int(time.time())
-                user.name = name
-                user.groups = groups
-                user.location = location
-                for val, col in ((user.name, 3), (user.location, 2)):
-                    if val != self.real_liststore.get(user.iter, col):
-                        self.real_liststore.set(user.iter, col, val)
+                updateUser(server, udict, localtime)
             
             for ukey_t, user in self.users.items():
                 if user.server is server:
                     if user.lastupdate < server.lastupdate:
                         # user logged out
-                        self.real_liststore.remove(user.iter)
-                        del self.users[ukey_t]
-                        self.highlight_duplicate(user.username)
+                        removeUser(ukey_t)
             
             gobject.idle_add(self.update_statusbar)
         
+        def formatUptime(uptime):
+            # in 0.5, "uptime" is the boot time in unix time
+            if uptime > 1262277000: # 40 years
+                uptime = time.time() - uptime
+            days, r = divmod(uptime, 86400)
+            hours, r = divmod(r, 3600)
+            minutes, r = divmod(r, 60)
+            
+            # 1d 10h 24m
+            return _('%(days)dd %(hours)dh %(minutes)dm') % locals()
+        
         def cbServers(server, data, error=''):
             ls = self.machines_liststore
             # {userver: treeiter}
             map = dict([(ls[i][1], ls.get_iter(i)) for i in xrange(len(ls)) if ls[i][0] == server.hostname])
             
+            if isinstance(data, dict): # response to since
+                server.serversVersion = data['version']
+                if 'servers' in data:
+                    data = data['servers']
+                    offline = set(map.iterkeys()) - set((d['server'] for d in data))
+                else: # only the changes
+                    offline = set([d['server'] for d in data['removed']])
+                    data = data['added']
+            else:
+                offline = set(map.iterkeys()) - set((d['server'] for d in data))
+            
             for d in data:
                 userver = d['server']
                 nusers = d['users']
                 load = '%1.2f' % d['load']
                 platform = d.get('os', '')
                 location = d.get('location', '')
+                server.uptimes[userver] = d['uptime']
                 
-                # in 0.5, "uptime" is the boot time in unix time
-                if d['uptime'] > 1262277000: # 40 years
-                    uptime = time.time() - d['uptime']
-                else:
-                    uptime = d['uptime']
-                days, r = divmod(uptime, 86400)
-                hours, r = divmod(r, 3600)
-                minutes, r = divmod(r, 60)
-                
-                # 1d 10h 24m
-                uptime = _('%(days)dd %(hours)dh %(minutes)dm') % locals()
                 # Columns:
                 # Sepiida server, user server/ws, N users, Load, Uptime, OS, Location
                 try:
@@ -551,17 +641,44 @@ class GtkClient:
                     map[userver] = it
                 ls.set(it, 2, str(nusers))
                 ls.set(it, 3, load)
-                ls.set(it, 4, uptime)
                 ls.set(it, 5, platform)
                 ls.set(it, 6, location)
             
-            offline = set(map.iterkeys()) - set((d['server'] for d in data))
             for userver in offline:
-                it = map[userver]
-                ls.remove(it)
+                server.uptimes.pop(userver, None)
+                it = map.pop(userver, None)
+                if it is not None:
+                    ls.remove(it)
             
-        server.sendRequest('listUsers', [], cbUsers)
-        server.sendRequest('listServers', [], cbServers)
+            updateUptimes(server)
+        
+        def updateUptimes(server):
+            # unchanged machines aren't sent again, so update all uptimes
+            ls = self.machines_liststore
+            for i in xrange(len(ls)):
+                userver = ls[i][1]
+                if ls[i][0] == server.hostname and userver in server.uptimes:
+                    ls.set(ls.get_iter(i), 4, formatUptime(server.uptimes[userver]))
+        
+        if server.subscribed:
+            updateUptimes(server)
+            return True
+        
+        if 'since' in server.features:
+            usersSince = server.usersVersion or ''
+            serversSince = server.serversVersion or ''
+        else:
+            usersSince = serversSince = None
+        requests = [('listUsers', [], cbUsers, usersSince),
+                    ('listServers', [], cbServers, serversSince)]
+        if 'subscribe' in server.features:
+            # pushed as responses to listUsers and listServers with since
+            server.setPushCallback(-1, cbUsers)
+            server.setPushCallback(-2, cbServers)
+            server.subscribed = True
+            requests.append(('subscribe', ['users', 'servers'],
+                             lambda server, data, error='': None, None))
+        server.sendBatch(requests)
         return True
 
     def delete_event(self, widget, event, data=None):
@@ -772,7 +889,7 @@ class GtkClient:
             def cbThumb(server, data, error=''):
                 pbl = gtk.gdk.PixbufLoader()
                 try:
-                    pbl.write(base64.b64decode(data[0].get('thumbnail', '')))
+                    pbl.write(wire.binaryData(data[0].get('thumbnail', '')))
                     pbl.close()
                 except (TypeError, gobject.GError):
                     label.set_text(_('Got invalid image data'))
@@ -928,30 +1045,56 @@ class GtkClient:
                 row += 1
                 col = 0
         
+        tokens = {} # {user: token of the thumbnail shown}
         def updateImages(server, data, error=''):
             for ukey_d in data:
                 ukey_t = (server, ukey_d['username'], ukey_d['server'],
                           ukey_d['client'], ukey_d['display'])
                 try:
-                    im = images[self.users[ukey_t]]
+                    user = self.users[ukey_t]
+                    im = images[user]
                 except KeyError: # user logged out
                     continue
+                if ukey_d.get('notmodified', False):
+                    continue
+                tokens[user] = ukey_d.get('token')
                 pbl = gtk.gdk.PixbufLoader()
                 try:
-                    pbl.write(base64.b64decode(ukey_d.get('thumbnail', '')))
+                    pbl.write(wire.binaryData(ukey_d.get('thumbnail', '')))
                     pbl.close()
                     im.set_from_pixbuf(pbl.get_pixbuf())
-                except gobject.GError:
+                except (TypeError, gobject.GError):
                     continue
             updated.set_text(time.strftime(_('Last updated: %H:%M:%S')))
             
         def refresh():
-            for im in images.itervalues():
-                im.set_from_pixbuf(None)
-                
             for server, ukeys in selected.iteritems():
+                args = []
                 for ukey in ukeys:
-                    server.sendRequest('getThumbnails', [ukey], updateImages)
+                    ukey_t = (server, ukey['username'], ukey['server'],
+                              ukey['client'], ukey['display'])
+                    arg = ukey.copy()
+                    user = self.users.get(ukey_t)
+                    if tokens.get(user):
+                        # only send the thumbnail if it has changed
+                        arg['token'] = tokens[user]
+                    args.append(arg)
+                if 'stream' in server.features:
+                    # users on workstations in one request, their thumbnails
+                    # are shown as each workstation sends them. The agent
+                    # answers for all the users on a host at once, so users
+                    # on the same (e.g. LTSP) server are asked for one by
+                    # one, so that one slow display doesn't hold up the rest
+                    hosts = {}
+                    for arg in args:
+                        hosts[arg['server']] = hosts.get(arg['server'], 0) + 1
+                    single = [arg for arg in args if hosts[arg['server']] == 1]
+                    args = [arg for arg in args if hosts[arg['server']] > 1]
+                    if single:
+                        server.sendRequest('getThumbnails', single, updateImages,
+                                           stream=True)
+                for arg in args:
+                    server.sendRequest('getThumbnails', [arg], updateImages)
 
         def close(dialog, data=None):
             dialog.destroy()
@@ -1000,25 +1143,65 @@ class GtkClient:
         def close(dialog, data=None):
             dialog.destroy()
         
+        # Process list versions and rows per user, so that only the
+        # processes started and ended since the last refresh are sent
+        # {(server name, userver, username, client, display): version}
+        versions = {}
+        # {(server name, userver, username, client, display): {pid: treeiter}}
+        rows = {}
+        
         def cbHandleResponse(server, data, error=''):
             #print server, data
             for ukey_d in data:
-                if not ukey_d.get('processes', ''):
-                    # TODO: this probably means that the user is offline
-                    continue
                 username = ukey_d['username']
                 client = ukey_d['client']
                 userver = ukey_d['server']
                 display = ukey_d['display']
+                key = (server.name, userver, username, client, display)
+                if ukey_d.get('error', ''):
+                    # probably logged out or not answering, don't keep
+                    # showing the old processes
+                    for it in rows.pop(key, {}).itervalues():
+                        proc_liststore.remove(it)
+                    versions.pop(key, None)
+                    continue
+                userrows = rows.setdefault(key, {})
+                
+                if 'processes' in ukey_d: # full list
+                    for it in userrows.itervalues():
+                        proc_liststore.remove(it)
+                    userrows.clear()
+                    added = ukey_d['processes']
+                    removed = []
+                else:
+                    added = ukey_d.get('added', [])
+                    removed = ukey_d.get('removed', [])
+                
+                for pid in removed:
+                    it = userrows.pop(pid, None)
+                    if it:
+                        proc_liststore.remove(it)
+                for pid, commandline in added:
+                    it = userrows.get(pid)
+                    if it:
+                        proc_liststore.set(it, 3, commandline)
+                    else:
+                        userrows[pid] = proc_liststore.append((username, client, pid, commandline, userver, display, server.name))
                 
-                for pid, commandline in ukey_d['processes']:
-                    proc_liststore.append((username, client, pid, commandline, userver, display, server.name))
+                if 'version' in ukey_d:
+                    versions[key] = ukey_d['version']
         
         def refresh():
-            proc_liststore.clear()
             for server, userlist in selected.iteritems():
                 # userlist is already a list of ukeys, which is what the server expects
-                args = userlist
+                args = []
+                for ukey_d in userlist:
+                    arg = ukey_d.copy()
+                    key = (server.name, ukey_d['server'], ukey_d['username'],
+                           ukey_d['client'], ukey_d['display'])
+                    if key in versions:
+                        arg['since'] = versions[key]
+                    args.append(arg)
                 server.sendRequest('listProcesses', args, cbHandleResponse)
 
         def kill_processes(widget=None, event=None):
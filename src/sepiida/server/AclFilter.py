@@ -16,9 +16,32 @@
 # along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
 
 import grp
+import time
 from pyparsing import Word, CaselessKeyword, Combine, Group, OneOrMore, \
     Literal, stringEnd, Suppress, ParseBaseException, alphanums, NoMatch
 
+GROUP_TTL = 60 # seconds to remember the members of a group
+
+_groupCache = {} # {group: (time, frozenset of members)}
+
+def groupMembers(group):
+    """
+    Return the members of group, as a frozenset. Raises KeyError if the
+    group doesn't exist.
+    Results are remembered for GROUP_TTL seconds, since getgrnam may have
+    to ask a directory server.
+    """
+    now = time.time()
+    try:
+        fetched, members = _groupCache[group]
+        if now - fetched < GROUP_TTL:
+            return members
+    except KeyError:
+        pass
+    members = frozenset(grp.getgrnam(group).gr_mem)
+    _groupCache[group] = (now, members)
+    return members
+
 class ACL(object):
     """
     ACL/filter class.
@@ -28,6 +51,19 @@ class ACL(object):
         self._who = []
         self._filter = []
         self._allowedRequests = []
+        self._compile()
+    
+    def _compile(self):
+        """
+        Turn the parsed ACL into sets, for the checks in requestAllowed.
+        """
+        self._whoUsers = frozenset(w for w in self._who if not w.startswith('@'))
+        self._whoGroups = tuple(w[1:] for w in self._who if w.startswith('@'))
+        self._filterAll = 'ALL' in self._filter
+        self._sameLocation = 'sameLocation' in self._filter
+        self._filterGroups = frozenset(f[1:] for f in self._filter if f.startswith('@'))
+        self._allRequests = 'ALL' in self._allowedRequests
+        self._requests = frozenset(self._allowedRequests)
         
     def parse(self, key, value):
         """
@@ -73,19 +109,35 @@ class ACL(object):
         self._who = r1.who.asList()
         self._filter = r2.filter.asList()
         self._allowedRequests = r2.requests.asList()
+        self._compile()
     
     def appliesTo(self, username):
         """
         Return True if this ACL applies to username, otherwise False
         """
-        if username in self._who:
+        if username in self._whoUsers:
             return True
-        groups = [g[1:] for g in self._who if g.startswith('@')]
-        for group in groups:
-            if username in grp.getgrnam(group).gr_mem:
+        for group in self._whoGroups:
+            if username in groupMembers(group):
                 return True
         return False
     
+    def usesLocation(self):
+        """
+        Return True if the ACL's filter depends on the location of the user
+        making the request (sameLocation).
+        """
+        return not self._filterAll and self._sameLocation
+    
+    def filterGroups(self):
+        """
+        Return the groups (a frozenset) users must be members of to pass the
+        filter, or None if it doesn't depend on groups.
+        """
+        if self._filterAll or not self._filterGroups:
+            return None
+        return self._filterGroups
+    
     def requestAllowed(self, request, reqUser=None, reqUserLoc=None, subjUser=None):
         """
         Return True if the ACL allows the request, otherwise False.
@@ -95,26 +147,29 @@ class ACL(object):
          * reqUserLoc  - list of locations for user making the request
          * subjUser    - user object for the user the request applies to
         """
-        if 'ALL' not in self._allowedRequests:
-            if request.lower() not in self._allowedRequests:
-                return False
+        if not self._allRequests and request.lower() not in self._requests:
+            return False
         
         if reqUser is None:
             return True
-        
-        if 'ALL' in self._filter:
+        return self.filterAllows(reqUserLoc, subjUser)
+    
+    def filterAllows(self, reqUserLoc, subjUser):
+        """
+        Return True if subjUser passes the filter, for a user at the
+        locations reqUserLoc, regardless of the request.
+        """
+        if self._filterAll:
             return True
         
-        if reqUserLoc and 'sameLocation' in self._filter:
-            if not [loc for loc in reqUserLoc if loc == subjUser.location]:
+        if reqUserLoc and self._sameLocation:
+            if subjUser.location not in reqUserLoc:
                 return False
         
         # Return True if subjUser is member of any groups in filter,
         # or if no groups have been specified (only ALL or sameLocation)
-        groups = [g[1:] for g in self._filter if g.startswith('@')]
-        if not groups or [g for g in groups if g in subjUser.groups]:
-            return True
-        return False
+        return not self._filterGroups or \
+               not self._filterGroups.isdisjoint(subjUser.groups)
     
     def requestAllowedServer(self, request, reqUser, reqUserLoc, server):
         """
@@ -122,10 +177,10 @@ class ACL(object):
         otherwise False.
         If no users are logged in on the server, return requestAllowed(request).
         """
-        if server.users:
+        if server.users and not self._filterAll:
             for user in server.users.itervalues():
                 if self.requestAllowed(request, reqUser, reqUserLoc, user):
                     return True
-        else:
+        else: # the filter doesn't matter
             return self.requestAllowed(request)
         return False
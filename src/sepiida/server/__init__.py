@@ -20,20 +20,42 @@ from twisted.internet import protocol, reactor, task, defer
 from twisted.protocols import basic
 from twisted.python import log
 import time
+import weakref
 import exceptions
-try:
-    import json
-except:
-    import simplejson as json
 
 from poller import PollerFactory
+from changelog import ChangeLog
+from scheduler import ConnectionScheduler
+from timers import Deadlines
+from userindex import UserIndex
+from visibility import Visibility
+from resultcache import ResultCache
 import config
+from sepiida import wire
+
+# Requests clients may check for in the hello features, in addition to
+# the sepiida.wire features
+REQUEST_FEATURES = ('batch', 'since', 'subscribe', 'cancel', 'stream')
+
+# {kind: (request, requestID)} of changes pushed to subscribed connections,
+# using negative requestIDs like the updates sent by the agents
+PUSH_REQUESTS = {'users': ('listUsers', -1), 'servers': ('listServers', -2)}
 
 class ServerProtocol(basic.Int32StringReceiver):
     MAX_LENGTH = 10000000
     acl = None
     username = None
     
+    def __init__(self):
+        self.codec = wire.Codec()
+        self._locations = None # (factory.usersVersion, locations)
+        self._views = {} # {snapshot kind: snapshot key}, see _changesSince
+        self._subscriptions = {} # {kind: version last pushed}
+        self._paused = False # the transport's buffer is full
+        self._visibility = None # see _allowed
+        self._pending = {} # {requestID: [agent deferreds]}, see _handleCancel
+        self._streams = {} # {requestID: (request, handler)}, see _sendPartial
+    
     def connectionMade(self):
         import struct
         import socket
@@ -50,52 +72,98 @@ class ServerProtocol(basic.Int32StringReceiver):
         try:
             self.username = pwd.getpwuid(uid).pw_name
             self.acl = self.factory.getACL(self.username)
+            if self.acl:
+                self._visibility = self.factory.visibility(self.acl, self.username)
         finally:
             if self.acl:
-                self._sendResponse('', 'hello', 0)
+                # pushed changes wait while the client isn't reading, see
+                # pauseProducing
+                self.transport.registerProducer(self, True)
+                # features the server supports, see _handleFeatures
+                self._sendResponse({'features': self._features()}, 'hello', 0)
             else: # no matching ACL for user
                 self._sendResponse('', 'hello', 0, 'notauthorized')
                 self.transport.loseConnection()
     
+    def connectionLost(self, reason):
+        self.factory.subscribers.discard(self)
+        # nobody is waiting for the responses any more
+        for requestID in self._pending.keys():
+            self._cancelPending(requestID)
+    
+    # The protocol is a push producer for its transport, which pauses it
+    # when the client doesn't read fast enough. Changes aren't pushed while
+    # paused, and all the changes since are pushed at once when resumed.
+    def pauseProducing(self):
+        self._paused = True
+    
+    def resumeProducing(self):
+        self._paused = False
+        if self._subscriptions:
+            self.pushChanges()
+    
+    def stopProducing(self):
+        self._paused = True
+    
     def _getLocations(self):
         """
         Get list of locations for the user connected to Sepiida.
         Note that it is assumed that the usernames refer to the same user,
         if this isn't the case sameLocation shouldn't be used.
         """
-        return [user.location for user in self._users() if \
-                     user.username == self.username]
+        version = self.factory.usersVersion
+        if self._locations is None or self._locations[0] != version:
+            self._locations = (version, [user.location for user in
+                                         self.factory.index.byUsername(self.username)])
+        return self._locations[1]
+    
+    def _allowed(self, reqName, user):
+        """
+        Return True if the ACL allows reqName for user, as
+        acl.requestAllowed, using the users visible to this connection
+        (see ServerFactory.visibility).
+        """
+        return self.acl.requestAllowed(reqName) and \
+               self._visibility.allowsUser(user)
+    
+    def _allowedServer(self, reqName, server):
+        """
+        Return True if the ACL allows reqName for server, as
+        acl.requestAllowedServer, see _allowed.
+        """
+        return self.acl.requestAllowed(reqName) and \
+               self._visibility.allowsServer(server)
     
     def _preFilter(self, handler, reqID, req, args):
         """
         Check if connected user is allowed access to the request
-        and the users it applies to.
+        and the users it applies to, setting 'error' in the args it isn't
+        allowed for.
         Returns False if request is not allowed.
         """
+        if handler.reqType == 'connection':
+            return True
         if not self.acl.requestAllowed(req):
-            self._sendResponse([], req, reqID, 'notauthorized')
             return False
         
         assert self.username
         if handler.reqType == 'user':
             # list of udicts sorted by _preProcessArgs
-            locations = self._getLocations()
             for server in args:
                 if server is None:
                     continue
                 for udict in args[server]:
                     user = server.users[self._dictToUkey(udict)]
-                    if not self.acl.requestAllowed(req, self.username, locations, user):
+                    if not self._allowed(req, user):
                         udict['error'] = 'notfound'
         else:
-            locations = self._getLocations()
             for d in args:
                 try:
                     server = self.factory.servers[d['server']]
                 except KeyError:
                     d['error'] = 'notfound'
                     continue
-                if not self.acl.requestAllowedServer(req, self.username, locations, server):
+                if not self._allowedServer(req, server):
                     d['error'] = 'notfound'
         return True
     
@@ -105,19 +173,17 @@ class ServerProtocol(basic.Int32StringReceiver):
         """
         
         if reqType == 'user':
-            locations = self._getLocations()
             def gen():
                 for udict in data:
                     user = self.factory.servers[udict['server']].users[self._dictToUkey(udict)]
-                    if self.acl.requestAllowed(reqName, self.username, locations, user):
+                    if self._allowed(reqName, user):
                         yield udict
             return list(gen())
         elif reqType == 'server':
-            locations = self._getLocations()
             def gen():
                 for d in data:
                     server = self.factory.servers[d['server']]
-                    if self.acl.requestAllowedServer(reqName, self.username, locations, server):
+                    if self._allowedServer(reqName, server):
                         yield d
             return list(gen())
         
@@ -146,15 +212,30 @@ class ServerProtocol(basic.Int32StringReceiver):
     
     def _parseRequest(self, jsonString):
         """
-        Check if request is valid.
+        Decode request and check if it's valid.
+        Returns (handler, reqName, args, request), where request is the
+        decoded request with any optional keys (e.g. since), or throws
+        ValueError on error (wire.StreamError if the connection must be
+        closed).
+        """
+        try:
+            request = self.codec.decode(jsonString)
+        except wire.StreamError:
+            raise
+        except ValueError:
+            raise ValueError('invalid request')
+        return self._checkRequest(request) + (request,)
+    
+    def _checkRequest(self, request):
+        """
+        Check if a decoded request is valid.
         Returns (handler, reqName, args) or throws ValueError on error.
         """
         try:
-            request = json.loads(jsonString)
             reqName = request['request']
             args = request['args']
             handler = getattr(self, '_handle' + reqName.capitalize())
-        except (ValueError, KeyError, AttributeError):
+        except (KeyError, TypeError, AttributeError):
             raise ValueError('invalid request')
         
         def ensure(b):
@@ -165,6 +246,7 @@ class ServerProtocol(basic.Int32StringReceiver):
         required = ('username', 'server', 'client', 'display')
         if args and handler.reqType == 'user':
             for item in args:
+                ensure(isinstance(item, dict))
                 for attr in required:
                     ensure(item.has_key(attr))
                     ensure(isinstance(item[attr], (str, unicode)))
@@ -183,31 +265,140 @@ class ServerProtocol(basic.Int32StringReceiver):
         self._nextRID += 1
         reqID = self._nextRID
         try:
-            handler, reqName, args = self._parseRequest(string)
+            handler, reqName, args, request = self._parseRequest(string)
+        except wire.StreamError, e:
+            log.msg('closing connection: %s' % e)
+            self.transport.loseConnection()
+            return
         except ValueError, ve:
             log.msg('invalid request: %s' % string)
             log.msg(str(ve))
             self._sendResponse([], '', reqID, 'invalid')
             return
         
+        def cbResponse((data, error)):
+            self._sendResponse(data, reqName, reqID, error)
+        self._runRequest(handler, reqID, reqName, args,
+                         request.get('since'),
+                         request.get('stream', False)).addCallback(cbResponse)
+    
+    def _runRequest(self, handler, reqID, reqName, args, since=None, stream=False):
+        """
+        Run a valid request. since is the version of the previous response
+        to listUsers/listServers, see _changesSince. If stream is set, the
+        results from each server are sent as they arrive, see _sendPartial.
+        Returns a deferred which is called back with (data, error).
+        """
+        if handler.reqType == 'user':
+            args = self._sortUserArgs(args)
+        if not self._preFilter(handler, reqID, reqName, args):
+            return defer.succeed(([], 'notauthorized'))
+        
+        if handler.snapshot and since is not None:
+            changes = self._changesSince(handler.snapshot, reqName, since)
+            if changes is not None:
+                return defer.succeed((changes, ''))
+            # changes unknown, respond with everything and the version
+            version = self.factory.changes.token()
+            d = self._runRequest(handler, reqID, reqName, args)
+            def cbFull((data, error)):
+                if isinstance(data, wire.Prepared):
+                    data = data.value
+                return {'version': version, handler.snapshot: data}, error
+            return d.addCallback(cbFull)
+        
+        if handler.snapshot:
+            key = self._snapshotKey(reqName)
+            prepared = self.factory.getSnapshot(handler.snapshot, key)
+            if prepared is not None:
+                return defer.succeed((prepared, ''))
+        
         deferred = defer.Deferred()
+        if stream and handler.reqType in ('user', 'server') and \
+           not handler.snapshot:
+            self._streams[reqID] = (reqName, handler)
+            def done(result):
+                del self._streams[reqID]
+                return result
+            deferred.addBoth(done)
         if handler.postFilter:
             deferred.addCallback(self._postFilter, reqName, handler.reqType)
-        deferred.addCallback(self._sendResponse, reqName, reqID)
-        
-        if handler.reqType == 'user':
-            args = self._sortUserArgs(args)
-        if self._preFilter(handler, reqID, reqName, args):
-            handler(deferred, reqID, reqName, args)
-        else: # request not authorized
-            pass # preFilter takes care of sending error 
+        if handler.snapshot:
+            deferred.addCallback(self._storeSnapshot, handler.snapshot, key,
+                                 self.factory.snapshotVersion(handler.snapshot))
+        deferred.addCallback(lambda data: (data, ''))
+        handler(deferred, reqID, reqName, args)
+        return deferred
+    
+    def _snapshotKey(self, reqName):
+        """
+        Return the key of the snapshot of reqName's response, which is the
+        same for all connections with the same ACL and, if the ACL depends on
+        it, the same locations.
+        """
+        if self.acl.usesLocation():
+            locations = tuple(sorted(set(self._getLocations())))
+        else:
+            locations = None
+        return (reqName.lower(), self.acl, locations)
+    
+    def _storeSnapshot(self, data, kind, key, version):
+        prepared = wire.Prepared(data)
+        self.factory.storeSnapshot(kind, key, version, prepared)
+        return prepared
+    
+    def _changesSince(self, kind, reqName, since):
+        """
+        Return the users or servers (kind) that have changed since version
+        since, as {'version': version, 'added': [..], 'removed': [..]},
+        where added are users/servers to add or update, in the same format
+        as the full response, and removed are ukeys/{'server': hostname}.
+        Returns None if the changes aren't known, because the version is
+        too old, or what this connection may see has changed.
+        """
+        key = self._snapshotKey(reqName)
+        version = self.factory.changes.token()
+        keys = None
+        if self._views.get(kind) == key:
+            keys = self.factory.changes.since(kind, since)
+        self._views[kind] = key
+        if keys is None:
+            return None
         
-    def _sendResponse(self, data, request, requestID, error=''):
-        response = json.dumps(
-          {'request': request, 'requestID': requestID,
-           'data': data,
-           'error': error}
-        )
+        servers = self.factory.servers
+        added = []
+        removed = []
+        if kind == 'users':
+            for ukey in keys:
+                poller = servers.get(ukey[1])
+                user = None
+                if poller is not None and poller.connected:
+                    user = poller.users.get(ukey)
+                if user is not None and \
+                   self._allowed(reqName, user):
+                    added.append(self._userDict(user))
+                else:
+                    username, server, client, display = ukey
+                    removed.append({'username': username, 'server': server,
+                                    'client': client, 'display': display})
+        else:
+            for hostname in keys:
+                poller = servers.get(hostname)
+                if poller is not None and poller.connected and \
+                   self._allowedServer(reqName, poller):
+                    added.append(self._serverDict(poller))
+                else:
+                    removed.append({'server': hostname})
+        return {'version': version, 'added': added, 'removed': removed}
+    
+
+    def _sendResponse(self, data, request, requestID, error='', partial=False):
+        response = {'request': request, 'requestID': requestID,
+                    'data': data,
+                    'error': error}
+        if partial:
+            response['partial'] = True
+        response = self.codec.encode(response)
         log.debug('Sending response: %s' % response)
         self.sendString(response)
     
@@ -236,59 +427,282 @@ class ServerProtocol(basic.Int32StringReceiver):
             for user in poller.users.itervalues():
                 yield user
     
-    def userRequest(attrs=[], postFilter=False):
+    def userRequest(attrs=[], postFilter=False, snapshot=None):
+        """
+        snapshot is set for requests without arguments whose response only
+        depends on the ACL and the state of the pollers, 'users' or 'servers'.
+        The response is then reused until that state changes, see
+        ServerFactory.snapshotVersion.
+        """
         def wrapper(func):
             func.reqAttrs = attrs
             func.reqType = 'user'
             func.postFilter = postFilter
+            func.snapshot = snapshot
             return func
         return wrapper
     
-    def serverRequest(attrs=[], postFilter=False):
+    def serverRequest(attrs=[], postFilter=False, snapshot=None):
         def wrapper(func):
             func.reqAttrs = attrs
             func.reqType = 'server'
             func.postFilter = postFilter
+            func.snapshot = snapshot
             return func
         return wrapper
     
+    def connectionRequest(func):
+        """
+        Requests concerning the connection itself, allowed regardless
+        of ACL.
+        """
+        func.reqAttrs = []
+        func.reqType = 'connection'
+        func.postFilter = False
+        func.snapshot = None
+        return func
+    
+    def _features(self):
+        return list(wire.FEATURES + REQUEST_FEATURES)
+    
     # request handlers
-    @userRequest(attrs=[], postFilter=True)
+    @connectionRequest
+    def _handleFeatures(self, deferred, requestID, request, args):
+        """
+        Handle features request. args is the list of features (see
+        sepiida.wire) the client can decode, which may then be used in
+        responses.
+        Returned data is the list of features the server supports.
+        """
+        self.codec.setPeerFeatures(args)
+        deferred.callback(self._features())
+    
+    @connectionRequest
+    def _handleBatch(self, deferred, requestID, request, args):
+        """
+        Handle batch request, several requests sent in one frame and
+        answered in one response. Each request is checked against the ACL
+        as if it had been sent on its own, and they're handled concurrently.
+        Args: [ {'request': request, 'args': args} ]
+        Requests may have a since key, as when sent on their own.
+        Response: [ {'request': request, 'data': data, 'error': error} ]
+        in the same order as the requests.
+        """
+        results = [None] * len(args)
+        deferreds = []
+        for i, subRequest in enumerate(args):
+            def cbResult((data, error), i=i, reqName=None):
+                if isinstance(data, wire.Prepared):
+                    data = data.value
+                results[i] = {'request': reqName, 'data': data, 'error': error}
+            try:
+                handler, reqName, subArgs = self._checkRequest(subRequest)
+                if handler == self._handleBatch:
+                    raise ValueError('nested batch request')
+            except ValueError, ve:
+                log.msg('invalid request in batch: %s' % ve)
+                cbResult(([], 'invalid'), i, '')
+                continue
+            d = self._runRequest(handler, requestID, reqName, subArgs,
+                                 subRequest.get('since'))
+            d.addCallback(cbResult, i, reqName)
+            deferreds.append(d)
+        
+        deferredList = defer.DeferredList(deferreds)
+        deferredList.addCallback(lambda ignore: deferred.callback(results))
+    
+    @connectionRequest
+    def _handleSubscribe(self, deferred, requestID, request, args):
+        """
+        Handle subscribe request. args is a list of 'users' and/or
+        'servers', which replaces any previous subscription.
+        Changes are then pushed as responses to listUsers (requestID -1) or
+        listServers (requestID -2) with since, see _changesSince.
+        Changes made within ServerFactory.pushDelay seconds of each other
+        are sent together.
+        Returned data is the list of kinds subscribed to, those the ACL
+        allows listing.
+        """
+        version = self.factory.changes.token()
+        self._subscriptions = {}
+        for kind in args:
+            if kind not in PUSH_REQUESTS:
+                continue
+            reqName = PUSH_REQUESTS[kind][0]
+            if self.acl.requestAllowed(reqName):
+                self._subscriptions[kind] = version
+                self._views[kind] = self._snapshotKey(reqName)
+        
+        if self._subscriptions:
+            self.factory.subscribers.add(self)
+        else:
+            self.factory.subscribers.discard(self)
+        deferred.callback(sorted(self._subscriptions))
+    
+    @connectionRequest
+    def _handleCancel(self, deferred, requestID, request, args):
+        """
+        Handle cancel request. args is a list of requestIDs of requests
+        the client is no longer interested in. The agents are told to stop
+        working on them, and they're answered at once with 'error' set to
+        'cancelled' for the users/servers not done yet.
+        Returned data is the list of requestIDs that were in progress.
+        """
+        cancelled = []
+        for reqID in args:
+            if reqID in self._pending:
+                self._cancelPending(reqID)
+                cancelled.append(reqID)
+        deferred.callback(cancelled)
+    
+    def _trackPending(self, requestID, deferred):
+        """
+        Remember deferred, returned by an agent request made for requestID,
+        until it's done.
+        """
+        self._pending.setdefault(requestID, []).append(deferred)
+        def done(result):
+            pending = self._pending.get(requestID, [])
+            if deferred in pending:
+                pending.remove(deferred)
+                if not pending:
+                    del self._pending[requestID]
+            return result
+        deferred.addBoth(done)
+    
+    def _cancelPending(self, requestID):
+        for deferred in self._pending.pop(requestID, []):
+            deferred.cancel()
+    
+    def _sendPartial(self, requestID, data):
+        """
+        Send data, the results from one server, at once if the request was
+        sent with 'stream' set. The partial responses have 'partial' set,
+        and are followed by the usual response with the remaining results
+        (e.g. errors for users not found), which marks the request as done.
+        Returns False if the request isn't streamed, and data should be
+        part of the usual response.
+        """
+        try:
+            reqName, handler = self._streams[requestID]
+        except KeyError:
+            return False
+        if handler.postFilter:
+            data = self._postFilter(data, reqName, handler.reqType)
+        self._sendResponse(data, reqName, requestID, partial=True)
+        return True
+    
+    def _failedError(self, failure, server):
+        """
+        Return the error to set for the arguments of a failed agent request.
+        """
+        if failure.check(defer.TimeoutError):
+            return 'timeout'
+        elif failure.check(defer.CancelledError):
+            return 'cancelled'
+        log.msg('%s: request failed: %s' % (server, failure.getErrorMessage()))
+        return 'failed'
+    
+    def pushChanges(self, views=None):
+        """
+        Send the changes since the last push to a subscribed connection.
+        Called by ServerFactory with views, a dict shared by all the
+        subscribers, so that connections with the same view of the changes
+        (the same snapshot key and version last pushed) share one
+        encoded message.
+        """
+        if self._paused:
+            return
+        if views is None:
+            views = {}
+        for kind, since in self._subscriptions.items():
+            if self.factory.changes.since(kind, since) == set():
+                continue
+            reqName, requestID = PUSH_REQUESTS[kind]
+            # the previous view decides if the changes can be sent, see
+            # _changesSince
+            view = (kind, self._views.get(kind), self._snapshotKey(reqName), since)
+            if view in views:
+                self._cbPush((views[view], ''), kind, reqName, requestID, view)
+                continue
+            handler = getattr(self, '_handle' + reqName.capitalize())
+            d = self._runRequest(handler, requestID, reqName, [], since)
+            d.addCallback(self._cbPush, kind, reqName, requestID, view, views)
+    
+    def _cbPush(self, (data, error), kind, reqName, requestID, view, views=None):
+        if error:
+            return
+        if not isinstance(data, wire.Prepared):
+            data = wire.Prepared(data)
+        if views is not None:
+            views[view] = data
+        self._views[kind] = view[2]
+        self._subscriptions[kind] = data.value['version']
+        self._sendResponse(data, reqName, requestID)
+    
+    @userRequest(attrs=[], postFilter=True, snapshot='users')
     def _handleListusers(self, deferred, requestID, request, args):
         """
         Handle listUsers request.
         Returned data is in format:
         [ {'username': .., 'server': .., 'client': .., 'display': ..,
         'name': .., 'groups': [], 'time': 1234567890 } ]
+        If the request has a since key (a version from a previous response),
+        the response is instead in the format described in _changesSince,
+        or {'version': version, 'users': [..]} with all users.
         """
-        
-        def gen():
-            for user in self._users():
-                d = self._getUkey(user)
-                d['name'] = user.name
-                d['groups'] = user.groups
-                d['time'] = user.time
-                d['location'] = user.location
-                yield d
-                
-        deferred.callback(list(gen()))
+        deferred.callback([self._userDict(user) for user in self._candidates()])
     
-    @serverRequest(attrs=[], postFilter=True)
+    def _candidates(self):
+        """
+        Return the users that may pass the ACL's filter: those in its groups
+        or locations, found in the factory's index, if it's restricted to
+        them, otherwise all users.
+        """
+        if self.acl is None: # nothing to narrow the users by
+            return self._users()
+        index = self.factory.index
+        groups = self.acl.filterGroups()
+        if groups is not None:
+            lookups = [index.byGroup(group) for group in groups]
+        elif self.acl.usesLocation() and self._getLocations():
+            lookups = [index.byLocation(location)
+                       for location in set(self._getLocations())]
+        else:
+            return self._users()
+        if len(lookups) == 1:
+            return lookups[0]
+        users = {}
+        for lookup in lookups:
+            for user in lookup:
+                users[id(user)] = user
+        return users.values()
+    
+    def _userDict(self, user):
+        d = self._getUkey(user)
+        d['name'] = user.name
+        d['groups'] = user.groups
+        d['time'] = user.time
+        d['location'] = user.location
+        return d
+    
+    @serverRequest(attrs=[], postFilter=True, snapshot='servers')
     def _handleListservers(self, deferred, requestID, request, args):
         """
         Handle listServers request.
         Returned data is in format:
         [ {'server': 'hostname', 'users': N} ]
+        since works as for listUsers, with {'version': version,
+        'servers': [..]} as the full response.
         """
-        def gen():
-            for poller in self.factory.servers.itervalues():
-                if not poller.connected:
-                    continue
-                yield {'server': poller.hostname, 'users': len(poller.users),
-                       'uptime': poller.uptime, 'load': poller.load,
-                       'os': poller.os, 'location': poller.location}
-        
-        deferred.callback(list(gen()))        
+        deferred.callback([self._serverDict(poller) for poller
+                           in self.factory.servers.itervalues()
+                           if poller.connected])
+    
+    def _serverDict(self, poller):
+        return {'server': poller.hostname, 'users': len(poller.users),
+                'uptime': poller.uptime, 'load': poller.load,
+                'os': poller.os, 'location': poller.location}
     
     def _genericHandleRequest(self, reqDeferred, requestID, request, args, ensure, fn_sendreq):
         """
@@ -311,7 +725,8 @@ class ServerProtocol(basic.Int32StringReceiver):
                 log.debug('cbHandleResponse: %s' % resp_data)
                 for ukey_d in resp_data:
                     ukey_d['server'] = server.hostname # expected by client
-                ret_data.extend(resp_data)
+                if not self._sendPartial(requestID, resp_data):
+                    ret_data.extend(resp_data)
             
             srv_args = []
             for ukey_d in args:
@@ -323,9 +738,20 @@ class ServerProtocol(basic.Int32StringReceiver):
                 else:
                     del ukey_d['server'] # not used by agent
                     srv_args.append(ukey_d)
+            def ebHandleResponse(failure, server=server, srv_args=srv_args):
+                error = self._failedError(failure, server)
+                for ukey_d in srv_args:
+                    ukey_d['server'] = server.hostname
+                    ukey_d['error'] = error
+                    for var, val in ensure:
+                        ukey_d[var] = val
+                if not self._sendPartial(requestID, srv_args):
+                    ret_data.extend(srv_args)
+            
             if srv_args:     
                 deferred = fn_sendreq(server, srv_args)
-                deferred.addCallback(cbHandleResponse)
+                self._trackPending(requestID, deferred)
+                deferred.addCallbacks(cbHandleResponse, ebHandleResponse)
                 deferreds.append(deferred)
         
         def cbSendResponse(result):
@@ -339,8 +765,10 @@ class ServerProtocol(basic.Int32StringReceiver):
     def _handleListprocesses(self, deferred, requestID, request, args):
         """
         Handle listProcesses request.
-        Args: ukeys
-        Response: [ {ukey + 'processes': [[pid, command]] ]
+        Args: ukeys, optionally with 'since': version from an earlier response
+        Response: [ {ukey + 'version': version + 'processes': [[pid, command]] ]
+        or, if 'since' was given and the agent could compute the difference:
+        [ {ukey + 'version': version + 'added': [[pid, command]] + 'removed': [pid]} ]
         """
         def sendRequest(server, args):
             return server.agentProtocol.getProcesses(args)
@@ -363,8 +791,12 @@ class ServerProtocol(basic.Int32StringReceiver):
     def _handleGetthumbnails(self, deferred, requestID, request, args):
         """
         Handle getThumbnails request.
-        Args: ukeys
-        Response: [ {ukey + 'thumbnail': base64 enc. jpg} ]
+        Args: ukeys, optionally with 'token': token from an earlier response
+        Response: [ {ukey + 'thumbnail': jpg + 'token': token} ]
+        The thumbnail is base64 encoded, or a binary blob if the client
+        has announced the binary feature (see sepiida.wire).
+        If the thumbnail is unchanged since token, 'notmodified' is True
+        and 'thumbnail' is not set.
         """
         def sendRequest(server, args):
             return server.agentProtocol.getThumbnails(args)
@@ -425,6 +857,17 @@ class ServerProtocol(basic.Int32StringReceiver):
             return server.agentProtocol.openURL(args)
         self._genericHandleRequest(deferred, requestID, request, args, [], sendRequest)
     
+    @serverRequest()
+    def _handleStatus(self, deferred, requestID, request, args):
+        """
+        Handle status request.
+        Response: [ {'servers': N, 'connected': N, 'connecting': N,
+        'queued': N, 'backoff': N, 'window': N} ]
+        where queued is the number of servers waiting to be connected to,
+        and backoff the number of servers not retried yet after failing.
+        """
+        deferred.callback([self.factory.connectionStats()])
+    
     def _genericHandleServerRequest(self, reqDeferred, requestID, request, args, fn_sendrequest):
         """
         Generic server request handler.
@@ -456,11 +899,21 @@ class ServerProtocol(basic.Int32StringReceiver):
             
             def cbRequest(rd, server):
                 rd['server'] = server.hostname 
-                data.append(rd)
+                if not self._sendPartial(requestID, [rd]):
+                    data.append(rd)
+            
+            def ebRequest(failure, server, d):
+                d['server'] = server.hostname
+                d['error'] = self._failedError(failure, server)
+                if not self._sendPartial(requestID, [d]):
+                    data.append(d)
             
             del d['server'] # not used by agent
             deferred = fn_sendrequest(server, d)
-            deferred.addCallback(cbRequest, server)
+            self._trackPending(requestID, deferred)
+            deferred.addCallbacks(cbRequest, ebRequest,
+                                  callbackArgs=(server,),
+                                  errbackArgs=(server, d))
             deferreds.append(deferred)
         
         def cbSendResponse(result):
@@ -500,6 +953,37 @@ class ServerFactory(protocol.ServerFactory):
     def __init__(self):
         # { hostname: PollerFactory }
         self.servers = {}
+        # timers for the pollers' watchdogs and connection attempts
+        self.timers = Deadlines()
+        # bumped when users, or the info of servers, change
+        self.usersVersion = 0
+        self.serversVersion = 0
+        self._snapshots = {} # {(kind, key): (version, wire.Prepared)}
+        # which users and servers have changed, for listUsers/listServers
+        # with since
+        self.changes = ChangeLog()
+        # the users on connected servers, by username, location etc.
+        self.index = UserIndex()
+        # {(ACL, username): Visibility} of connected users
+        self._visibilities = weakref.WeakValueDictionary()
+        # ServerProtocols to push changes to, see _handleSubscribe
+        self.subscribers = set()
+        self.pushDelay = 0.5
+        self._pushCall = None
+        self.clock = reactor
+        
+        cfg = config.configuration
+        def getint(option, default):
+            if cfg.has_option('Server', option):
+                return cfg.getint('Server', option)
+            return default
+        self.scheduler = ConnectionScheduler(self._connect,
+                            maxConcurrent=getint('max connecting', 20),
+                            minBackoff=cfg.getint('Server', 'connect frequency'),
+                            maxBackoff=getint('max retry delay', 3600))
+        self.scheduler.clock = self.timers
+        # recent thumbnails and process lists, see poller.MAX_AGES
+        self.results = ResultCache(getint('result cache size', 32) * 1024 * 1024)
     
     def startFactory(self):
         cfg = config.configuration
@@ -518,12 +1002,17 @@ class ServerFactory(protocol.ServerFactory):
         try:
             config.reload()
             log.msg('reloaded configuration')
+            # keyed by the ACLs, which have been replaced
+            self._snapshots.clear()
         except:
             log.err()
             log.msg('failed to reload configuration')
     
     def retryServers(self):
-        """Try/retry connection to servers"""
+        """
+        Try/retry connection to servers. The connection attempts are
+        started by the scheduler, see _connect.
+        """
         cfg = config.configuration
         def hosts():
             for key, hosts in cfg.getHosts():
@@ -535,35 +1024,161 @@ class ServerFactory(protocol.ServerFactory):
                 for host in hosts:
                     yield host, alias
         
+        configured = set()
         for hostname, alias in hosts():
             try:
                 poller = self.servers[hostname]
             except KeyError:
-                poller = self.servers[hostname] = PollerFactory(hostname, alias)
+                poller = self.servers[hostname] = PollerFactory(hostname, alias, self)
                 poller.notified_error = False
+            configured.add(poller)
             
             if poller.connected or poller.connecting:
                 continue
-            poller.connecting = True
-            
-            def cbConnected(factory, poller=poller):
-                log.msg('connected to server/workstation %s' % poller.hostname)
-                
-            def ebFailed(reason, poller=poller):
-                # Try to keep the size of the logfile down by only notifying
-                # of the same error once.
-                if not poller.notified_error:
-                    log.err('failed to connect to %s: %s' % (poller.hostname, reason))
-                    poller.notified_error = True
-            
-            deferred = poller.deferred = defer.Deferred()                            
-            deferred.addCallback(cbConnected)
-            deferred.addErrback(ebFailed)
+            if self.scheduler.schedule(poller):
+                poller.connecting = True
+        # hosts removed from the configuration
+        self.scheduler.retain(configured)
+    
+    def _connect(self, poller):
+        """
+        Connect to poller's host. Called by the scheduler, returns a deferred
+        which is called back when connected to the agent.
+        """
+        def cbConnected(factory):
+            log.msg('connected to server/workstation %s' % poller.hostname)
+            poller.notified_error = False
+            return factory
             
-            # Delay in order to space out connection attempts
-            import random
-            reactor.callLater(random.uniform(0.0, 10.0),
-                              reactor.connectTCP, poller.hostname, 22, poller)
+        def ebFailed(reason):
+            # Try to keep the size of the logfile down by only notifying
+            # of the same error once.
+            if not poller.notified_error:
+                log.err('failed to connect to %s: %s' % (poller.hostname, reason))
+                poller.notified_error = True
+            return reason
+        
+        def cancel(deferred):
+            connector.disconnect()
+        
+        deferred = poller.deferred = defer.Deferred(cancel)
+        deferred.addCallbacks(cbConnected, ebFailed)
+        connector = reactor.connectTCP(poller.hostname, 22, poller)
+        return deferred
+    
+    def connectionStats(self):
+        """
+        Return a dict with the number of servers connected, and the
+        scheduler's queue depth (see ConnectionScheduler.stats).
+        """
+        stats = self.scheduler.stats()
+        stats['connected'] = len([p for p in self.servers.itervalues() if p.connected])
+        stats['servers'] = len(self.servers)
+        return stats
+    
+    def usersChanged(self, poller, ukeys=()):
+        """
+        Called by pollers when users have logged in or out, or the poller
+        has connected or disconnected. ukeys are the users that changed.
+        """
+        self.usersVersion += 1
+        self._dropSnapshots(('users', 'servers'))
+        for ukey in ukeys:
+            self.changes.record('users', ukey)
+            user = None
+            if poller.connected:
+                user = poller.users.get(ukey)
+            self.index.update(ukey, user)
+        for visibility in self._visibilities.values():
+            visibility.update(poller, ukeys)
+        # listServers includes the number of users
+        self.changes.record('servers', poller.hostname)
+        self._schedulePush()
+    
+    def serversChanged(self, poller):
+        """
+        Called by pollers when uptime, load, OS or location has changed.
+        """
+        self.serversVersion += 1
+        self._dropSnapshots(('servers',))
+        self.changes.record('servers', poller.hostname)
+        self._schedulePush()
+    
+    def rebuildIndex(self):
+        """
+        Index all users again, e.g. if the pollers' users have been
+        replaced without calling usersChanged.
+        """
+        self.index.clear()
+        for poller in self.servers.itervalues():
+            if poller.connected:
+                for ukey, user in poller.users.iteritems():
+                    self.index.update(ukey, user)
+        for visibility in self._visibilities.values():
+            visibility.rebuild()
+        self.usersVersion += 1
+        self._dropSnapshots(('users', 'servers'))
+    
+    def visibility(self, acl, username):
+        """
+        Return the Visibility of users and servers for username with acl,
+        which is shared by all its connections while any are open.
+        """
+        try:
+            return self._visibilities[acl, username]
+        except KeyError:
+            visibility = self._visibilities[acl, username] = \
+                Visibility(acl, username, self)
+            return visibility
+    
+    def _schedulePush(self):
+        """
+        Push changes to subscribers in pushDelay seconds, unless that's
+        already scheduled, so that a burst of changes is sent at once.
+        """
+        if self.subscribers and self._pushCall is None:
+            self._pushCall = self.clock.callLater(self.pushDelay, self._push)
+    
+    def _push(self):
+        self._pushCall = None
+        views = {} # shared by the subscribers, see ServerProtocol.pushChanges
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.pushChanges(views)
+            except:
+                log.err()
+    
+    def snapshotVersion(self, kind):
+        if kind == 'users':
+            return self.usersVersion
+        return (self.usersVersion, self.serversVersion)
+    
+    def getSnapshot(self, kind, key):
+        """
+        Return the stored response for key (see ServerProtocol._snapshotKey)
+        if it's still current, otherwise None.
+        """
+        try:
+            version, prepared = self._snapshots[kind, key]
+        except KeyError:
+            return None
+        if version != self.snapshotVersion(kind):
+            del self._snapshots[kind, key]
+            return None
+        return prepared
+    
+    def _dropSnapshots(self, kinds):
+        """
+        Forget the stored responses of kinds, after their version has
+        changed.
+        """
+        for kind, key in self._snapshots.keys():
+            if kind in kinds:
+                del self._snapshots[kind, key]
+    
+    def storeSnapshot(self, kind, key, version, prepared):
+        if version == self.snapshotVersion(kind):
+            self._snapshots[kind, key] = (version, prepared)
     
     def getACL(self, username):
         """
@@ -0,0 +1,70 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import deque
+import random
+
+class ChangeLog(object):
+    """
+    Bounded log of which users and servers have changed, used to answer
+    listUsers and listServers requests with only the changes since a given
+    version.
+    Versions are strings of the form "generation:N", where generation
+    changes each time the server is started.
+    """
+    MAX_CHANGES = 20000
+
+    def __init__(self):
+        self.generation = '%08x' % random.getrandbits(32)
+        self.version = 0
+        self._log = deque() # [ (version, kind, key) ]
+        self._horizon = 0 # oldest version changes can be found from
+
+    def token(self):
+        return '%s:%d' % (self.generation, self.version)
+
+    def record(self, kind, key):
+        """
+        Record that key has changed, kind is 'users' (key is a ukey tuple)
+        or 'servers' (key is a hostname).
+        """
+        self.version += 1
+        self._log.append((self.version, kind, key))
+        while len(self._log) > self.MAX_CHANGES:
+            self._horizon = self._log.popleft()[0]
+
+    def since(self, kind, token):
+        """
+        Return the set of keys of kind changed since token, or None if
+        that's not known (the token is invalid or too old).
+        """
+        try:
+            generation, version = token.split(':')
+            version = int(version)
+        except (AttributeError, ValueError):
+            return None
+        if generation != self.generation or version > self.version or \
+           version < self._horizon:
+            return None
+
+        keys = set()
+        for v, k, key in reversed(self._log):
+            if v <= version:
+                break
+            if k == kind:
+                keys.add(key)
+        return keys
@@ -0,0 +1,204 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Look up the location of servers and clients in the locationmap, the same
+way as sepiida-get-location, without starting a process per lookup.
+"""
+
+from twisted.internet import defer, utils
+from twisted.python import log
+from fnmatch import translate
+import os
+import re
+import time
+import config
+
+LOCATIONMAP = '/etc/sepiida/locationmap'
+COMMAND_TTL = 300 # seconds to remember results from a location command
+
+_rsep = re.compile('\t+| {4,}')
+_globChars = re.compile('[*?[]')
+
+def normalizeHWAddr(s):
+    return s.lower().replace(':', '').replace('-', '')
+
+class LocationMap(object):
+    """
+    The locationmap, indexed for lookups.
+    Format:
+    # comments start with #
+    [hostname|HWAddr ..]    location
+    The first line with a pattern matching the client (or the server if
+    client is empty) or its hardware address wins. Patterns may contain
+    shell-style wildcards.
+    The file is read again if it has changed, this is checked at most every
+    checkInterval seconds. Results are remembered until then.
+    """
+    def __init__(self, path=LOCATIONMAP, checkInterval=10.0):
+        self.path = path
+        self.checkInterval = checkInterval
+        self._mtime = None
+        self._checkedAt = 0
+        self._clear()
+
+    def _clear(self):
+        self._names = {} # {hostname: line number}
+        self._hwaddrs = {} # {normalized HWAddr: line number}
+        self._globs = [] # [ (line number, hostname regex, HWAddr regex) ]
+        self._locations = [] # location of each line
+        self._memo = {} # {(server, client, hwaddr): location}
+
+    def _check(self):
+        now = time.time()
+        if now - self._checkedAt < self.checkInterval:
+            return
+        self._checkedAt = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._load()
+
+    def _load(self):
+        self._clear()
+        try:
+            f = open(self.path)
+        except IOError, e:
+            log.msg('failed to read locationmap: %s' % e)
+            return
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                patterns, location = _rsep.split(line, 1)
+            except ValueError: # not enough fields
+                log.msg('malformed line in locationmap: %s' % line)
+                continue
+
+            lineno = len(self._locations)
+            self._locations.append(location.decode('utf-8', 'replace'))
+            names = []
+            hwaddrs = []
+            for pattern in patterns.lower().split():
+                if _globChars.search(pattern):
+                    names.append(translate(pattern))
+                    hwaddrs.append(translate(normalizeHWAddr(pattern)))
+                else:
+                    self._names.setdefault(pattern, lineno)
+                    self._hwaddrs.setdefault(normalizeHWAddr(pattern), lineno)
+            if names:
+                self._globs.append((lineno, re.compile('|'.join(names)),
+                                    re.compile('|'.join(hwaddrs))))
+        f.close()
+
+    def lookup(self, server, client, hwaddr):
+        """
+        Return the location of client (or server if client is empty), or
+        u'' if it's not in the locationmap.
+        """
+        self._check()
+        key = (server, client, hwaddr)
+        try:
+            return self._memo[key]
+        except KeyError:
+            pass
+
+        machine = (client or server).lower()
+        hwaddr = normalizeHWAddr(hwaddr)
+        best = min(self._names.get(machine, len(self._locations)),
+                   self._hwaddrs.get(hwaddr, len(self._locations)))
+        for lineno, names, hwaddrs in self._globs:
+            if lineno >= best:
+                break
+            if names.match(machine) or hwaddrs.match(hwaddr):
+                best = lineno
+                break
+
+        if best < len(self._locations):
+            location = self._locations[best]
+        else:
+            location = u''
+        self._memo[key] = location
+        return location
+
+locationMap = LocationMap()
+
+_commandResults = {} # {args: (time, deferred or location)}
+
+def _chain(d):
+    """
+    Return a new deferred called back with the result of d.
+    """
+    result = defer.Deferred()
+    def cb(location):
+        result.callback(location)
+        return location
+    d.addCallback(cb)
+    return result
+
+def _runCommand(command, args):
+    """
+    Run location command, e.g. sepiida-get-location, with args.
+    Results are remembered for COMMAND_TTL seconds, and concurrent lookups
+    of the same args share one process.
+    """
+    key = (command,) + args
+    try:
+        started, result = _commandResults[key]
+        if time.time() - started < COMMAND_TTL:
+            if isinstance(result, defer.Deferred):
+                return _chain(result)
+            return defer.succeed(result)
+    except KeyError:
+        pass
+
+    def cbSuccess(data):
+        out, err, retval = data
+        if retval == 0:
+            location = out.rstrip().decode('utf-8', 'replace')
+        else:
+            location = u''
+        _commandResults[key] = (started, location)
+        return location
+
+    def ebFailed(failure):
+        log.err(failure)
+        _commandResults.pop(key, None)
+        return u''
+
+    started = time.time()
+    d = utils.getProcessOutputAndValue(command,
+                    [x.encode('utf-8', 'replace') for x in args])
+    d.addCallbacks(cbSuccess, ebFailed)
+    _commandResults[key] = (started, d)
+    return _chain(d)
+
+def getLocation(servername, clientname, hwaddr):
+    """
+    Return a deferred which is called back with the location of a server
+    or client, from the locationmap or the command set in the option
+    [Server] location command.
+    """
+    cfg = config.configuration
+    if cfg.has_option('Server', 'location command'):
+        return _runCommand(cfg.get('Server', 'location command'),
+                           (servername, clientname, hwaddr))
+    return defer.succeed(locationMap.lookup(servername, clientname, hwaddr))
@@ -15,30 +15,33 @@
 # You should have received a copy of the GNU General Public License
 # along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
 
-from twisted.internet import protocol, reactor, defer, task, utils
-from twisted.python import log
+from twisted.internet import protocol, reactor, defer
+from twisted.python import log, failure
 from twisted.protocols import basic
 from twisted.conch import error
+from twisted.internet import error as ierror
 from twisted.conch.ssh import transport
-from twisted.conch.ssh import keys, userauth
+from twisted.conch.ssh import userauth
 from twisted.conch.ssh import connection
 from twisted.conch.ssh import channel, common, forwarding
-from twisted.conch.client.default import isInKnownHosts
 from twisted.application import service
 import sys
-try:
-    import json
-except:
-    import simplejson as json
 import time
 import config
+import location
+import sshkeys
+from sepiida import wire
+
+# {request: seconds}, default max age of results kept in
+# ServerFactory.results, see AgentProtocol._cachedResult
+MAX_AGES = {'thumbnails': 3, 'processes': 2}
 
 class ClientTransport(transport.SSHClientTransport):
     def verifyHostKey(self, pubkey, fingerprint):
         cfg = config.configuration
         name = self.factory.alias or self.factory.hostname
-        options = {'known-hosts': cfg.get('Server', 'known hosts')}
-        found = isInKnownHosts(name, pubkey, options)
+        knownHosts = sshkeys.knownHosts(cfg.get('Server', 'known hosts'))
+        found = knownHosts.check(name, pubkey)
         if found == 0:
             log.err('host key for %s not found' % name)
             return defer.fail(error.ConchError('host key for %s not found' % name))
@@ -61,10 +64,10 @@ class ClientUserAuth(userauth.SSHUserAuthClient):
     def getPublicKey(self):
         if self.lastPublicKey:
             return
-        return keys.Key.fromFile(filename=self.instance.factory.privkey+'.pub')
+        return sshkeys.loadKey(self.instance.factory.privkey+'.pub')
     
     def getPrivateKey(self):
-        return defer.succeed(keys.Key.fromFile(self.instance.factory.privkey))
+        return defer.succeed(sshkeys.loadKey(self.instance.factory.privkey))
 
 class ClientConnection(connection.SSHConnection):
 
@@ -104,7 +107,13 @@ class AgentProtocol(basic.Int32StringReceiver):
     def __init__(self, conn):
         self._nextid = 0 # next request ID
         self._requests = {} # dict mapping request ID to deferred/callback
+        self._cancelled = set() # request IDs whose responses are ignored
+        # see _sharedRequest
+        self._shared = {} # {(request, arg): [waiting deferreds]}
+        self._flights = {} # {(request, arg): (deferred, keys sent with it)}
         self.conn = conn
+        self.codec = wire.Codec()
+        self.features = []
         
         # There are three special request IDs:
         #  0: hello (contains "info", e.g. uptime and load)
@@ -112,6 +121,11 @@ class AgentProtocol(basic.Int32StringReceiver):
         # -2: updated info
         
         def cbHello(data):
+            if 'features' in data:
+                # the agent can decode these, tell it what we can decode
+                self.features = data.pop('features')
+                self.codec.setPeerFeatures(self.features)
+                self._sendRequest('features', list(wire.FEATURES), 0)
             self._requests[-1] = self.conn.factory.userInfoReceived
             self._requests[-2] = self.conn.factory.infoReceived
             self.conn.factory.connectionMade(self)
@@ -126,7 +140,12 @@ class AgentProtocol(basic.Int32StringReceiver):
         with the data returned.
         """
         log.debug('Response received: %s' % response)
-        agent_response = json.loads(response)
+        try:
+            agent_response = self.codec.decode(response)
+        except wire.StreamError, e:
+            log.msg('closing connection: %s' % e)
+            self.transport.loseConnection()
+            return
         
         try:
             requestID = agent_response['requestID']
@@ -140,7 +159,10 @@ class AgentProtocol(basic.Int32StringReceiver):
             else:
                 cbOrDeferred = self._requests.pop(requestID)
         except KeyError:
-            log.err('Received invalid requestID')
+            if requestID in self._cancelled: # timed out or cancelled
+                self._cancelled.discard(requestID)
+            else:
+                log.err('Received invalid requestID')
             return
         
         try:
@@ -168,25 +190,65 @@ class AgentProtocol(basic.Int32StringReceiver):
         pass
     
     def connectionLost(self):
-        pass
+        # fail the requests that won't be answered
+        for requestID, deferred in self._requests.items():
+            if not callable(deferred):
+                del self._requests[requestID]
+                deferred.errback(ierror.ConnectionLost())
         
-    def _sendRequest(self, request, args=[]):
+    def _sendRequest(self, request, args=[], timeout=None):
         """
         Send request to agent containing a requestID.
         Return deferred which is called back when a response is received
         containing the requestID.
+        The deferred fails with defer.TimeoutError if there's no response
+        within timeout seconds (by default the configured request timeout,
+        0 for none), and can be cancelled. In both cases the agent is told
+        to stop working on the request, if it supports it.
         """
-        deferred = defer.Deferred()
-        self._requests[self._nextid] = deferred
-        agent_request = json.dumps(
-          {'request': request, 'requestID': self._nextid,
+        requestID = self._nextid
+        deferred = defer.Deferred(lambda d: self._forget(requestID))
+        self._requests[requestID] = deferred
+        agent_request = self.codec.encode(
+          {'request': request, 'requestID': requestID,
            'args': args}
         )
         log.debug('Sending request: %s' % agent_request)
         self.sendString(agent_request)
         self._nextid += 1
+        
+        if timeout is None:
+            timeout = self.conn.factory.requestTimeout(request)
+        if timeout:
+            call = self.conn.factory.timers.callLater(timeout, self._timedOut,
+                                                      requestID, request)
+            def cancelTimer(result):
+                if call.active():
+                    call.cancel()
+                return result
+            deferred.addBoth(cancelTimer)
         return deferred
     
+    def _forget(self, requestID):
+        """
+        Stop waiting for the response to requestID, and ask the agent to
+        cancel it.
+        Returns the request's deferred, or None if it has been answered.
+        """
+        deferred = self._requests.pop(requestID, None)
+        if deferred is None:
+            return None
+        self._cancelled.add(requestID)
+        if 'cancel' in self.features:
+            self._sendRequest('cancel', [requestID], 0)
+        return deferred
+    
+    def _timedOut(self, requestID, request):
+        deferred = self._forget(requestID)
+        if deferred is not None:
+            log.msg('%s: %s request timed out' % (self.conn.factory, request))
+            deferred.errback(defer.TimeoutError(request))
+    
     def getUsers(self):
         """
         Send request for users.
@@ -194,12 +256,139 @@ class AgentProtocol(basic.Int32StringReceiver):
         deferred = self._sendRequest('users')
         return deferred
     
+    def _sharedRequest(self, request, args):
+        """
+        Send request, which only reads information about the users in args,
+        for the args that aren't already part of an identical request in
+        progress, e.g. sent for another client looking at the same users.
+        The result for each arg is shared by all the callers waiting for
+        it, each getting a copy. Results fetched recently are returned
+        without asking the agent, see _cachedResult.
+        Returns a deferred called back with the list of results in the
+        same order as args.
+        """
+        waiters = []
+        send = [] # [(key, arg)] not in progress
+        for arg in args:
+            result = self._cachedResult(request, arg)
+            if result is not None:
+                waiters.append(defer.succeed(result))
+                continue
+            key = (request, repr(sorted(arg.items())))
+            if key not in self._shared:
+                self._shared[key] = []
+                send.append((key, arg))
+            d = defer.Deferred(lambda d, key=key: self._stopWaiting(key, d))
+            self._shared[key].append(d)
+            waiters.append(d)
+        
+        if send:
+            keys = [key for key, arg in send]
+            deferred = self._sendRequest(request, [arg for key, arg in send])
+            deferred.addCallbacks(self._cbShared, self._ebShared,
+                                  callbackArgs=(request, send),
+                                  errbackArgs=(keys,))
+            for key in keys:
+                self._flights[key] = (deferred, keys)
+        
+        deferred = defer.DeferredList(waiters, fireOnOneErrback=True,
+                                      consumeErrors=True)
+        deferred.addCallbacks(lambda results: [r for ok, r in results],
+                              lambda failure: failure.value.subFailure)
+        return deferred
+    
+    def _cbShared(self, data, request, send):
+        if not isinstance(data, list) or len(data) != len(send) or \
+           [result for result in data if not isinstance(result, dict)]:
+            # e.g. an error response, with no data
+            log.err('invalid response to %s request' % request)
+            self._ebShared(failure.Failure(ValueError('invalid response')),
+                           [key for key, arg in send])
+            return
+        for (key, arg), result in zip(send, data):
+            self._storeResult(request, arg, result)
+            del self._flights[key]
+            for d in self._shared.pop(key):
+                d.callback(dict(result))
+    
+    def _ebShared(self, failure, keys):
+        for key in keys:
+            del self._flights[key]
+            for d in self._shared.pop(key):
+                d.errback(failure)
+    
+    def _stopWaiting(self, key, d):
+        """
+        Canceller of the deferreds returned by _sharedRequest, which
+        cancels the agent request when nobody waits for it any more.
+        """
+        self._shared[key].remove(d)
+        deferred, keys = self._flights[key]
+        if not [k for k in keys if self._shared[k]]:
+            deferred.cancel()
+    
+    def _resultKey(self, request, arg):
+        factory = self.conn.factory
+        return (request, (arg['username'], factory.hostname,
+                          arg['client'], arg['display']))
+    
+    def _cachedResult(self, request, arg):
+        """
+        Return a copy of the result for arg if it was fetched less than
+        the request's max age ago, otherwise None. If arg has the token or
+        version of the cached result, the thumbnail or process list is
+        left out as the agent would have done.
+        Process lists are only returned for args without since or with the
+        cached version, as the client may have a newer list than the cache.
+        """
+        maxAge = self.conn.factory.resultMaxAge(request)
+        if not maxAge:
+            return None
+        result = self.conn.factory.serverFactory.results.get(
+                        self._resultKey(request, arg), maxAge)
+        if result is None:
+            return None
+        since = arg.get('since')
+        if request == 'processes' and since is not None and \
+           since != result['version']:
+            return None
+        result = dict(result)
+        if request == 'thumbnails' and arg.get('token') == result['token']:
+            del result['thumbnail']
+            result['notmodified'] = True
+        elif request == 'processes' and since is not None:
+            del result['processes']
+            result['added'] = []
+            result['removed'] = []
+        return result
+    
+    def _storeResult(self, request, arg, result):
+        """
+        Keep a result received from the agent, if it's complete, or
+        refresh the cached result if the agent says it's unchanged.
+        """
+        if not self.conn.factory.resultMaxAge(request) or 'error' in result:
+            return
+        results = self.conn.factory.serverFactory.results
+        key = self._resultKey(request, arg)
+        if 'thumbnail' in result or 'processes' in result:
+            results.put(key, dict(result))
+            return
+        cached = results.peek(key)
+        if cached is None:
+            return
+        if request == 'thumbnails' and result.get('notmodified') and \
+           cached['token'] == arg.get('token'):
+            results.put(key, cached)
+        elif request == 'processes' and cached['version'] == arg.get('since') \
+             and not result.get('added') and not result.get('removed'):
+            results.put(key, dict(cached, version=result['version']))
+    
     def getProcesses(self, args):
         """
         Send request for processes.
         """
-        deferred = self._sendRequest('processes', args)
-        return deferred
+        return self._sharedRequest('processes', args)
     
     def killProcesses(self, args):
         """
@@ -212,7 +401,7 @@ class AgentProtocol(basic.Int32StringReceiver):
         """
         Send request to get thumbnails.
         """
-        return self._sendRequest('thumbnails', args)
+        return self._sharedRequest('thumbnails', args)
     
     def openSSHForwarding(self, port):
         """
@@ -351,9 +540,16 @@ class User(object):
 
 class PollerFactory(protocol.ClientFactory):
     protocol = ClientTransport
+    # seconds without info from the agent before the connection is closed
+    watchdogTimeout = 15
     
-    def __init__(self, hostname, alias):
+    def __init__(self, hostname, alias, serverFactory):
+        """
+        serverFactory is notified of changes, and its timers are used for
+        the watchdog.
+        """
         self.deferred = None
+        self.serverFactory = serverFactory
         self.hostname = hostname
         self.alias = alias # host key alias
         self.stopped = False
@@ -369,7 +565,30 @@ class PollerFactory(protocol.ClientFactory):
         self.os = None
         self.location = None
         self.lastResponse = None
-        self._watchdogCall = task.LoopingCall(self._watchdog)
+        self.timers = serverFactory.timers
+        self._watchdogCall = None
+    
+    def requestTimeout(self, request):
+        """
+        Return the number of seconds to wait for a response to request,
+        from the "<request> timeout" or "request timeout" options.
+        """
+        cfg = config.configuration
+        for option in ('%s timeout' % request, 'request timeout'):
+            if cfg.has_option('Server', option):
+                return cfg.getfloat('Server', option)
+        return 30
+    
+    def resultMaxAge(self, request):
+        """
+        Return the number of seconds results of request are reused for,
+        from the "<request> max age" option, 0 if they're not kept.
+        """
+        cfg = config.configuration
+        option = '%s max age' % request
+        if cfg.has_option('Server', option):
+            return cfg.getfloat('Server', option)
+        return MAX_AGES.get(request, 0)
     
     def userInfoReceived(self, userinfo):
         users = {}
@@ -399,41 +618,38 @@ class PollerFactory(protocol.ClientFactory):
                 user.location = ''
                 users[ukey] = user
             
-            def cbGotLocation(location, user=user):
-                user.location = location
+            def cbGotLocation(location, user=user, ukey=ukey):
+                if location != user.location:
+                    user.location = location
+                    self.serverFactory.usersChanged(self, [ukey])
             
-            d = self._getLocation(self.hostname, client, clientHWAddr)
+            d = location.getLocation(self.hostname, client, clientHWAddr)
             d.addCallback(cbGotLocation)
             
+        changed = set(self.users) ^ set(users) # logged in or out
+        self._discardResults(set(self.users) - set(users))
         self.users = users
-    
-    def _getLocation(self, servername, clientname, hwaddr):
-        def cbSuccess(data):
-            out, err, retval = data
-            if retval == 0:
-                return out.rstrip().decode('utf-8', 'replace')
-            else:
-                return u''
-            
-        args = [x.encode('utf-8', 'replace') for x in 
-                (servername, clientname, hwaddr)]
-        d = utils.getProcessOutputAndValue('/usr/bin/sepiida-get-location', args)
-        d.addCallback(cbSuccess)
-        return d
+        self.serverFactory.usersChanged(self, changed)
         
     def infoReceived(self, data):
         # {'uptime': 1234567890, 'load': 0.50, 'os': 'linux2'}
-        self.uptime = int(data['uptime'])
-        self.load = float(data['load'])
+        info = (int(data['uptime']), float(data['load']), data['os'])
         self.lastResponse = time.time()
-        self.os = data['os']
+        if info != (self.uptime, self.load, self.os):
+            self.uptime, self.load, self.os = info
+            self.serverFactory.serversChanged(self)
         
     def connectionMade(self, agentProtocol):
         self.agentProtocol = agentProtocol
+        changed = self.users.keys()
         self.users.clear()
         self.connected = True
-        self.deferred.callback(self)
-        self._watchdogCall.start(10.0, False)
+        self.serverFactory.usersChanged(self, changed)
+        if not self.deferred.called:
+            self.deferred.callback(self)
+        self.lastResponse = time.time()
+        self._watchdogCall = self.timers.callLater(self.watchdogTimeout,
+                                                   self._watchdog)
     
     def clientConnectionFailed(self, connector, reason):
         #log.err('%s: connection failed: %s' % (self, reason))
@@ -444,6 +660,9 @@ class PollerFactory(protocol.ClientFactory):
     
     def clientConnectionLost(self, connector, reason):
         log.msg('%s: lost connection: %s' % (self, reason))
+        # lost before connecting to the agent, e.g. host key not found
+        if not self.deferred.called:
+            self.deferred.errback(reason)
     
     def __repr__(self):
         return 'PollerFactory("%s")' % self.hostname
@@ -454,19 +673,38 @@ class PollerFactory(protocol.ClientFactory):
         
         def cbLocation(location):
             self.location = location
-        d = self._getLocation(self.hostname, '', '')
+            self.serverFactory.serversChanged(self)
+        d = location.getLocation(self.hostname, '', '')
         d.addCallback(cbLocation)
     
     def stopFactory(self):
         self.stopped = True
         self.connected = False
+        self._discardResults(self.users)
+        self.serverFactory.usersChanged(self, self.users.keys())
         self.connecting = False
-        if self._watchdogCall.running:
-            self._watchdogCall.stop()
+        if self._watchdogCall and self._watchdogCall.active():
+            self._watchdogCall.cancel()
+    
+    def _discardResults(self, ukeys):
+        """
+        Forget the cached results for users ukeys, e.g. after logging out.
+        """
+        for ukey in ukeys:
+            for request in MAX_AGES:
+                self.serverFactory.results.discard((request, ukey))
     
     def _watchdog(self):
+        """
+        Called by the timer. lastResponse isn't tracked by the timer, so
+        if a response has been received since it was set, it's set again
+        to expire watchdogTimeout seconds after that response.
+        """
         now = time.time()
-        if (now - self.lastResponse) > 15:
-            log.err('%s: no response, closing connection' % self)
-            self.agentProtocol.conn.transport.loseConnection()
-            self.stopFactory()
+        if (now - self.lastResponse) < self.watchdogTimeout:
+            self._watchdogCall = self.timers.callAt(
+                    self.lastResponse + self.watchdogTimeout, self._watchdog)
+            return
+        log.err('%s: no response, closing connection' % self)
+        self.agentProtocol.conn.transport.loseConnection()
+        self.stopFactory()
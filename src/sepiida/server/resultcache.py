@@ -0,0 +1,87 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from sepiida import wire
+import time
+
+def resultSize(value):
+    """
+    Return roughly how many bytes value, a decoded agent response, uses.
+    """
+    if isinstance(value, wire.Binary):
+        return len(value.data) + 32
+    elif isinstance(value, (str, unicode)):
+        return len(value) + 32
+    elif isinstance(value, dict):
+        return sum(resultSize(k) + resultSize(v) for k, v in value.iteritems()) + 64
+    elif isinstance(value, (list, tuple)):
+        return sum(resultSize(v) for v in value) + 32
+    return 16
+
+class ResultCache(object):
+    """
+    Recently fetched results of agent requests, e.g. thumbnails and process
+    lists keyed by (request, ukey), so that requests for the same users
+    within a few seconds don't go to the agent again.
+    The least recently used results are removed when they use more than
+    maxSize bytes (as estimated by resultSize).
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.size = 0
+        self._results = OrderedDict() # {key: (time, result, size)}, oldest first
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, key, maxAge):
+        """
+        Return the result for key if it was fetched less than maxAge seconds
+        ago, otherwise None.
+        """
+        entry = self._results.get(key)
+        if entry is None or time.time() - entry[0] >= maxAge:
+            return None
+        # most recently used
+        del self._results[key]
+        self._results[key] = entry
+        return entry[1]
+
+    def peek(self, key):
+        """
+        Return the result for key regardless of its age, or None.
+        """
+        entry = self._results.get(key)
+        if entry is not None:
+            return entry[1]
+
+    def put(self, key, result):
+        self.discard(key)
+        size = resultSize(result)
+        if size > self.maxSize:
+            return
+        self._results[key] = (time.time(), result, size)
+        self.size += size
+        while self.size > self.maxSize:
+            oldest, (t, r, s) = self._results.popitem(last=False)
+            self.size -= s
+
+    def discard(self, key):
+        entry = self._results.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
@@ -0,0 +1,130 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import reactor, defer
+from twisted.python import log
+from collections import deque
+import random
+import time
+
+class ConnectionScheduler(object):
+    """
+    Schedules connection attempts to hosts, so that only a limited number of
+    SSH handshakes are in progress at a time.
+    Admission starts with initialWindow concurrent attempts, which grows by
+    one for each successful connection up to maxConcurrent (slow start).
+    Hosts which fail to connect are not attempted again for an exponentially
+    increasing, jittered delay, from minBackoff up to maxBackoff seconds.
+    Attempts taking more than timeout seconds are cancelled.
+    connect is called with a host and should return a deferred which is
+    called back when connected, or errbacked on failure.
+    """
+    def __init__(self, connect, maxConcurrent=20, initialWindow=2,
+                 minBackoff=30.0, maxBackoff=3600.0, timeout=60.0):
+        self.connect = connect
+        self.maxConcurrent = maxConcurrent
+        self.initialWindow = min(initialWindow, maxConcurrent)
+        self.window = self.initialWindow
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.timeout = timeout
+        self._queue = deque()
+        self._queued = set()
+        self._active = set()
+        self._backoff = {} # {host: (failures, time of next attempt)}
+        self._pumping = False
+        self.clock = reactor
+
+    def schedule(self, host):
+        """
+        Queue a connection attempt to host, unless it is already queued or
+        connecting, or it's backing off after failing.
+        Returns True if queued.
+        """
+        if host in self._queued or host in self._active:
+            return False
+        failures, nextAttempt = self._backoff.get(host, (0, 0))
+        if nextAttempt > time.time():
+            return False
+        self._queue.append(host)
+        self._queued.add(host)
+        self._pump()
+        return True
+
+    def retain(self, hosts):
+        """
+        Forget the failures of hosts not in hosts, e.g. after they've been
+        removed from the configuration.
+        """
+        for host in self._backoff.keys():
+            if host not in hosts:
+                del self._backoff[host]
+
+    def stats(self):
+        """
+        Return a dict with the number of hosts queued, connecting and
+        backing off, and the current admission window.
+        """
+        now = time.time()
+        return {'queued': len(self._queue),
+                'connecting': len(self._active),
+                'backoff': len([h for h, (f, t) in self._backoff.iteritems() if t > now]),
+                'window': self.window}
+
+    def _pump(self):
+        if self._pumping: # attempt failed at once, called from _start
+            return
+        self._pumping = True
+        try:
+            while self._queue and len(self._active) < self.window:
+                host = self._queue.popleft()
+                self._queued.discard(host)
+                self._start(host)
+        finally:
+            self._pumping = False
+
+    def _start(self, host):
+        self._active.add(host)
+        try:
+            d = self.connect(host)
+        except Exception:
+            log.err()
+            d = defer.fail()
+        timeoutCall = self.clock.callLater(self.timeout, d.cancel)
+
+        def done(result):
+            if timeoutCall.active():
+                timeoutCall.cancel()
+            self._active.discard(host)
+            self._pump()
+
+        d.addCallbacks(self._succeeded, self._failed,
+                       callbackArgs=(host,), errbackArgs=(host,))
+        d.addBoth(done)
+
+    def _succeeded(self, result, host):
+        self._backoff.pop(host, None)
+        if self.window < self.maxConcurrent:
+            self.window += 1
+
+    def _failed(self, failure, host):
+        failures = self._backoff.get(host, (0, 0))[0] + 1
+        delay = min(self.maxBackoff, self.minBackoff * 2 ** min(failures - 1, 30))
+        # randomize, so that hosts which failed together (e.g. a switch
+        # was down) are spread out when retried
+        delay *= random.uniform(0.5, 1.0)
+        self._backoff[host] = (failures, time.time() + delay)
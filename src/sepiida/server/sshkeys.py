@@ -0,0 +1,153 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The SSH key and known hosts used to connect to the agents, read once and
+kept in memory until the files change, instead of on every connection.
+"""
+
+from twisted.conch.ssh import common, keys
+from twisted.python import log
+from base64 import b64decode
+import binascii
+import hashlib
+import hmac
+import os
+import time
+
+_HASHED = '|1|'
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class KnownHosts(object):
+    """
+    A known_hosts file (OpenSSH format, including hashed hostnames),
+    indexed by hostname.
+    The file is read again if it has changed, this is checked at most every
+    checkInterval seconds.
+    """
+    def __init__(self, path, checkInterval=10.0):
+        self.path = os.path.expanduser(path)
+        self.checkInterval = checkInterval
+        self._mtime = None
+        self._checkedAt = 0
+        self._clear()
+
+    def _clear(self):
+        self._hosts = {} # {hostname: [(key type, key)]}
+        self._hashed = [] # [(salt, hash, key type, key)]
+        self._memo = {} # {hostname: [(key type, key)]}, including hashed
+
+    def _check(self):
+        now = time.time()
+        if now - self._checkedAt < self.checkInterval:
+            return
+        self._checkedAt = now
+        mtime = _mtime(self.path)
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._load()
+
+    def _load(self):
+        self._clear()
+        try:
+            f = open(self.path, 'rb')
+        except IOError, e:
+            log.msg('failed to read known hosts: %s' % e)
+            return
+        for line in f:
+            split = line.split()
+            if len(split) < 3 or split[0].startswith('#') or \
+               split[0].startswith('@'): # markers aren't supported
+                continue
+            hosts, keyType, encodedKey = split[:3]
+            try:
+                key = (keyType, b64decode(encodedKey))
+            except (TypeError, binascii.Error):
+                continue
+            for host in hosts.split(','):
+                if host.startswith(_HASHED):
+                    try:
+                        salt, hash = host[len(_HASHED):].split('|')
+                        self._hashed.append((b64decode(salt), b64decode(hash)) + key)
+                    except (ValueError, TypeError, binascii.Error):
+                        continue
+                else:
+                    self._hosts.setdefault(host, []).append(key)
+        f.close()
+
+    def _keys(self, host):
+        try:
+            return self._memo[host]
+        except KeyError:
+            pass
+        found = list(self._hosts.get(host, ()))
+        for salt, hash, keyType, key in self._hashed:
+            if hmac.new(salt, host, hashlib.sha1).digest() == hash:
+                found.append((keyType, key))
+        self._memo[host] = found
+        return found
+
+    def check(self, host, pubKey):
+        """
+        Return 0 if there's no key for host, 1 if pubKey is one of its keys,
+        or 2 if the host has another key of the same type (it has changed),
+        as twisted.conch.client.default.isInKnownHosts.
+        """
+        self._check()
+        keyType = common.getNS(pubKey)[0]
+        found = 0
+        for hostKeyType, key in self._keys(host):
+            if hostKeyType != keyType:
+                continue
+            if key == pubKey:
+                return 1
+            found = 2
+        return found
+
+_knownHosts = {} # {path: KnownHosts}
+
+def knownHosts(path):
+    """
+    Return the KnownHosts for path, shared by all connections.
+    """
+    try:
+        return _knownHosts[path]
+    except KeyError:
+        kh = _knownHosts[path] = KnownHosts(path)
+        return kh
+
+_keys = {} # {path: (mtime, Key)}
+
+def loadKey(path):
+    """
+    Return the Key in file path, read again only if the file has changed.
+    """
+    mtime = _mtime(path)
+    try:
+        loaded, key = _keys[path]
+        if loaded == mtime:
+            return key
+    except KeyError:
+        pass
+    key = keys.Key.fromFile(path)
+    _keys[path] = (mtime, key)
+    return key
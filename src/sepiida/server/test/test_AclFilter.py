@@ -13,6 +13,7 @@ class TestAclFilter(unittest.TestCase):
         import grp
         grp.getgrnam = minimock.Mock('grp.getgrnam', tracker=None)
         grp.getgrnam.mock_returns = grp.struct_group(('fakegroup', 'x', -1, ['fakeuser']))
+        AclFilter._groupCache.clear()
         self.acl = AclFilter.ACL()
     
     def tearDown(self):
@@ -51,6 +52,17 @@ class TestAclFilter(unittest.TestCase):
         self.assertTrue(self.acl.appliesTo('fakeuser'))
         self.assertFalse(self.acl.appliesTo('anotherfakeuser'))
     
+    def test_groupMembers_cached(self):
+        import grp
+        self.acl.parse('@fakegroup', 'ALL: ALL')
+        self.assertTrue(self.acl.appliesTo('fakeuser'))
+        grp.getgrnam.mock_returns = grp.struct_group(('fakegroup', 'x', -1, []))
+        self.assertTrue(self.acl.appliesTo('fakeuser'))
+        
+        fetched, members = AclFilter._groupCache['fakegroup']
+        AclFilter._groupCache['fakegroup'] = (fetched - AclFilter.GROUP_TTL, members)
+        self.assertFalse(self.acl.appliesTo('fakeuser'))
+    
     def test_requestAllowed_only_request(self):
         self.acl.parse('fakeuser', 'ALL: listUsers')
         self.assertTrue(self.acl.requestAllowed('listusers'))
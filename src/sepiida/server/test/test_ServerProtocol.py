@@ -2,6 +2,7 @@ from twisted.trial import unittest
 from twisted.python import log
 from twisted.internet import defer
 from sepiida.server import ServerFactory, ServerProtocol, AclFilter, config
+from sepiida import wire
 import minimock
 log.debug = lambda *args: ''
 
@@ -18,6 +19,9 @@ class Transport(object):
     
     def loseConnection(self):
         self.lostConnection = True
+    
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
 
 class Server(object):
     pass
@@ -29,11 +33,12 @@ class TestServerProtocol(unittest.TestCase):
     def setUp(self):
         import pwd
         import struct
-        pwd.getpwuid = minimock.Mock('pwd.getpwuid', tracker=None)
-        pwd.getpwuid.mock_returns = pwd.struct_passwd(('fakeuser', 'x', 123, 123, 'gecos', 'homedir', 'shell'))
+        minimock.mock('pwd.getpwuid', tracker=None,
+            returns=pwd.struct_passwd(('fakeuser', 'x', 123, 123, 'gecos', 'homedir', 'shell')))
         
-        struct.unpack = minimock.Mock('struct.unpack', tracker=None)
-        struct.unpack.mock_returns = 0, 123, 123 # pid, uid, gid
+        # restored in tearDown, as struct is used by twisted.conch too
+        minimock.mock('struct.unpack', tracker=None,
+                      returns=(0, 123, 123)) # pid, uid, gid
         
         config.configuration.remove_section('ACL')
         config.configuration.add_section('ACL')
@@ -59,7 +64,8 @@ class TestServerProtocol(unittest.TestCase):
         s.uptime = 0
         s.load = 0.0
         s.os = 'linux2'
-        s.users = {(testUser.username, testUser.server, testUser.client, testUser.display): testUser}
+        self.testUkey = (testUser.username, testUser.server, testUser.client, testUser.display)
+        s.users = {self.testUkey: testUser}
         s.connected = True
         s.location = u'room0'
         s.agentProtocol = minimock.Mock('agentProtocol', tracker=None)
@@ -78,6 +84,7 @@ class TestServerProtocol(unittest.TestCase):
         s.agentProtocol.shutdown.mock_returns = defer.succeed({})
         
         sp.factory.servers = {'ltspserver00': s}
+        sp.factory.rebuildIndex()
         sp.transport = Transport()
     
     def tearDown(self):
@@ -104,6 +111,7 @@ class TestServerProtocol(unittest.TestCase):
         self.assertFalse('error' in udict)
         
         self.testUser.groups = ['anothergroup']
+        self.sp.factory.usersChanged(self.testServer, [self.testUkey]) # as done by the poller
         self.assertTrue(self.sp._preFilter(self.sp._handleSendmessage, 0, 'sendmessage', args))
         self.assertTrue('error' in udict)
         
@@ -123,6 +131,7 @@ class TestServerProtocol(unittest.TestCase):
         
         # no users on server, therefore OK
         self.testServer.users = {}
+        self.sp.factory.usersChanged(self.testServer, [self.testUkey])
         args = [{'server': 'ltspserver00'}]
         self.assertTrue(self.sp._preFilter(self.sp._handleListservers, 0, 'listservers', args))
         self.assertFalse('error' in args[0])
@@ -143,6 +152,7 @@ class TestServerProtocol(unittest.TestCase):
         
         # but not members of anothergroup, should be filtered
         self.testUser.groups = ['anothergroup']
+        self.sp.factory.usersChanged(self.testServer, [self.testUkey])
         data = [self.sp._getUkey(self.testUser)]
         data = self.sp._postFilter(data, 'listusers', 'user')
         self.assert_(len(data) == 0)
@@ -180,14 +190,15 @@ class TestServerProtocol(unittest.TestCase):
         self.assertRaises(ValueError, self.sp._parseRequest, invalidReq3)
         
         luReq = '{"args": [], "request": "listUsers"}'
-        handler, reqName, args = self.sp._parseRequest(luReq)
+        handler, reqName, args, request = self.sp._parseRequest(luReq)
         self.assertEqual(handler, self.sp._handleListusers)
         self.assertEqual(reqName.lower(), 'listusers')
         self.assertEqual(args, [])
+        self.assertEqual(request, {'args': [], 'request': 'listUsers'})
         
         lpReq = '''{"args": [{"username": "a", "client": "", "display": ":0",
         "server": "b"}], "request": "listProcesses"}'''
-        handler, reqName, args = self.sp._parseRequest(lpReq)
+        handler, reqName, args, request = self.sp._parseRequest(lpReq)
         self.assertEqual(handler, self.sp._handleListprocesses)
         self.assertEqual(reqName.lower(), 'listprocesses')
         self.assertEqual(args, [{"username": "a", "client": "", "display":
@@ -215,12 +226,14 @@ class TestServerProtocol(unittest.TestCase):
         lpReq = '''{"args": [{"username": "testuser", "client": "ltsp200", "display": ":1234",
         "server": "ltspserver00"}], "request": "listProcesses"}'''
         self.testUser.groups = ['anothergroup'] # so that the ACL won't match
+        self.sp.factory.usersChanged(self.testServer, [self.testUkey])
         self.sp._requestReceived(lpReq)
         self.assertIn('"error": "notfound"', self.sp.transport.written)
         
         # check that the handler is called
         self.sp.transport.written = ''
         self.testUser.groups = ['testgroup'] # now the ACL will match
+        self.sp.factory.usersChanged(self.testServer, [self.testUkey])
         self.sp._requestReceived(lpReq)
         self.assertIn('"error": ""', self.sp.transport.written)
         
@@ -234,6 +247,7 @@ class TestServerProtocol(unittest.TestCase):
         # testuser should be filtered, as the ACL is changed not to match
         self.sp.transport.written = ''
         self.testUser.groups = ['anothergroup']
+        self.sp.factory.usersChanged(self.testServer, [self.testUkey]) # as done by the poller
         self.sp._requestReceived(luReq)
         self.assertNotIn('"username": "testuser"', self.sp.transport.written)
     
@@ -298,4 +312,326 @@ class TestServerProtocol(unittest.TestCase):
         d.addCallback(cbSuccess)
         self.sp._handleShutdown(d, 1, 'shutdown', [{'server': 'ltspserver00', 'action': 'erroneous'}])
         return d
-    
\ No newline at end of file
+        
+    def test_features(self):
+        from sepiida import wire
+        config.configuration.set('ACL', 'fakeuser', '@testgroup: listUsers')
+        self.sp.connectionMade()
+        self.assertIn('"features": ["binary", "zlib", "compact", "batch", "since", "subscribe", "cancel", "stream"]', self.sp.transport.written)
+        
+        # allowed regardless of ACL
+        self.sp.transport.written = ''
+        self.sp._requestReceived('{"args": ["binary", "unknown"], "request": "features"}')
+        self.assertIn('"error": ""', self.sp.transport.written)
+        self.assertEqual(self.sp.codec.features, frozenset(['binary']))
+        
+        self.sp.transport.written = ''
+        self.sp._sendResponse([{'thumbnail': wire.Binary('jpeg')}], 'getThumbnails', 1)
+        self.assertEqual(self.sp.transport.written[4], wire.BLOB_FRAME)
+        self.assertTrue(self.sp.transport.written.endswith('\x00\x00\x00\x04jpeg'))
+    
+    def test_corruptStream(self):
+        self.sp.connectionMade()
+        self.sp.transport.written = ''
+        self.sp._requestReceived(wire.ZLIB_FRAME + 'invalid')
+        self.assertTrue(self.sp.transport.lostConnection)
+        self.assertEqual(self.sp.transport.written, '')
+    
+    def test_batch(self):
+        import json
+        config.configuration.set('ACL', 'fakeuser', '@testgroup: listUsers listServers')
+        self.sp.connectionMade()
+        self.sp.transport.written = ''
+        self.sp._requestReceived(json.dumps({'request': 'batch', 'args': [
+            {'request': 'listUsers', 'args': []},
+            {'request': 'login', 'args': [{'server': 'ltspserver00'}]},
+            {'request': 'invalid', 'args': []},
+            {'request': 'batch', 'args': []},
+            {'request': 'listServers', 'args': []}]}))
+        response = json.loads(self.sp.transport.written[4:])
+        self.assertEqual(response['request'], 'batch')
+        self.assertEqual(response['error'], '')
+        results = response['data']
+        self.assertEqual([r['request'] for r in results],
+                         ['listUsers', 'login', '', '', 'listServers'])
+        self.assertEqual([r['error'] for r in results],
+                         ['', 'notauthorized', 'invalid', 'invalid', ''])
+        self.assertEqual(results[0]['data'][0]['username'], 'testuser')
+        self.assertEqual(results[4]['data'][0]['server'], 'ltspserver00')
+        
+        # sub-requests are filtered by the ACL like other requests
+        self.testUser.groups = ['anothergroup']
+        self.sp.factory.usersChanged(self.testServer, [self.testUkey])
+        self.sp.transport.written = ''
+        self.sp._requestReceived('{"request": "batch", "args": [{"request": "listUsers", "args": []}]}')
+        self.assertEqual(json.loads(self.sp.transport.written[4:])['data'][0]['data'], [])
+    
+    def test_handleStatus(self):
+        d = defer.Deferred()
+        self.sp._handleStatus(d, 1, 'status', [])
+        def cbSuccess(result):
+            self.assertEqual(result, [{'servers': 1, 'connected': 1, 'connecting': 0,
+                                       'queued': 0, 'backoff': 0, 'window': 2}])
+        d.addCallback(cbSuccess)
+        return d
+    
+    def test_snapshot(self):
+        import json
+        config.configuration.set('ACL', 'fakeuser', '@testgroup: listUsers')
+        self.sp.connectionMade()
+        luReq = '{"args": [], "request": "listUsers"}'
+        self.sp._requestReceived(luReq)
+        self.sp.transport.written = ''
+        
+        # served from the snapshot while the users are unchanged
+        self.testUser.name = 'Changed'
+        self.sp._requestReceived(luReq)
+        response = json.loads(self.sp.transport.written[4:])
+        self.assertEqual(response['data'][0]['name'], 'Test User')
+        self.assertEqual(response['requestID'], 2)
+        
+        self.sp.factory.usersChanged(self.testServer, [self.testUkey])
+        self.sp.transport.written = ''
+        self.sp._requestReceived(luReq)
+        self.assertIn('"name": "Changed"', self.sp.transport.written)
+        
+        # only the current responses are kept
+        self.assertEqual(len(self.sp.factory._snapshots), 1)
+        self.sp.factory.serversChanged(self.testServer)
+        self.assertEqual(len(self.sp.factory._snapshots), 1)
+        self.sp.factory.usersChanged(self.testServer, [self.testUkey])
+        self.assertEqual(self.sp.factory._snapshots, {})
+    
+    def test_since(self):
+        import json
+        config.configuration.set('ACL', 'fakeuser', '@testgroup: listUsers listServers')
+        self.sp.connectionMade()
+        def request(reqName, since):
+            self.sp.transport.written = ''
+            self.sp._requestReceived(json.dumps({'request': reqName, 'args': [],
+                                                 'since': since}))
+            return json.loads(self.sp.transport.written[4:])['data']
+        
+        # unknown version, all users are returned
+        data = request('listUsers', 'invalid')
+        self.assertEqual([u['username'] for u in data['users']], ['testuser'])
+        version = data['version']
+        self.assertEqual(request('listUsers', version),
+                         {'version': version, 'added': [], 'removed': []})
+        
+        user = User()
+        user.__dict__.update(self.testUser.__dict__)
+        user.username = 'testuser2'
+        ukey = (user.username, user.server, user.client, user.display)
+        self.testServer.users[ukey] = user
+        self.sp.factory.usersChanged(self.testServer, [ukey])
+        data = request('listUsers', version)
+        self.assertEqual([u['username'] for u in data['added']], ['testuser2'])
+        self.assertEqual(data['removed'], [])
+        
+        del self.testServer.users[ukey]
+        self.sp.factory.usersChanged(self.testServer, [ukey])
+        data = request('listUsers', data['version'])
+        self.assertEqual(data['added'], [])
+        self.assertEqual(data['removed'], [{'username': 'testuser2',
+                'server': 'ltspserver00', 'client': 'ltsp200', 'display': ':1234'}])
+        
+        # the number of users is included in listServers
+        data = request('listServers', None)
+        self.assertEqual(data[0]['users'], 1)
+        data = request('listServers', version)
+        self.assertEqual(data['servers'][0]['users'], 1)
+        self.testServer.load = 1.0
+        self.sp.factory.serversChanged(self.testServer)
+        data = request('listServers', data['version'])
+        self.assertEqual([s['load'] for s in data['added']], [1.0])
+    
+    def test_subscribe(self):
+        import json
+        from twisted.internet import task
+        config.configuration.set('ACL', 'fakeuser', '@testgroup: listUsers')
+        self.sp.factory.clock = clock = task.Clock()
+        self.sp.connectionMade()
+        self.sp.transport.written = ''
+        self.sp._requestReceived('{"request": "subscribe", "args": ["users", "servers"]}')
+        self.assertEqual(json.loads(self.sp.transport.written[4:])['data'], ['users'])
+        self.assertEqual(self.sp.factory.subscribers, set([self.sp]))
+        
+        # a burst of changes is pushed at once
+        self.sp.transport.written = ''
+        self.testUser.name = 'Changed'
+        ukey = ('testuser', 'ltspserver00', 'ltsp200', ':1234')
+        self.sp.factory.usersChanged(self.testServer, [ukey])
+        self.sp.factory.usersChanged(self.testServer, [ukey])
+        self.assertEqual(self.sp.transport.written, '')
+        clock.advance(self.sp.factory.pushDelay)
+        response = json.loads(self.sp.transport.written[4:])
+        self.assertEqual(response['requestID'], -1)
+        self.assertEqual(response['request'], 'listUsers')
+        self.assertEqual([u['name'] for u in response['data']['added']], ['Changed'])
+        
+        # nothing is sent for changes to servers only
+        self.sp.transport.written = ''
+        self.sp.factory.serversChanged(self.testServer)
+        clock.advance(self.sp.factory.pushDelay)
+        self.assertEqual(self.sp.transport.written, '')
+        
+        self.sp.connectionLost(None)
+        self.assertEqual(self.sp.factory.subscribers, set())
+    
+    def test_pushSharedEncoding(self):
+        import json
+        from twisted.internet import task
+        config.configuration.set('ACL', 'fakeuser', '@testgroup: listUsers')
+        factory = self.sp.factory
+        factory.clock = clock = task.Clock()
+        subscribers = []
+        for i in range(3):
+            sp = ServerProtocol()
+            sp.factory = factory
+            sp.transport = Transport()
+            sp.connectionMade()
+            self.assertEqual(sp.transport.producer, sp)
+            sp._requestReceived('{"request": "subscribe", "args": ["users"]}')
+            sp.transport.written = ''
+            subscribers.append(sp)
+        
+        sent = []
+        encode = wire.Codec.encode
+        def trackingEncode(codec, message):
+            sent.append(message['data'])
+            return encode(codec, message)
+        wire.Codec.encode = trackingEncode
+        try:
+            subscribers[2].pauseProducing()
+            self.testUser.name = 'Changed'
+            factory.usersChanged(self.testServer,
+                                 [('testuser', 'ltspserver00', 'ltsp200', ':1234')])
+            clock.advance(factory.pushDelay)
+        finally:
+            wire.Codec.encode = encode
+        
+        # one message for the connections with the same view
+        self.assertEqual(len(sent), 2)
+        self.assertTrue(sent[0] is sent[1])
+        self.assertEqual(subscribers[0].transport.written,
+                         subscribers[1].transport.written)
+        
+        # the paused connection gets the changes when resumed
+        self.assertEqual(subscribers[2].transport.written, '')
+        subscribers[2].resumeProducing()
+        response = json.loads(subscribers[2].transport.written[4:])
+        self.assertEqual(response['data']['added'][0]['name'], 'Changed')
+    
+    def test_visibility(self):
+        config.configuration.set('ACL', 'fakeuser', 'sameLocation: listUsers listServers')
+        self.sp.connectionMade()
+        self.assertTrue(self.sp._allowed('listUsers', self.testUser))
+        self.assertFalse(self.sp._allowed('login', self.testUser))
+        
+        # fakeuser logs in in room1, only users there are visible
+        user = User()
+        user.__dict__.update(self.testUser.__dict__)
+        user.username = 'fakeuser'
+        user.location = 'room1'
+        ukey = (user.username, user.server, user.client, user.display)
+        self.testServer.users[ukey] = user
+        self.sp.factory.usersChanged(self.testServer, [ukey])
+        self.assertFalse(self.sp._allowed('listUsers', self.testUser))
+        self.assertTrue(self.sp._allowed('listUsers', user))
+        self.assertTrue(self.sp._allowedServer('listServers', self.testServer))
+        
+        # only the users that changed are checked again
+        self.testUser.location = 'room1'
+        self.assertFalse(self.sp._allowed('listUsers', self.testUser))
+        self.sp.factory.usersChanged(self.testServer, [self.testUkey])
+        self.assertTrue(self.sp._allowed('listUsers', self.testUser))
+        
+        # shared by connections with the same ACL and username
+        sp = ServerProtocol()
+        sp.factory = self.sp.factory
+        sp.transport = Transport()
+        sp.connectionMade()
+        self.assertTrue(sp._visibility is self.sp._visibility)
+    
+    def test_cancel(self):
+        config.configuration.set('ACL', 'fakeuser', 'ALL: ALL')
+        self.sp.connectionMade()
+        agentDeferred = defer.Deferred()
+        self.testServer.agentProtocol.getProcesses.mock_returns = agentDeferred
+        
+        self.sp.transport.written = ''
+        self.sp._requestReceived('''{"args": [{"username": "testuser", "client": "ltsp200",
+        "display": ":1234", "server": "ltspserver00"}], "request": "listProcesses"}''')
+        self.assertEqual(self.sp.transport.written, '') # waiting for the agent
+        self.assertEqual(self.sp._pending.keys(), [1])
+        
+        self.sp._requestReceived('{"args": [1, 5], "request": "cancel"}')
+        self.assertTrue(agentDeferred.called)
+        self.assertEqual(self.sp._pending, {})
+        self.assertIn('"error": "cancelled"', self.sp.transport.written)
+        self.assertIn('"data": [1], "request": "cancel"', self.sp.transport.written)
+    
+    def test_timeout(self):
+        config.configuration.set('ACL', 'fakeuser', 'ALL: ALL')
+        self.sp.connectionMade()
+        self.testServer.agentProtocol.shutdown.mock_returns = \
+            defer.fail(defer.TimeoutError('shutdown'))
+        d = defer.Deferred()
+        def cbSuccess(result):
+            self.assertEqual(result, [{'server': 'ltspserver00', 'action': 'reboot',
+                                       'error': 'timeout'}])
+        d.addCallback(cbSuccess)
+        self.sp._handleShutdown(d, 1, 'shutdown', [{'server': 'ltspserver00', 'action': 'reboot'}])
+        return d
+    
+    def test_stream(self):
+        config.configuration.set('ACL', 'fakeuser', 'ALL: ALL')
+        self.sp.connectionMade()
+        s = Server()
+        s.__dict__.update(self.testServer.__dict__)
+        s.hostname = 'ltspserver01'
+        user = User()
+        user.__dict__.update(self.testUser.__dict__)
+        user.server = s.hostname
+        ukey = (user.username, user.server, user.client, user.display)
+        s.users = {ukey: user}
+        s.agentProtocol = minimock.Mock('agentProtocol', tracker=None)
+        agentDeferred = s.agentProtocol.getThumbnails = minimock.Mock('getThumbnails', tracker=None)
+        agentDeferred.mock_returns = defer.Deferred()
+        self.sp.factory.servers[s.hostname] = s
+        self.sp.factory.usersChanged(s, [ukey])
+        
+        req = '''{"args": [{"username": "testuser", "client": "ltsp200", "display": ":1234",
+        "server": "ltspserver00"}, {"username": "testuser", "client": "ltsp200", "display": ":1234",
+        "server": "ltspserver01"}, {"username": "nobody", "client": "ltsp200", "display": ":1234",
+        "server": "ltspserver00"}], "request": "getThumbnails", "stream": true}'''
+        self.sp.transport.written = ''
+        self.sp._requestReceived(req)
+        # the first server has answered
+        self.assertIn('"server": "ltspserver00"', self.sp.transport.written)
+        self.assertIn('"partial": true', self.sp.transport.written)
+        self.assertNotIn('ltspserver01', self.sp.transport.written)
+        
+        self.sp.transport.written = ''
+        agentDeferred.mock_returns.callback([{'username': 'testuser', 'client': 'ltsp200',
+                                              'display': ':1234', 'mock': 1}])
+        partial, complete = self.sp.transport.written[4:].split('}\x00\x00')
+        self.assertIn('"server": "ltspserver01"', partial)
+        self.assertIn('"partial": true', partial)
+        # the rest, and the end of the response
+        self.assertIn('"username": "nobody"', complete)
+        self.assertNotIn('partial', complete)
+        self.assertEqual(self.sp._streams, {})
+    
+    def test_stream_batch(self):
+        # stream only applies to requests sent on their own
+        config.configuration.set('ACL', 'fakeuser', 'ALL: ALL')
+        self.sp.connectionMade()
+        self.sp.transport.written = ''
+        self.sp._requestReceived('''{"args": [{"request": "getThumbnails", "args": [
+        {"username": "testuser", "client": "ltsp200", "display": ":1234",
+        "server": "ltspserver00"}]}], "request": "batch", "stream": true}''')
+        self.assertNotIn('partial', self.sp.transport.written)
+        self.assertIn('"mock": 1', self.sp.transport.written)
+        self.assertEqual(self.sp._streams, {})
@@ -0,0 +1,31 @@
+from twisted.trial import unittest
+from sepiida.server.changelog import ChangeLog
+
+class TestChangeLog(unittest.TestCase):
+    def setUp(self):
+        self.changes = ChangeLog()
+    
+    def test_since(self):
+        version = self.changes.token()
+        self.changes.record('users', ('user1', 'server', '', ':0'))
+        self.changes.record('servers', 'server')
+        self.changes.record('users', ('user1', 'server', '', ':0'))
+        self.assertEqual(self.changes.since('users', version),
+                         set([('user1', 'server', '', ':0')]))
+        self.assertEqual(self.changes.since('servers', version), set(['server']))
+        self.assertEqual(self.changes.since('servers', self.changes.token()), set())
+        
+        for token in (None, 'invalid', 'gen:1',
+                      '%s:99' % self.changes.generation,
+                      ChangeLog().token()):
+            self.assertEqual(self.changes.since('users', token), None)
+    
+    def test_horizon(self):
+        self.changes.MAX_CHANGES = 2
+        version = self.changes.token()
+        for server in ('server1', 'server2', 'server3'):
+            self.changes.record('servers', server)
+        self.assertEqual(self.changes.since('servers', version), None)
+        self.changes.record('servers', 'server4')
+        self.assertEqual(self.changes.since('servers', '%s:2' % self.changes.generation),
+                         set(['server3', 'server4']))
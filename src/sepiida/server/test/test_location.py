@@ -0,0 +1,38 @@
+from twisted.trial import unittest
+from sepiida.server import location
+import os
+
+class TestLocationMap(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.write('# comment\n'
+                   'ws00 ws01    room0\n'
+                   'lab*\t\tlab\n'
+                   '00:11:22:33:44:55    room1\n'
+                   'ltspserver00 *    everywhere\n'
+                   'ws01 lab01    notused\n')
+        self.map = location.LocationMap(self.path, checkInterval=0)
+    
+    def write(self, data):
+        f = open(self.path, 'w')
+        f.write(data)
+        f.close()
+    
+    def test_lookup(self):
+        self.assertEqual(self.map.lookup('ltspserver00', 'WS01', ''), u'room0')
+        self.assertEqual(self.map.lookup('ltspserver00', 'lab01', ''), u'lab')
+        self.assertEqual(self.map.lookup('ltspserver00', 'ltsp200', '00-11-22-33-44-55'), u'room1')
+        # a pattern on an earlier line wins over an exact match
+        self.assertEqual(self.map.lookup('ltspserver00', 'lab00', '00:11:22:33:44:55'), u'lab')
+        self.assertEqual(self.map.lookup('ltspserver00', '', ''), u'everywhere')
+        self.assertEqual(self.map.lookup('ltspserver01', 'ltsp201', ''), u'everywhere')
+    
+    def test_reload(self):
+        self.assertEqual(self.map.lookup('ltspserver00', 'ws00', ''), u'room0')
+        self.write('ws00    room2\n')
+        os.utime(self.path, (0, 0))
+        self.assertEqual(self.map.lookup('ltspserver00', 'ws00', ''), u'room2')
+        self.assertEqual(self.map.lookup('ltspserver00', 'ws01', ''), u'')
+        
+        os.unlink(self.path)
+        self.assertEqual(self.map.lookup('ltspserver00', 'ws00', ''), u'')
@@ -0,0 +1,169 @@
+from twisted.trial import unittest
+from twisted.internet import task, defer, error
+from sepiida.server import config
+from sepiida.server.poller import AgentProtocol, PollerFactory
+from sepiida.server.timers import Deadlines
+from sepiida.server.resultcache import ResultCache
+from sepiida import wire
+
+config.reload()
+
+class ServerFactory(object):
+    pass
+
+class Conn(object):
+    pass
+
+class Transport(object):
+    def __init__(self):
+        self.written = ''
+    
+    def write(self, s):
+        self.written += s
+
+ukey = {'username': 'testuser', 'client': 'ltsp200', 'display': ':1234'}
+
+class TestAgentProtocol(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        serverFactory = ServerFactory()
+        serverFactory.timers = Deadlines(clock=self.clock)
+        serverFactory.results = ResultCache(1024 * 1024)
+        conn = Conn()
+        conn.factory = PollerFactory('ltspserver00', None, serverFactory)
+        self.ap = AgentProtocol(conn)
+        self.ap._requests.clear() # no hello
+        self.ap.features = ['cancel']
+        self.ap.transport = Transport()
+    
+    def tearDown(self):
+        for option in ('thumbnails timeout', 'thumbnails max age'):
+            if config.configuration.has_option('Server', option):
+                config.configuration.remove_option('Server', option)
+    
+    def _requests(self):
+        written = self.ap.transport.written
+        requests = []
+        while written:
+            length = int(written[:4].encode('hex'), 16)
+            requests.append(wire.Codec().decode(written[4:4+length]))
+            written = written[4+length:]
+        return [(r['request'], r['args']) for r in requests]
+    
+    def test_timeout(self):
+        config.configuration.set('Server', 'thumbnails timeout', '5')
+        d = self.ap.getThumbnails([ukey])
+        self.assertFailure(d, defer.TimeoutError)
+        self.clock.advance(5)
+        self.assertTrue(d.called)
+        self.assertEqual(self._requests(), [('thumbnails', [ukey]), ('cancel', [0])])
+        
+        # a late response is ignored
+        self.ap.stringReceived(wire.Codec().encode({'requestID': 0, 'data': []}))
+        self.assertEqual(self.ap._cancelled, set())
+        return d
+    
+    def test_cancel(self):
+        d = self.ap.getProcesses([ukey])
+        self.assertFailure(d, defer.CancelledError)
+        d.cancel()
+        self.assertEqual(self._requests(), [('processes', [ukey]), ('cancel', [0])])
+        self.assertEqual(self.ap._requests.keys(), [1]) # the cancel request
+        return d
+    
+    def test_connectionLost(self):
+        d = self.ap.getProcesses([ukey])
+        self.assertFailure(d, error.ConnectionLost)
+        self.ap.connectionLost()
+        self.assertEqual(self.ap._requests, {})
+        return d
+    
+    def test_shared(self):
+        other = dict(ukey, username='otheruser')
+        results = []
+        d1 = self.ap.getProcesses([ukey])
+        d1.addCallback(results.append)
+        d2 = self.ap.getProcesses([other, ukey])
+        d2.addCallback(results.append)
+        # only otheruser is asked for again
+        self.assertEqual(self._requests(), [('processes', [ukey]), ('processes', [other])])
+        
+        self.ap.stringReceived(wire.Codec().encode(
+            {'requestID': 1, 'data': [dict(other, processes=[])]}))
+        self.assertEqual(results, [])
+        self.ap.stringReceived(wire.Codec().encode(
+            {'requestID': 0, 'data': [dict(ukey, processes=[[1, 'init']])]}))
+        self.assertEqual(results, [[dict(ukey, processes=[[1, 'init']])],
+                                   [dict(other, processes=[]),
+                                    dict(ukey, processes=[[1, 'init']])]])
+        # each caller gets a copy
+        self.assertFalse(results[0][0] is results[1][1])
+        self.assertEqual(self.ap._shared, {})
+    
+    def test_shared_cancel(self):
+        d1 = self.ap.getThumbnails([ukey])
+        d2 = self.ap.getThumbnails([ukey])
+        self.assertFailure(d1, defer.CancelledError)
+        d1.cancel()
+        self.assertEqual(self._requests(), [('thumbnails', [ukey])])
+        d2.cancel()
+        self.assertEqual(self._requests(), [('thumbnails', [ukey]), ('cancel', [0])])
+        self.assertEqual(self.ap._shared, {})
+        return self.assertFailure(d2, defer.CancelledError)
+    
+    def test_cached(self):
+        results = []
+        self.ap.getThumbnails([ukey]).addCallback(results.append)
+        self.ap.stringReceived(wire.Codec().encode(
+            {'requestID': 0, 'data': [dict(ukey, token='abc', thumbnail='anBlZw==')]}))
+        
+        # from the cache, without sending a request
+        self.ap.getThumbnails([ukey]).addCallback(results.append)
+        self.ap.getThumbnails([dict(ukey, token='abc')]).addCallback(results.append)
+        self.assertEqual(self._requests(), [('thumbnails', [ukey])])
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], [dict(ukey, token='abc', notmodified=True)])
+        
+        # too old
+        config.configuration.set('Server', 'thumbnails max age', '0')
+        self.ap.getThumbnails([ukey])
+        self.assertEqual(len(self._requests()), 2)
+    
+    def test_cached_logout(self):
+        factory = self.ap.conn.factory
+        factory.serverFactory.usersChanged = lambda poller, ukeys: None
+        user = {'username': 'testuser', 'client': 'ltsp200', 'display': ':1234',
+                'hwaddr': '', 'name': 'Test User', 'groups': [], 'time': 0}
+        factory.userInfoReceived([user])
+        self.ap.getProcesses([ukey])
+        self.ap.stringReceived(wire.Codec().encode(
+            {'requestID': 0, 'data': [dict(ukey, version='a:1', processes=[])]}))
+        self.assertEqual(len(factory.serverFactory.results), 1)
+        
+        results = []
+        self.ap.getProcesses([ukey]).addCallback(results.append)
+        self.ap.getProcesses([dict(ukey, since='a:1')]).addCallback(results.append)
+        self.assertEqual(results, [[dict(ukey, version='a:1', processes=[])],
+                                   [dict(ukey, version='a:1', added=[], removed=[])]])
+        # the client may have a newer list than the cache
+        self.ap.getProcesses([dict(ukey, since='a:2')])
+        self.assertEqual(len(self._requests()), 2)
+        
+        factory.userInfoReceived([])
+        self.assertEqual(len(factory.serverFactory.results), 0)
+    
+    def test_shared_invalidResponse(self):
+        d = self.ap.getProcesses([ukey])
+        self.assertFailure(d, ValueError)
+        self.ap.stringReceived(wire.Codec().encode(
+            {'requestID': 0, 'data': '', 'error': 'invalid request'}))
+        self.assertEqual((self.ap._shared, self.ap._flights), ({}, {}))
+        
+        # fewer results than users asked for
+        other = dict(ukey, username='otheruser')
+        d2 = self.ap.getProcesses([ukey, other])
+        self.assertFailure(d2, ValueError)
+        self.ap.stringReceived(wire.Codec().encode(
+            {'requestID': 1, 'data': [dict(ukey, processes=[])]}))
+        self.assertEqual((self.ap._shared, self.ap._flights), ({}, {}))
+        return defer.gatherResults([d, d2])
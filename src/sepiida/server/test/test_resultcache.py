@@ -0,0 +1,36 @@
+from twisted.trial import unittest
+from sepiida.server.resultcache import ResultCache, resultSize
+from sepiida import wire
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResultCache(3000)
+    
+    def test_maxAge(self):
+        self.cache.put('a', {'processes': []})
+        self.assertEqual(self.cache.get('a', 2), {'processes': []})
+        self.assertEqual(self.cache.get('a', 0), None)
+        self.assertEqual(self.cache.peek('a'), {'processes': []})
+    
+    def test_lru(self):
+        thumbnail = {'thumbnail': wire.Binary('x' * 800)}
+        self.cache.put('a', thumbnail)
+        self.cache.put('b', thumbnail)
+        self.cache.get('a', 2) # b is now the least recently used
+        self.cache.put('c', thumbnail)
+        self.assertEqual(sorted(self.cache._results), ['a', 'b', 'c'])
+        self.cache.put('d', thumbnail)
+        self.assertEqual(sorted(self.cache._results), ['a', 'c', 'd'])
+        self.assertEqual(self.cache.size, 3 * resultSize(thumbnail))
+        
+        # too large to keep
+        self.cache.put('e', {'thumbnail': wire.Binary('x' * 4000)})
+        self.assertEqual(self.cache.peek('e'), None)
+        self.assertEqual(len(self.cache), 3)
+    
+    def test_discard(self):
+        self.cache.put('a', {'processes': []})
+        self.cache.discard('a')
+        self.cache.discard('b')
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.size, 0)
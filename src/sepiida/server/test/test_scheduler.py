@@ -0,0 +1,70 @@
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from sepiida.server.scheduler import ConnectionScheduler
+import time
+
+class TestConnectionScheduler(unittest.TestCase):
+    def setUp(self):
+        self.attempts = {} # {host: deferred}
+        self.scheduler = ConnectionScheduler(self.connect, maxConcurrent=3,
+                                             initialWindow=1, minBackoff=30,
+                                             timeout=60)
+        self.scheduler.clock = self.clock = task.Clock()
+    
+    def connect(self, host):
+        d = self.attempts[host] = defer.Deferred()
+        return d
+    
+    def test_slowStart(self):
+        for host in range(6):
+            self.assertTrue(self.scheduler.schedule(host))
+        self.assertFalse(self.scheduler.schedule(0))
+        self.assertEqual(self.attempts.keys(), [0])
+        self.assertEqual(self.scheduler.stats()['queued'], 5)
+        
+        self.attempts[0].callback(None) # window is now 2
+        self.assertEqual(sorted(self.attempts), [0, 1, 2])
+        self.attempts[1].callback(None)
+        self.attempts[2].callback(None) # window is now 3, the maximum
+        self.assertEqual(sorted(self.attempts), range(6))
+        self.assertEqual(self.scheduler.stats(),
+                         {'queued': 0, 'connecting': 3, 'backoff': 0, 'window': 3})
+    
+    def test_backoff(self):
+        self.scheduler.schedule('host')
+        self.attempts.pop('host').errback(Exception('connection refused'))
+        self.assertEqual(self.scheduler.stats()['backoff'], 1)
+        self.assertFalse(self.scheduler.schedule('host'))
+        failures, nextAttempt = self.scheduler._backoff['host']
+        self.assertEqual(failures, 1)
+        self.assertTrue(15 - 1 < nextAttempt - time.time() <= 30)
+        
+        # the delay doubles for each failure, jittered by up to half
+        self.scheduler._backoff['host'] = (failures, 0)
+        self.assertTrue(self.scheduler.schedule('host'))
+        self.attempts.pop('host').errback(Exception('connection refused'))
+        failures, nextAttempt = self.scheduler._backoff['host']
+        self.assertEqual(failures, 2)
+        self.assertTrue(30 - 1 < nextAttempt - time.time() <= 60)
+        
+        # success resets it
+        self.scheduler._backoff['host'] = (2, 0)
+        self.scheduler.schedule('host')
+        self.attempts.pop('host').callback(None)
+        self.assertEqual(self.scheduler.stats()['backoff'], 0)
+        self.assertFalse('host' in self.scheduler._backoff)
+    
+    def test_retain(self):
+        for host in ('host', 'removed'):
+            self.scheduler.schedule(host)
+            self.attempts.pop(host).errback(Exception('connection refused'))
+        self.scheduler.retain(set(['host', 'other']))
+        self.assertEqual(self.scheduler._backoff.keys(), ['host'])
+    
+    def test_timeout(self):
+        self.scheduler.schedule('host')
+        self.scheduler.schedule('other')
+        self.clock.advance(61)
+        self.assertTrue(self.attempts['host'].called)
+        self.assertEqual(self.scheduler.stats()['backoff'], 1)
+        self.assertTrue('other' in self.attempts)
@@ -0,0 +1,42 @@
+from twisted.trial import unittest
+from twisted.conch.ssh import common
+from sepiida.server import sshkeys
+from base64 import b64encode
+import hashlib
+import hmac
+import os
+
+class TestKnownHosts(unittest.TestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        self.rsaKey = common.NS('ssh-rsa') + 'rsa key'
+        self.dssKey = common.NS('ssh-dss') + 'dss key'
+        salt = 'saltsaltsaltsaltsalt'
+        hashed = '|1|%s|%s' % (b64encode(salt),
+                    b64encode(hmac.new(salt, 'hashedhost', hashlib.sha1).digest()))
+        f = open(self.path, 'w')
+        f.write('# comment\n')
+        f.write('ws00,ws01 ssh-rsa %s\n' % b64encode(self.rsaKey))
+        f.write('ws01 ssh-dss %s\n' % b64encode(self.dssKey))
+        f.write('%s ssh-rsa %s\n' % (hashed, b64encode(self.rsaKey)))
+        f.write('invalid line\n')
+        f.close()
+        self.knownHosts = sshkeys.KnownHosts(self.path)
+    
+    def test_check(self):
+        check = self.knownHosts.check
+        self.assertEqual(check('ws00', self.rsaKey), 1)
+        self.assertEqual(check('ws01', self.dssKey), 1)
+        self.assertEqual(check('ws00', self.dssKey), 0)
+        self.assertEqual(check('ws00', common.NS('ssh-rsa') + 'other key'), 2)
+        self.assertEqual(check('hashedhost', self.rsaKey), 1)
+        self.assertEqual(check('unknown', self.rsaKey), 0)
+    
+    def test_reload(self):
+        self.assertEqual(self.knownHosts.check('ws02', self.rsaKey), 0)
+        f = open(self.path, 'a')
+        f.write('ws02 ssh-rsa %s\n' % b64encode(self.rsaKey))
+        f.close()
+        os.utime(self.path, (0, 0))
+        self.knownHosts._checkedAt = 0
+        self.assertEqual(self.knownHosts.check('ws02', self.rsaKey), 1)
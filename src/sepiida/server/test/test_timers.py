@@ -0,0 +1,43 @@
+from twisted.trial import unittest
+from twisted.internet import task
+from sepiida.server.timers import Deadlines
+
+class TestDeadlines(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.timers = Deadlines(resolution=1.0, clock=self.clock)
+        self.called = []
+    
+    def test_order(self):
+        for delay in (3.5, 1.2, 2.0, 1.7):
+            self.timers.callLater(delay, self.called.append, delay)
+        # one reactor timer for all of them
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(1.5)
+        self.assertEqual(self.called, [])
+        # 1.2 and 1.7 are rounded up to 2.0, and run in one wakeup
+        self.clock.advance(0.5)
+        self.assertEqual(sorted(self.called), [1.2, 1.7, 2.0])
+        self.clock.advance(2)
+        self.assertEqual(self.called[-1], 3.5)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+    
+    def test_cancel(self):
+        d1 = self.timers.callLater(1, self.called.append, 1)
+        d2 = self.timers.callLater(2, self.called.append, 2)
+        d1.cancel()
+        self.assertFalse(d1.active())
+        self.clock.advance(2)
+        self.assertEqual(self.called, [2])
+        self.assertFalse(d2.active())
+    
+    def test_reschedule(self):
+        # a call scheduling a new call, like the watchdog does
+        def watchdog(n):
+            self.called.append(n)
+            if n < 3:
+                self.timers.callLater(10, watchdog, n + 1)
+        self.timers.callLater(10, watchdog, 1)
+        self.clock.pump([10, 10, 10, 10])
+        self.assertEqual(self.called, [1, 2, 3])
+        self.assertEqual(len(self.timers), 0)
@@ -0,0 +1,38 @@
+from twisted.trial import unittest
+from sepiida.server.userindex import UserIndex
+
+class User(object):
+    def __init__(self, username, location, groups, client, hwaddr):
+        self.username = username
+        self.location = location
+        self.groups = groups
+        self.client = client
+        self.clientHWAddr = hwaddr
+
+class TestUserIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = UserIndex()
+        self.user1 = User('user1', 'room0', ['pupils'], 'ltsp1', '00:11:22:33:44:55')
+        self.user2 = User('user2', 'room0', ['pupils', 'teachers'], '', None)
+        self.index.update(('user1', 'server', 'ltsp1', ':1'), self.user1)
+        self.index.update(('user2', 'server', '', ':0'), self.user2)
+    
+    def test_lookups(self):
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.byUsername('user1'), [self.user1])
+        self.assertEqual(sorted(self.index.byLocation('room0')), sorted([self.user1, self.user2]))
+        self.assertEqual(self.index.byGroup('teachers'), [self.user2])
+        self.assertEqual(self.index.byClient('ltsp1'), [self.user1])
+        self.assertEqual(self.index.byHWAddr('00-11-22-33-44-55'), [self.user1])
+        self.assertEqual(self.index.byUsername('nobody'), [])
+    
+    def test_update(self):
+        self.user1.location = 'room1'
+        self.index.update(('user1', 'server', 'ltsp1', ':1'), self.user1)
+        self.assertEqual(self.index.byLocation('room0'), [self.user2])
+        self.assertEqual(self.index.byLocation('room1'), [self.user1])
+        
+        self.index.update(('user2', 'server', '', ':0'), None)
+        self.assertEqual(self.index.byGroup('pupils'), [self.user1])
+        self.assertEqual(self.index.byGroup('teachers'), [])
+        self.assertEqual(len(self.index), 1)
@@ -0,0 +1,110 @@
+from twisted.trial import unittest
+from sepiida import wire
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.codec = wire.Codec()
+        self.message = {'requestID': 1, 'data': [{'thumbnail': wire.Binary('\x00\xff')},
+                                                 {'thumbnail': wire.Binary('')}]}
+    
+    def test_base64(self):
+        encoded = self.codec.encode(self.message)
+        self.assertIn('"AP8="', encoded)
+        decoded = self.codec.decode(encoded)
+        self.assertEqual(wire.binaryData(decoded['data'][0]['thumbnail']), '\x00\xff')
+    
+    def test_binary(self):
+        self.assertEqual(self.codec.setPeerFeatures(['binary', 'unknown']),
+                         frozenset(['binary']))
+        encoded = self.codec.encode(self.message)
+        self.assertEqual(encoded[0], wire.BLOB_FRAME)
+        decoded = wire.Codec().decode(encoded)
+        self.assertEqual(decoded['requestID'], 1)
+        self.assertEqual(decoded['data'][0]['thumbnail'], wire.Binary('\x00\xff'))
+        self.assertEqual(wire.binaryData(decoded['data'][1]['thumbnail']), '')
+        
+        # messages without blobs are still plain JSON
+        self.assertEqual(self.codec.encode({'data': []}), '{"data": []}')
+    
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.codec.decode, wire.BLOB_FRAME + '\x00')
+        self.assertRaises(ValueError, self.codec.decode,
+                          wire.BLOB_FRAME + '\x00\x00\x00\x0c{"$blob": 0}')
+    
+    def test_zlib(self):
+        self.codec.setPeerFeatures(['zlib'])
+        receiver = wire.Codec()
+        message = {'request': 'users', 'requestID': -1,
+                   'data': [{'username': 'user%d' % i, 'groups': ['students', 'room0']}
+                            for i in range(20)]}
+        plain = len(wire.Codec().encode(message))
+        first = self.codec.encode(message)
+        second = self.codec.encode(message)
+        self.assertEqual(first[0], wire.ZLIB_FRAME)
+        self.assertTrue(len(first) < plain)
+        # the second message refers back to the first
+        self.assertTrue(len(second) < len(first))
+        self.assertEqual(receiver.decode(first), message)
+        self.assertEqual(receiver.decode(second), message)
+        
+        # blob frames aren't compressed
+        self.codec.setPeerFeatures(['binary', 'zlib'])
+        encoded = self.codec.encode(self.message)
+        self.assertEqual(encoded[0], wire.BLOB_FRAME)
+        self.assertEqual(receiver.decode(encoded)['data'][0]['thumbnail'].data, '\x00\xff')
+        # and don't affect the stream
+        self.assertEqual(receiver.decode(self.codec.encode(message)), message)
+        
+        self.assertRaises(wire.StreamError, wire.Codec().decode, wire.ZLIB_FRAME + 'invalid')
+    
+    def test_zlibTooLarge(self):
+        self.codec.setPeerFeatures(['zlib'])
+        receiver = wire.Codec()
+        large = self.codec.encode({'data': 'x' * (wire.MAX_DECOMPRESSED + 1)})
+        self.assertRaises(wire.StreamError, receiver.decode, large)
+        # the rest of the stream can't be decoded
+        self.assertRaises(wire.StreamError, receiver.decode,
+                          self.codec.encode({'data': 'small'}))
+    
+    def test_compact(self):
+        self.codec.setPeerFeatures(['compact'])
+        users = [{'username': 'user%d' % i, 'server': 'ltspserver00',
+                  'client': '', 'display': ':%d' % i} for i in range(10)]
+        message = {'request': 'listUsers', 'requestID': 1, 'error': '', 'data': users}
+        encoded = self.codec.encode(message)
+        self.assertEqual(encoded[0], wire.COMPACT_FRAME)
+        self.assertEqual(encoded.count('"username"'), 1)
+        self.assertEqual(wire.Codec().decode(encoded), message)
+        
+        # lists which aren't tables are sent as they are
+        for data in ([users[0]], [users[0], {'username': 'a'}], [1, 2], {'load': 0.0}):
+            message['data'] = data
+            self.assertEqual(wire.Codec().decode(self.codec.encode(message)), message)
+        
+        # dicts that look like tables are left alone
+        tableLike = {'$t': ['a'], '$r': [[1]]}
+        for data in (tableLike, [tableLike, tableLike], [{'a': tableLike}, {'a': 1}]):
+            message['data'] = data
+            self.assertEqual(wire.Codec().decode(self.codec.encode(message)), message)
+            self.assertEqual(wire.Codec().decode(self.codec.encode(
+                {'data': wire.Prepared(data)})), {'data': data})
+        
+        # with blobs and compression
+        self.codec.setPeerFeatures(wire.FEATURES)
+        encoded = self.codec.encode(self.message)
+        self.assertEqual(encoded[0], wire.BLOB_FRAME)
+        self.assertEqual(wire.Codec().decode(encoded), self.message)
+        message['data'] = users
+        self.assertEqual(wire.Codec().decode(self.codec.encode(message)), message)
+    
+    def test_prepared(self):
+        data = wire.Prepared([{'username': 'a', 'display': ':0'}, {'username': 'b', 'display': ':1'}])
+        message = {'request': 'listUsers', 'requestID': 1, 'data': data}
+        expected = {'request': 'listUsers', 'requestID': 1, 'data': data.value}
+        self.assertEqual(wire.Codec().decode(self.codec.encode(message)), expected)
+        self.codec.setPeerFeatures(wire.FEATURES)
+        receiver = wire.Codec()
+        for i in range(2):
+            encoded = self.codec.encode(message)
+            self.assertEqual(receiver.decode(encoded), expected)
+        self.assertEqual(sorted(data._encoded), [False, True])
@@ -0,0 +1,111 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+from twisted.internet import reactor
+from twisted.python import log
+import heapq
+import math
+
+class Deadline(object):
+    """
+    A call scheduled with Deadlines, like a DelayedCall.
+    """
+    __slots__ = ('time', 'func', 'args', 'cancelled', 'called')
+
+    def __init__(self, time, func, args):
+        self.time = time
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.called = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __cmp__(self, other):
+        return cmp(self.time, other.time)
+
+class Deadlines(object):
+    """
+    Calls functions at given times, using a heap and a single reactor timer
+    for all of them, e.g. for the watchdogs of thousands of agent
+    connections.
+    Times are rounded up to a multiple of resolution seconds, so that calls
+    due at about the same time are run in one wakeup.
+    Cancelled calls are left in the heap until they're due.
+    """
+    def __init__(self, resolution=1.0, clock=reactor):
+        self.resolution = resolution
+        self.clock = clock
+        self._heap = []
+        self._timer = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def callAt(self, when, func, *args):
+        """
+        Call func(*args) at time when (in seconds since the epoch, as from
+        clock.seconds()). Returns a Deadline.
+        """
+        when = math.ceil(when / self.resolution) * self.resolution
+        deadline = Deadline(when, func, args)
+        heapq.heappush(self._heap, deadline)
+        if self._heap[0] is deadline:
+            self._reschedule()
+        return deadline
+
+    def callLater(self, delay, func, *args):
+        return self.callAt(self.clock.seconds() + delay, func, *args)
+
+    def _reschedule(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        if self._heap:
+            delay = max(0, self._heap[0].time - self.clock.seconds())
+            self._timer = self.clock.callLater(delay, self._run)
+
+    def _run(self):
+        self._timer = None
+        now = self.clock.seconds()
+        while self._heap and self._heap[0].time <= now:
+            deadline = heapq.heappop(self._heap)
+            if deadline.cancelled:
+                continue
+            deadline.called = True
+            try:
+                deadline.func(*deadline.args)
+            except:
+                log.err()
+        if self._timer is None:
+            self._reschedule()
+
+    def stop(self):
+        """
+        Cancel all calls.
+        """
+        for deadline in self._heap:
+            deadline.cancel()
+        self._heap = []
+        self._reschedule()
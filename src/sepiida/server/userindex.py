@@ -0,0 +1,91 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+from location import normalizeHWAddr
+
+class UserIndex(object):
+    """
+    Index of the users logged in on connected servers, by username,
+    location, group, client and client hardware address.
+    Kept up to date by ServerFactory.usersChanged, which calls update for
+    each user that has logged in or out, or changed location.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._users = {} # {ukey: (user, (username, location, groups, client, hwaddr))}
+        self._byUsername = {} # {username: {ukey: user}}
+        self._byLocation = {}
+        self._byGroup = {}
+        self._byClient = {}
+        self._byHWAddr = {}
+
+    def __len__(self):
+        return len(self._users)
+
+    def _attrs(self, user):
+        return (user.username, user.location, tuple(user.groups),
+                user.client, normalizeHWAddr(getattr(user, 'clientHWAddr', None) or ''))
+
+    def _entries(self, attrs):
+        username, location, groups, client, hwaddr = attrs
+        yield self._byUsername, username
+        yield self._byLocation, location
+        for group in groups:
+            yield self._byGroup, group
+        if client:
+            yield self._byClient, client
+        if hwaddr:
+            yield self._byHWAddr, hwaddr
+
+    def update(self, ukey, user):
+        """
+        Index user as ukey, or remove ukey from the index if user is None.
+        """
+        try:
+            old, attrs = self._users.pop(ukey)
+        except KeyError:
+            pass
+        else:
+            for index, value in self._entries(attrs):
+                users = index[value]
+                del users[ukey]
+                if not users:
+                    del index[value]
+        if user is None:
+            return
+
+        attrs = self._attrs(user)
+        self._users[ukey] = (user, attrs)
+        for index, value in self._entries(attrs):
+            index.setdefault(value, {})[ukey] = user
+
+    def byUsername(self, username):
+        return self._byUsername.get(username, {}).values()
+
+    def byLocation(self, location):
+        return self._byLocation.get(location, {}).values()
+
+    def byGroup(self, group):
+        return self._byGroup.get(group, {}).values()
+
+    def byClient(self, client):
+        return self._byClient.get(client, {}).values()
+
+    def byHWAddr(self, hwaddr):
+        return self._byHWAddr.get(normalizeHWAddr(hwaddr), {}).values()
@@ -0,0 +1,80 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+class Visibility(object):
+    """
+    The users and servers an ACL's filter lets username see, shared by
+    the connections with the same ACL and username (see
+    ServerFactory.visibility).
+    Kept up to date by ServerFactory.usersChanged, only the users that
+    changed are checked again, unless they're username's own users, whose
+    locations sameLocation depends on.
+    """
+    def __init__(self, acl, username, factory):
+        self.acl = acl
+        self.username = username
+        self.factory = factory
+        self.rebuild()
+
+    def rebuild(self):
+        self.locations = [user.location for user in
+                          self.factory.index.byUsername(self.username)]
+        self._users = set() # ukeys
+        self._servers = {} # {hostname: number of visible users}
+        for poller in self.factory.servers.itervalues():
+            if poller.connected:
+                for ukey, user in poller.users.iteritems():
+                    self._set(ukey, user)
+
+    def update(self, poller, ukeys):
+        """
+        Check users ukeys on poller again, after they've logged in or out,
+        or changed location.
+        """
+        for ukey in ukeys:
+            if ukey[0] == self.username:
+                self.rebuild()
+                return
+        for ukey in ukeys:
+            user = None
+            if poller.connected:
+                user = poller.users.get(ukey)
+            self._set(ukey, user)
+
+    def _set(self, ukey, user):
+        visible = user is not None and self.acl.filterAllows(self.locations, user)
+        if visible == (ukey in self._users):
+            return
+        hostname = ukey[1]
+        if visible:
+            self._users.add(ukey)
+            self._servers[hostname] = self._servers.get(hostname, 0) + 1
+        else:
+            self._users.discard(ukey)
+            self._servers[hostname] -= 1
+            if not self._servers[hostname]:
+                del self._servers[hostname]
+
+    def allowsUser(self, user):
+        return (user.username, user.server, user.client, user.display) in self._users
+
+    def allowsServer(self, server):
+        """
+        Return True if any of the users on server are visible, or no users
+        are logged in on it (as ACL.requestAllowedServer).
+        """
+        return not server.users or server.hostname in self._servers
@@ -0,0 +1,308 @@
+# Copyright 2009-2011 Linnea Skogtvedt <linnea@linuxavdelingen.no>
+#
+# This file is part of Sepiida.
+#
+# Sepiida is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Sepiida is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Sepiida.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Encoding of the messages (requests and responses) sent as Int32-prefixed
+strings between agents, the server and clients.
+
+Messages are JSON encoded unless the receiving end has announced that it
+supports other frame types, see Codec. Each end announces the features it
+can decode in the hello exchange:
+ * binary - Binary values are sent as raw blobs after a JSON header instead
+   of being base64 encoded into the JSON.
+ * zlib - Messages are compressed with a deflate stream which is kept for
+   the lifetime of the connection, so that keys, usernames and group names
+   repeated between messages are sent as back-references.
+ * compact - Lists of dicts with the same keys (users, servers, ukeys) are
+   sent as tables, with the keys once followed by a list of values per
+   row. This is about 40% smaller than plain JSON for user lists, and
+   faster to encode and decode as the json module does less work.
+"""
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import struct
+import zlib
+from base64 import b64encode, b64decode
+
+# Features this implementation can decode
+FEATURES = ('binary', 'zlib', 'compact')
+
+BLOB_FRAME = '\x00'
+BLOB_KEY = '$blob'
+ZLIB_FRAME = '\x01'
+COMPACT_FRAME = '\x02'
+TABLE_KEYS = '$t'
+TABLE_ROWS = '$r'
+_length = struct.Struct('!I')
+
+# Deflate parameters for the zlib feature. A small window and memLevel keep
+# the compressor state at about 40 KiB per connection (256 KiB with the
+# defaults), as the server may have thousands of connections. Messages are
+# mostly short and repetitive, so this compresses nearly as well as the
+# defaults.
+ZLIB_LEVEL = 6
+ZLIB_WBITS = 12
+ZLIB_MEMLEVEL = 5
+MAX_DECOMPRESSED = 10000000
+
+class StreamError(ValueError):
+    """
+    The compressed stream is corrupt (or a frame was too large), so no
+    later compressed frames can be decoded and the connection must be
+    closed.
+    """
+
+class Binary(object):
+    """
+    Binary data, e.g. a JPEG thumbnail. Sent as a raw blob if the receiver
+    supports the binary feature, otherwise as a base64 encoded string.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __eq__(self, other):
+        return isinstance(other, Binary) and other.data == self.data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Binary(<%d bytes>)' % len(self.data)
+
+def binaryData(value):
+    """
+    Return the raw data of a value which was sent either as Binary or
+    base64 encoded, e.g. the thumbnail in a getThumbnails response.
+    """
+    if isinstance(value, Binary):
+        return value.data
+    return b64decode(value)
+
+def _b64default(obj):
+    if isinstance(obj, Binary):
+        return b64encode(obj.data)
+    raise TypeError('%r is not JSON serializable' % obj)
+
+def _table(value):
+    """
+    Return value as a table if it's a list of dicts with the same keys,
+    otherwise value. A dict which could be mistaken for a table is escaped.
+    """
+    if isinstance(value, dict) and TABLE_KEYS in value:
+        return {TABLE_KEYS: None, TABLE_ROWS: value}
+    if not isinstance(value, list) or len(value) < 2 or \
+       not isinstance(value[0], dict):
+        return value
+    keys = value[0].keys()
+    n = len(keys)
+    try:
+        rows = [[d[k] for k in keys] for d in value if len(d) == n]
+    except (KeyError, TypeError):
+        return value
+    if len(rows) != len(value):
+        return value
+    return {TABLE_KEYS: keys, TABLE_ROWS: rows}
+
+def _pack(message):
+    """
+    Pack the lists in a message (e.g. data and args) as tables.
+    """
+    return dict((k, _table(v)) for k, v in message.iteritems())
+
+def _untable(value):
+    if isinstance(value, dict) and len(value) == 2 and TABLE_KEYS in value:
+        try:
+            keys = value[TABLE_KEYS]
+            if keys is None:
+                return value[TABLE_ROWS]
+            return [dict(zip(keys, row)) for row in value[TABLE_ROWS]]
+        except (KeyError, TypeError):
+            raise ValueError('invalid table')
+    return value
+
+def _unpack(message):
+    """
+    Unpack the tables in a message packed by _pack. Only the top-level
+    values are tables, so nested dicts are never mistaken for them.
+    """
+    if not isinstance(message, dict):
+        raise ValueError('invalid message')
+    return dict((k, _untable(v)) for k, v in message.iteritems())
+
+class Prepared(object):
+    """
+    Data which is encoded once and sent in several messages, e.g. the same
+    listUsers response to many clients. May only be used as the data of a
+    message. Binary values in it are always base64 encoded.
+    The value must not be modified after it has been encoded.
+    """
+    __slots__ = ('value', '_encoded')
+
+    def __init__(self, value):
+        self.value = value
+        self._encoded = {} # {compact: JSON}
+
+    def encoded(self, compact):
+        try:
+            return self._encoded[compact]
+        except KeyError:
+            pass
+        if compact:
+            value = _table(self.value)
+        else:
+            value = self.value
+        encoded = self._encoded[compact] = json.dumps(value, default=_b64default)
+        return encoded
+
+class Codec(object):
+    """
+    Encodes and decodes messages for one connection.
+    Any known frame type is decoded, but only the features the other end
+    has announced (see setPeerFeatures) are used when encoding.
+    """
+    def __init__(self):
+        self.features = frozenset()
+        self._compressor = None
+        self._decompressor = None
+
+    def setPeerFeatures(self, features):
+        """
+        Set the features the other end can decode, unknown features are
+        ignored. Returns the features which will be used.
+        """
+        self.features = frozenset(features) & frozenset(FEATURES)
+        if 'zlib' in self.features and self._compressor is None:
+            self._compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED,
+                                                -ZLIB_WBITS, ZLIB_MEMLEVEL)
+        return self.features
+
+    def _encodePrepared(self, message):
+        compact = 'compact' in self.features
+        rest = dict(message)
+        data = rest.pop('data')
+        if compact:
+            rest = _pack(rest)
+        header = json.dumps(rest)
+        if rest:
+            header = header[:-1] + ', '
+        else:
+            header = '{'
+        string = header + '"data": ' + data.encoded(compact) + '}'
+        if compact:
+            string = COMPACT_FRAME + string
+        return self._compress(string)
+
+    def encode(self, message):
+        if isinstance(message.get('data'), Prepared):
+            return self._encodePrepared(message)
+        blobs = []
+        if 'binary' in self.features:
+            def default(obj):
+                if isinstance(obj, Binary):
+                    blobs.append(obj.data)
+                    return {BLOB_KEY: len(blobs) - 1}
+                raise TypeError('%r is not JSON serializable' % obj)
+        else:
+            default = _b64default
+
+        if 'compact' in self.features:
+            header = COMPACT_FRAME + json.dumps(_pack(message), default=default)
+        else:
+            header = json.dumps(message, default=default)
+        if not blobs:
+            return self._compress(header)
+        # Blobs (JPEGs) don't compress, and would only push the JSON out
+        # of the deflate window, so blob frames are sent as they are.
+        parts = [BLOB_FRAME, _length.pack(len(header)), header]
+        for blob in blobs:
+            parts.append(_length.pack(len(blob)))
+            parts.append(blob)
+        return ''.join(parts)
+
+    def _compress(self, string):
+        if 'zlib' not in self.features:
+            return string
+        c = self._compressor
+        return ZLIB_FRAME + c.compress(string) + c.flush(zlib.Z_SYNC_FLUSH)
+
+    def _decompress(self, string):
+        if self._decompressor is None:
+            # the largest window decodes streams using any window size
+            self._decompressor = zlib.decompressobj(-15)
+        d = self._decompressor
+        if d is False:
+            raise StreamError('compressed stream is corrupt')
+        try:
+            string = d.decompress(string, MAX_DECOMPRESSED)
+        except zlib.error, e:
+            self._decompressor = False
+            raise StreamError('invalid compressed frame: %s' % e)
+        if d.unconsumed_tail:
+            # the rest of the frame would be decoded as the next one
+            self._decompressor = False
+            raise StreamError('compressed frame too large')
+        return string
+
+    def decode(self, string):
+        """
+        Decode a message. Raises ValueError if it's invalid, or StreamError
+        if the connection must be closed.
+        Compressed frames must be decoded in the order they were sent.
+        """
+        if string[:1] == ZLIB_FRAME:
+            string = self._decompress(string[1:])
+        if string[:1] == COMPACT_FRAME:
+            return _unpack(json.loads(string[1:]))
+        if string[:1] != BLOB_FRAME:
+            return json.loads(string)
+
+        try:
+            size = _length.unpack_from(string, 1)[0]
+            offset = 1 + _length.size
+            header = string[offset:offset+size]
+            offset += size
+            blobs = []
+            while offset < len(string):
+                size = _length.unpack_from(string, offset)[0]
+                offset += _length.size
+                blobs.append(Binary(string[offset:offset+size]))
+                offset += size
+        except struct.error:
+            raise ValueError('invalid blob frame')
+
+        compact = header[:1] == COMPACT_FRAME
+        if compact:
+            header = header[1:]
+        def hook(d):
+            if len(d) == 1 and BLOB_KEY in d:
+                try:
+                    return blobs[d[BLOB_KEY]]
+                except (IndexError, TypeError):
+                    raise ValueError('invalid blob reference')
+            return d
+        message = json.loads(header, object_hook=hook)
+        if compact:
+            return _unpack(message)
+        return message